@@ -107,6 +107,11 @@ def create_app():
             from app.api.message_operations import message_ops_bp
             from app.api.moments_routes import moments_bp
             from app.api.auxiliary_routes import auxiliary_bp
+            from app.api.job_routes import job_bp
+            from app.api.schedule_routes import schedule_bp
+            from app.api.stream_routes import stream_bp
+            from app.api.webhook_routes import webhook_bp
+            from app.api.media_routes import media_bp
         except ImportError as e:
             logging.error(f"导入蓝图模块失败: {str(e)}")
             logging.error("请确保app/api目录下的所有蓝图文件存在")
@@ -123,12 +128,37 @@ def create_app():
         app.register_blueprint(message_ops_bp, url_prefix='/api/message')
         app.register_blueprint(moments_bp, url_prefix='/api/moments')
         app.register_blueprint(auxiliary_bp, url_prefix='/api/auxiliary')
+        app.register_blueprint(job_bp, url_prefix='/api/jobs')
+        app.register_blueprint(schedule_bp, url_prefix='/api/schedule')
+        app.register_blueprint(stream_bp, url_prefix='/api/stream')
+        app.register_blueprint(webhook_bp, url_prefix='/api/webhooks')
+        app.register_blueprint(media_bp, url_prefix='/api/media')
         logging.info("蓝图注册成功")
     except Exception as e:
         logging.error(f"注册蓝图时出错: {str(e)}")
         logging.error("无法继续创建Flask应用")
         raise
 
+    # 将请求头中的截止时间传递给请求队列，调用方已放弃等待的任务不再执行
+    @app.before_request
+    def bind_queue_context():
+        from flask import request
+        from app.api_queue import set_request_context
+        import time
+
+        deadline = None
+        timeout = request.headers.get('X-Request-Timeout', type=float)
+        if timeout and timeout > 0:
+            deadline = time.time() + timeout
+        # 请求头X-Queue-Lane可为单个请求指定优先级通道
+        lane = request.headers.get('X-Queue-Lane')
+        set_request_context(deadline=deadline, lane=lane.strip().lower() if lane else None)
+
+    @app.teardown_request
+    def clear_queue_context(exception=None):
+        from app.api_queue import clear_request_context
+        clear_request_context()
+
     # 添加健康检查路由
     @app.route('/health')
     def health_check():
@@ -0,0 +1,97 @@
+"""
+自适应轮询间隔
+有活动（取到新消息、连接状态变化）后立即回到最短间隔，之后每次无活动的轮询将间隔乘以退避系数，
+直到最长间隔。队列中有发送任务等待时推迟轮询，把UI自动化执行线程让给发送任务
+"""
+
+import threading
+import time
+from collections import deque
+
+# 让出执行线程时每次推迟的时间（秒）
+YIELD_SLICE = 0.2
+
+# 统计有效轮询频率的时间窗口（秒）
+RATE_WINDOW = 60
+
+# 需要优先于轮询执行的通道
+FOREGROUND_LANES = ('interactive', 'bulk')
+
+def sends_pending():
+    """队列中是否有发送任务等待执行"""
+    # 延迟导入，避免与队列模块循环导入
+    from app.api_queue import request_queue
+    return any(request_queue.qsize(lane) for lane in FOREGROUND_LANES)
+
+class AdaptiveInterval:
+    """根据活动情况在[floor, ceiling]之间调整的轮询间隔"""
+
+    def __init__(self, floor, ceiling, backoff=2.0, max_yield=None):
+        self.floor = max(float(floor), 0.01)
+        self.ceiling = max(float(ceiling), self.floor)
+        self.backoff = max(float(backoff), 1.0)
+        # 最多连续推迟的时间，避免持续的发送任务让轮询永远无法执行
+        self.max_yield = self.ceiling if max_yield is None else max_yield
+        self.current = self.floor
+        self._polls = deque()
+        self._lock = threading.Lock()
+        self.activity_count = 0
+        self.yields = 0
+        self.yield_time = 0.0
+
+    def activity(self):
+        """有活动，下次轮询使用最短间隔"""
+        self.current = self.floor
+        self.activity_count += 1
+
+    def idle(self):
+        """没有活动，间隔按退避系数增大"""
+        self.current = min(self.current * self.backoff, self.ceiling)
+
+    def record_poll(self, now=None):
+        now = now or time.time()
+        with self._lock:
+            self._polls.append(now)
+            while self._polls and now - self._polls[0] > RATE_WINDOW:
+                self._polls.popleft()
+
+    def wait(self, stop_event=None):
+        """
+        等待当前间隔，之后若有发送任务等待则继续推迟，最多推迟max_yield秒
+
+        Args:
+            stop_event: 设置后立即结束等待（如服务停止或有请求唤醒）
+        """
+        if stop_event is not None:
+            if stop_event.wait(self.current):
+                return
+        else:
+            time.sleep(self.current)
+
+        started = time.time()
+        yielded = False
+        while sends_pending() and time.time() - started < self.max_yield:
+            yielded = True
+            if stop_event is not None:
+                if stop_event.wait(YIELD_SLICE):
+                    break
+            else:
+                time.sleep(YIELD_SLICE)
+        if yielded:
+            self.yields += 1
+            self.yield_time += time.time() - started
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            recent = sum(1 for t in self._polls if now - t <= RATE_WINDOW)
+        return {
+            'interval': round(self.current, 3),
+            'floor': self.floor,
+            'ceiling': self.ceiling,
+            'backoff': self.backoff,
+            'polls_per_minute': recent * 60 / RATE_WINDOW,
+            'activity': self.activity_count,
+            'yields': self.yields,
+            'yield_time': round(self.yield_time, 3)
+        }
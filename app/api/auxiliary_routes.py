@@ -5,6 +5,7 @@
 
 from flask import Blueprint, jsonify, request
 from app.auth import require_api_key
+from app.api_queue import run_in_executor
 from app.unified_logger import logger
 from app.wechat import wechat_manager
 from app.utils.wechat_path_detector import get_best_wechat_path, validate_wechat_path
@@ -53,7 +54,7 @@ def click_session():
             }), 404
 
         # 点击会话
-        target_session.click()
+        run_in_executor(target_session.click)
 
         return jsonify({
             'code': 0,
@@ -5,8 +5,15 @@
 
 from flask import Blueprint, jsonify, request
 from app.auth import require_api_key
+from app.idempotency import idempotent
+from app.message_model import serialize_message, serialize_messages
+from app.message_index import message_index
+from app.media_pipeline import media_pipeline
+from app.message_delta import compute_delta, parse_cursor as parse_delta_cursor
+from app.message_store import message_store, parse_time, STORE_MAX_LIMIT
 from app.unified_logger import logger
 from app.wechat import wechat_manager
+from app.api.routes import next_new_messages_response
 import time
 
 chat_bp = Blueprint('chat', __name__)
@@ -111,6 +118,8 @@ def load_more_messages():
                 wx_instance._handle_chat_window_method(chat_wnd, 'LoadMoreMessage')
             else:
                 chat_wnd.LoadMoreMessage()
+        # 窗口中的消息列表已变化，之前索引的消息对象不再可信
+        message_index.invalidate(who)
 
         return jsonify({
             'code': 0,
@@ -128,7 +137,14 @@ def load_more_messages():
 @chat_bp.route('/get-all-messages', methods=['GET'])
 @require_api_key
 def get_all_messages():
-    """获取当前聊天窗口的所有消息"""
+    """
+    获取当前聊天窗口的所有消息
+
+    查询参数：
+        who: 聊天对象名称
+        since: 上一次返回的cursor，只返回其后的新消息
+        limit: 最多返回的消息数量，剩余消息通过返回的cursor继续获取
+    """
     wx_instance = wechat_manager.get_instance()
     if not wx_instance:
         return jsonify({
@@ -146,6 +162,19 @@ def get_all_messages():
             'data': None
         }), 400
 
+    since = request.args.get('since')
+    limit = request.args.get('limit', type=int)
+    try:
+        since = parse_delta_cursor(since) if since else None
+        if limit is not None and limit <= 0:
+            raise ValueError('limit必须为正整数')
+    except ValueError as e:
+        return jsonify({
+            'code': 1002,
+            'message': str(e),
+            'data': None
+        }), 400
+
     try:
         # 获取聊天窗口
         listen = wx_instance.listen
@@ -169,26 +198,24 @@ def get_all_messages():
             else:
                 messages = chat_wnd.GetAllMessage()
 
-        # 格式化消息
-        formatted_messages = []
-        for msg in messages:
-            formatted_msg = {
-                'type': getattr(msg, 'type', 'unknown'),
-                'content': getattr(msg, 'content', ''),
-                'sender': getattr(msg, 'sender', ''),
-                'id': getattr(msg, 'id', ''),
-                'mtype': getattr(msg, 'mtype', None),
-                'sender_remark': getattr(msg, 'sender_remark', None),
-                'file_path': getattr(msg, 'file_path', None)
-            }
-            formatted_messages.append(formatted_msg)
+        # 只序列化cursor之后的消息
+        messages = list(messages or [])
+        message_index.refresh(who, chat_wnd, messages)
+        start, end, cursor, has_more, reset = compute_delta(messages, since, limit)
+        if reset:
+            logger.info(f"聊天窗口 {who} 的消息已变化，找不到since位置，从头返回")
+        formatted_messages = [media_pipeline.attach(message) for message in serialize_messages(messages[start:end])]
+        message_store.add_many(who, formatted_messages, 'history')
 
         return jsonify({
             'code': 0,
             'message': '获取消息成功',
             'data': {
                 'who': who,
-                'messages': formatted_messages
+                'messages': formatted_messages,
+                'cursor': cursor,
+                'has_more': has_more,
+                'reset': reset
             }
         })
     except Exception as e:
@@ -199,6 +226,81 @@ def get_all_messages():
             'data': None
         }), 500
 
+@chat_bp.route('/history', methods=['GET'])
+@require_api_key
+def get_history():
+    """
+    从消息存储中查询历史消息，不访问微信窗口
+
+    查询参数：
+        who: 聊天对象名称
+        sender: 发送者，who和sender至少提供一个
+        id: 消息ID
+        since/until: 接收时间范围[since, until)，Unix时间戳或'YYYY-MM-DD HH:MM:SS'
+        limit: 每页消息数量，默认100
+        cursor: 上一页返回的next_cursor
+        order: desc（从新到旧，默认）或asc
+    """
+    if not message_store.enabled:
+        return jsonify({
+            'code': 3001,
+            'message': '消息存储未启用',
+            'data': None
+        }), 400
+
+    who = request.args.get('who')
+    sender = request.args.get('sender')
+    if not who and not sender:
+        return jsonify({
+            'code': 1002,
+            'message': '缺少必要参数: who或sender',
+            'data': None
+        }), 400
+
+    order = request.args.get('order', 'desc')
+    limit = request.args.get('limit', 100, type=int)
+    cursor = request.args.get('cursor')
+    try:
+        if order not in ('asc', 'desc'):
+            raise ValueError('order只能为asc或desc')
+        if limit is None or not 1 <= limit <= STORE_MAX_LIMIT:
+            raise ValueError(f'limit需在1到{STORE_MAX_LIMIT}之间')
+        since = request.args.get('since')
+        since = parse_time(since) if since else None
+        until = request.args.get('until')
+        until = parse_time(until) if until else None
+        if cursor:
+            cursor = message_store.parse_cursor(cursor)
+            if cursor is None:
+                raise ValueError('无效的cursor')
+    except ValueError as e:
+        return jsonify({
+            'code': 1002,
+            'message': str(e),
+            'data': None
+        }), 400
+
+    try:
+        messages, next_cursor = message_store.query(
+            chat=who or None, sender=sender or None, since=since, until=until,
+            msg_id=request.args.get('id') or None, limit=limit, cursor=cursor, order=order
+        )
+        return jsonify({
+            'code': 0,
+            'message': '获取成功',
+            'data': {
+                'messages': messages,
+                'next_cursor': next_cursor
+            }
+        })
+    except Exception as e:
+        logger.error(f"查询历史消息失败: {str(e)}")
+        return jsonify({
+            'code': 3001,
+            'message': f'查询历史消息失败: {str(e)}',
+            'data': None
+        }), 500
+
 @chat_bp.route('/close', methods=['POST'])
 @require_api_key
 def close_chat_window():
@@ -489,18 +591,7 @@ def get_top_message():
         # 获取置顶消息
         top_message = chat_wnd.GetTopMessage()
 
-        # 格式化置顶消息
-        formatted_message = None
-        if top_message:
-            formatted_message = {
-                'type': getattr(top_message, 'type', 'unknown'),
-                'content': getattr(top_message, 'content', ''),
-                'sender': getattr(top_message, 'sender', ''),
-                'id': getattr(top_message, 'id', ''),
-                'mtype': getattr(top_message, 'mtype', None),
-                'sender_remark': getattr(top_message, 'sender_remark', None),
-                'file_path': getattr(top_message, 'file_path', None)
-            }
+        formatted_message = serialize_message(top_message) if top_message else None
 
         return jsonify({
             'code': 0,
@@ -520,6 +611,7 @@ def get_top_message():
 
 @chat_bp.route('/send-message', methods=['POST'])
 @require_api_key
+@idempotent
 def send_message():
     """发送消息"""
     wx_instance = wechat_manager.get_instance()
@@ -574,6 +666,7 @@ def send_message():
 
 @chat_bp.route('/send-file', methods=['POST'])
 @require_api_key
+@idempotent
 def send_file():
     """发送文件"""
     wx_instance = wechat_manager.get_instance()
@@ -643,294 +736,8 @@ def send_file():
 @chat_bp.route('/get-next-new', methods=['GET'])
 @require_api_key
 def get_next_new():
-    """获取下一条新消息"""
-    wx_instance = wechat_manager.get_instance()
-    if not wx_instance:
-        return jsonify({
-            'code': 2001,
-            'message': '微信未初始化',
-            'data': None
-        }), 400
-
-    try:
-        # 使用与成功API完全相同的实现方式
-        # 获取参数（使用默认值）
-        savepic = False
-        savevideo = False
-        savefile = False
-        savevoice = False
-        parseurl = False
-
-        # 获取当前使用的库
-        lib_name = wx_instance.get_lib_name() if hasattr(wx_instance, 'get_lib_name') else 'wxauto'
-
-        # 根据不同的库构建不同的参数
-        if lib_name == 'wxautox':
-            # wxautox的GetNextNewMessage只支持filter_mute参数
-            params = {
-                'filter_mute': False  # 默认不过滤免打扰消息
-            }
-        else:
-            # wxauto的GetNextNewMessage可能不支持任何参数，使用空参数
-            params = {}
-
-        # 调用GetNextNewMessage方法
-        try:
-            messages = wx_instance.GetNextNewMessage(**params)
-        except Exception as e:
-            logger.error(f"获取新消息失败: {str(e)}")
-            # 如果出现异常，返回空字典表示没有新消息
-            messages = {}
-
-        # 处理返回的消息（与成功API完全相同的处理方式）
-        if not messages:
-            return jsonify({
-                'code': 0,
-                'message': '没有新消息',
-                'data': {'messages': {}}
-            })
-
-        # 辅助函数：清理群名中的人数信息
-        def clean_group_name(name):
-            # 匹配群名后面的 (数字) 模式
-            import re
-            return re.sub(r'\s*\(\d+\)$', '', name)
-
-        # 格式化消息 - 处理不同库的返回格式
-        formatted_messages = {}
-
-        if lib_name == "wxautox":
-            # wxautox返回格式: {'chat_name': 'name', 'chat_type': 'type', 'msg': [messages]}
-            if isinstance(messages, dict) and 'chat_name' in messages and 'msg' in messages:
-                chat_name = messages.get('chat_name', 'Unknown')
-                msg_list = messages.get('msg', [])
-
-                # 清理群名中的人数信息
-                clean_name = clean_group_name(chat_name)
-                formatted_messages[clean_name] = []
-
-                for msg in msg_list:
-                    try:
-                        # 检查msg是否是对象
-                        if hasattr(msg, 'type'):
-                            # 检查消息类型
-                            if hasattr(msg, 'type') and getattr(msg, 'type', '') in ['image', 'file', 'video', 'voice']:
-                                # 检查文件是否存在且大小大于0
-                                if hasattr(msg, 'file_path') and getattr(msg, 'file_path', ''):
-                                    try:
-                                        import os
-                                        file_path = getattr(msg, 'file_path', '')
-                                        if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
-                                            logger.warning(f"文件不存在或大小为0: {file_path}")
-                                    except Exception as e:
-                                        logger.error(f"检查文件失败: {str(e)}")
-
-                            formatted_messages[clean_name].append({
-                                'type': getattr(msg, 'type', 'unknown'),
-                                'content': getattr(msg, 'content', str(msg)),
-                                'sender': getattr(msg, 'sender', ''),
-                                'id': getattr(msg, 'id', ''),
-                                'mtype': getattr(msg, 'mtype', None),
-                                'sender_remark': getattr(msg, 'sender_remark', None),
-                                'file_path': getattr(msg, 'file_path', None)
-                            })
-                        else:
-                            # 如果msg是字符串或其他类型，转换为文本消息
-                            formatted_messages[clean_name].append({
-                                'type': 'text',
-                                'content': str(msg),
-                                'sender': '',
-                                'id': '',
-                                'mtype': None,
-                                'sender_remark': None,
-                                'file_path': None
-                            })
-                    except Exception as e:
-                        logger.error(f"处理消息时出错: {str(e)}")
-                        # 添加错误消息
-                        formatted_messages[clean_name].append({
-                            'type': 'error',
-                            'content': f'消息处理错误: {str(e)}',
-                            'sender': '',
-                            'id': '',
-                            'mtype': None,
-                            'sender_remark': None,
-                            'file_path': None
-                        })
-        else:
-            # wxauto库的处理方式 - 根据日志分析，wxauto实际返回字典格式，不是列表格式
-            if isinstance(messages, dict):
-                # wxauto返回字典格式: {'chat_name': '消息测试', 'chat_type': 'group', 'msg': [...]}
-                if 'msg' in messages and isinstance(messages['msg'], list):
-                    # 使用正确的chat_name，而不是硬编码的"新消息"
-                    chat_name = messages.get('chat_name', '未知聊天')
-                    clean_name = clean_group_name(chat_name)
-                    formatted_messages = {clean_name: []}
-
-                    for msg in messages['msg']:
-                        try:
-                            # 检查msg是否已经是字典格式（适配器已转换）
-                            if isinstance(msg, dict):
-                                # 已经是字典格式，直接使用
-                                msg_data = msg
-                            elif hasattr(msg, 'type'):
-                                # 原始消息对象，需要转换
-                                msg_data = {
-                                    'type': getattr(msg, 'type', 'unknown'),
-                                    'content': getattr(msg, 'content', str(msg)),
-                                    'sender': getattr(msg, 'sender', ''),
-                                    'time': getattr(msg, 'time', ''),
-                                    'id': getattr(msg, 'id', ''),
-                                    'mtype': getattr(msg, 'mtype', None),
-                                    'sender_remark': getattr(msg, 'sender_remark', None),
-                                    'file_path': getattr(msg, 'file_path', None)
-                                }
-                            else:
-                                # 其他类型，转换为文本消息
-                                msg_data = {
-                                    'type': 'text',
-                                    'content': str(msg),
-                                    'sender': '',
-                                    'time': '',
-                                    'id': '',
-                                    'mtype': None,
-                                    'sender_remark': None,
-                                    'file_path': None
-                                }
-
-                            formatted_messages[clean_name].append(msg_data)
-                        except Exception as e:
-                            logger.error(f"处理wxauto消息时出错: {str(e)}")
-                            # 添加错误消息
-                            formatted_messages[clean_name].append({
-                                'type': 'error',
-                                'content': f'消息处理错误: {str(e)}',
-                                'sender': '',
-                                'time': '',
-                                'id': '',
-                                'mtype': None,
-                                'sender_remark': None,
-                                'file_path': None
-                            })
-                else:
-                    # 可能是其他字典格式: {chat_name: [messages]}
-                    formatted_messages = {}
-                    for chat_name, msg_list in messages.items():
-                        if isinstance(msg_list, list):
-                            # 清理群名中的人数信息
-                            clean_name = clean_group_name(chat_name)
-                            formatted_messages[clean_name] = []
-
-                            for msg in msg_list:
-                                try:
-                                    # 处理消息对象
-                                    if hasattr(msg, 'type'):
-                                        msg_data = {
-                                            'type': getattr(msg, 'type', 'unknown'),
-                                            'content': getattr(msg, 'content', str(msg)),
-                                            'sender': getattr(msg, 'sender', ''),
-                                            'time': getattr(msg, 'time', ''),
-                                            'id': getattr(msg, 'id', ''),
-                                            'mtype': getattr(msg, 'mtype', None),
-                                            'sender_remark': getattr(msg, 'sender_remark', None),
-                                            'file_path': getattr(msg, 'file_path', None)
-                                        }
-                                    else:
-                                        msg_data = {
-                                            'type': 'text',
-                                            'content': str(msg),
-                                            'sender': '',
-                                            'time': '',
-                                            'id': '',
-                                            'mtype': None,
-                                            'sender_remark': None,
-                                            'file_path': None
-                                        }
-                                    formatted_messages[clean_name].append(msg_data)
-                                except Exception as e:
-                                    logger.error(f"处理wxauto消息时出错: {str(e)}")
-                                    # 添加错误消息
-                                    formatted_messages[clean_name].append({
-                                        'type': 'error',
-                                        'content': f'消息处理错误: {str(e)}',
-                                        'sender': '',
-                                        'time': '',
-                                        'id': '',
-                                        'mtype': None,
-                                        'sender_remark': None,
-                                        'file_path': None
-                                    })
-                        else:
-                            # 如果不是列表，直接使用原值
-                            formatted_messages[chat_name] = msg_list
-            elif isinstance(messages, list):
-                # 如果wxauto确实返回列表格式（向后兼容）
-                formatted_messages = {"新消息": []}
-
-                for msg in messages:
-                    try:
-                        # 检查msg是否已经是字典格式（适配器已转换）
-                        if isinstance(msg, dict):
-                            # 已经是字典格式，直接使用
-                            msg_data = msg
-                        elif hasattr(msg, 'type'):
-                            # 原始消息对象，需要转换
-                            msg_data = {
-                                'type': getattr(msg, 'type', 'unknown'),
-                                'content': getattr(msg, 'content', str(msg)),
-                                'sender': getattr(msg, 'sender', ''),
-                                'time': getattr(msg, 'time', ''),
-                                'id': getattr(msg, 'id', ''),
-                                'mtype': getattr(msg, 'mtype', None),
-                                'sender_remark': getattr(msg, 'sender_remark', None),
-                                'file_path': getattr(msg, 'file_path', None)
-                            }
-                        else:
-                            # 其他类型，转换为文本消息
-                            msg_data = {
-                                'type': 'text',
-                                'content': str(msg),
-                                'sender': '',
-                                'time': '',
-                                'id': '',
-                                'mtype': None,
-                                'sender_remark': None,
-                                'file_path': None
-                            }
-
-                        formatted_messages["新消息"].append(msg_data)
-                    except Exception as e:
-                        logger.error(f"处理wxauto消息时出错: {str(e)}")
-                        # 添加错误消息
-                        formatted_messages["新消息"].append({
-                            'type': 'error',
-                            'content': f'消息处理错误: {str(e)}',
-                            'sender': '',
-                            'time': '',
-                            'id': '',
-                            'mtype': None,
-                            'sender_remark': None,
-                            'file_path': None
-                        })
-            else:
-                # 其他情况，转换为字符串
-                formatted_messages = {"消息": [{"type": "text", "content": str(messages)}]}
-
-        return jsonify({
-            'code': 0,
-            'message': '获取成功',
-            'data': {
-                'messages': formatted_messages
-            }
-        })
-
-    except Exception as e:
-        logger.error(f"获取新消息失败: {str(e)}")
-        return jsonify({
-            'code': 3001,
-            'message': f'获取新消息失败: {str(e)}',
-            'data': None
-        }), 500
+    """获取下一条新消息，与 /api/message/get-next-new 共用同一读取逻辑"""
+    return next_new_messages_response()
 
 # 删除重复的监听路由 - 统一使用 /api/message/listen/* 路径
 
@@ -0,0 +1,74 @@
+"""
+异步任务相关API路由
+查询通过异步模式提交的队列任务的执行状态
+"""
+
+from flask import Blueprint, jsonify, request
+from app.auth import require_api_key
+from app.api_queue import get_job, job_to_dict, cancel_task
+
+job_bp = Blueprint('jobs', __name__)
+
+# 长轮询最长等待时间（秒）
+MAX_JOB_WAIT = 30
+
+def _get_own_job(job_id):
+    """获取由当前API密钥提交的异步任务"""
+    task = get_job(job_id)
+    if not task or task['tenant'] != request.headers.get('X-API-Key'):
+        return None
+    return task
+
+@job_bp.route('/<job_id>', methods=['GET'])
+@require_api_key
+def get_job_status(job_id):
+    """获取异步任务状态，可通过wait参数长轮询等待任务完成"""
+    task = _get_own_job(job_id)
+    if not task:
+        return jsonify({
+            'code': 1004,
+            'message': f'任务不存在或已过期: {job_id}',
+            'data': None
+        }), 404
+
+    wait = request.args.get('wait', 0, type=float)
+    if wait and wait > 0:
+        task['done'].wait(min(wait, MAX_JOB_WAIT))
+
+    return jsonify({
+        'code': 0,
+        'message': '获取成功',
+        'data': job_to_dict(task)
+    })
+
+@job_bp.route('/<job_id>/cancel', methods=['POST'])
+@require_api_key
+def cancel_job(job_id):
+    """取消仍在排队的异步任务"""
+    task = _get_own_job(job_id)
+    if not task:
+        return jsonify({
+            'code': 1004,
+            'message': f'任务不存在或已过期: {job_id}',
+            'data': None
+        }), 404
+
+    if cancel_task(task, '任务已被客户端取消'):
+        return jsonify({
+            'code': 0,
+            'message': '任务已取消',
+            'data': job_to_dict(task)
+        })
+
+    if task['status'] == 'running':
+        return jsonify({
+            'code': 1005,
+            'message': '任务正在执行，无法取消',
+            'data': job_to_dict(task)
+        }), 409
+
+    return jsonify({
+        'code': 0,
+        'message': '任务已结束，无需取消',
+        'data': job_to_dict(task)
+    })
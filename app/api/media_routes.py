@@ -0,0 +1,69 @@
+"""
+媒体文件相关API路由
+查询媒体文件的处理状态，获取按内容哈希保存的文件
+"""
+
+from flask import Blueprint, jsonify, request, send_file
+from app.auth import require_api_key
+from app.media_pipeline import media_pipeline
+
+media_bp = Blueprint('media', __name__)
+
+# 查询状态时最多等待的时间（秒）
+MEDIA_MAX_WAIT = 60
+
+def _not_found(media_id):
+    return jsonify({
+        'code': 3001,
+        'message': f'媒体文件不存在: {media_id}',
+        'data': None
+    }), 404
+
+@media_bp.route('/stats', methods=['GET'])
+@require_api_key
+def media_stats():
+    """媒体文件处理统计"""
+    return jsonify({
+        'code': 0,
+        'message': '获取成功',
+        'data': media_pipeline.stats()
+    })
+
+@media_bp.route('/<media_id>', methods=['GET'])
+@require_api_key
+def get_media(media_id):
+    """
+    查询媒体文件状态
+
+    查询参数：
+        wait: 尚未处理完成时最多等待的秒数，默认0立即返回
+    """
+    record = media_pipeline.get(media_id)
+    if record is None:
+        return _not_found(media_id)
+
+    wait = request.args.get('wait', 0, type=float) or 0
+    if wait > 0:
+        media_pipeline.wait(record, min(wait, MEDIA_MAX_WAIT))
+
+    return jsonify({
+        'code': 0,
+        'message': '获取成功',
+        'data': record.to_dict()
+    })
+
+@media_bp.route('/<media_id>/content', methods=['GET'])
+@require_api_key
+def get_media_content(media_id):
+    """下载已保存的媒体文件"""
+    record = media_pipeline.get(media_id)
+    if record is None:
+        return _not_found(media_id)
+    if record.status != 'ready':
+        return jsonify({
+            'code': 3001,
+            'message': f'媒体文件尚未就绪，当前状态: {record.status}',
+            'data': record.to_dict()
+        }), 409
+
+    return send_file(record.path, as_attachment=True, download_name=record.name)
@@ -5,6 +5,10 @@
 
 from flask import Blueprint, jsonify, request
 from app.auth import require_api_key
+from app.api_queue import run_in_executor
+from app.api.media_routes import MEDIA_MAX_WAIT
+from app.media_pipeline import media_pipeline
+from app.message_index import message_index
 from app.unified_logger import logger
 from app.wechat import wechat_manager
 
@@ -45,13 +49,8 @@ def click_message():
 
         chat_wnd = listen[who]
 
-        # 获取消息
-        messages = chat_wnd.GetAllMessage()
-        target_message = None
-        for msg in messages:
-            if getattr(msg, 'id', '') == message_id:
-                target_message = msg
-                break
+        # 通过消息ID索引查找消息，未命中时才抓取整个窗口
+        target_message = message_index.resolve(who, chat_wnd, message_id)
 
         if not target_message:
             return jsonify({
@@ -61,7 +60,7 @@ def click_message():
             }), 404
 
         # 点击消息
-        target_message.click()
+        run_in_executor(target_message.click)
 
         return jsonify({
             'code': 0,
@@ -72,6 +71,8 @@ def click_message():
             }
         })
     except Exception as e:
+        # 消息对象可能已随窗口刷新失效，下次操作时重新抓取
+        message_index.invalidate(who)
         logger.error(f"点击消息失败: {str(e)}")
         return jsonify({
             'code': 3001,
@@ -115,13 +116,8 @@ def quote_message():
 
         chat_wnd = listen[who]
 
-        # 获取消息
-        messages = chat_wnd.GetAllMessage()
-        target_message = None
-        for msg in messages:
-            if getattr(msg, 'id', '') == message_id:
-                target_message = msg
-                break
+        # 通过消息ID索引查找消息，未命中时才抓取整个窗口
+        target_message = message_index.resolve(who, chat_wnd, message_id)
 
         if not target_message:
             return jsonify({
@@ -131,7 +127,7 @@ def quote_message():
             }), 404
 
         # 引用回复
-        target_message.quote(reply_text)
+        run_in_executor(target_message.quote, (reply_text,))
 
         return jsonify({
             'code': 0,
@@ -143,6 +139,8 @@ def quote_message():
             }
         })
     except Exception as e:
+        # 消息对象可能已随窗口刷新失效，下次操作时重新抓取
+        message_index.invalidate(who)
         logger.error(f"引用回复失败: {str(e)}")
         return jsonify({
             'code': 3001,
@@ -186,13 +184,8 @@ def forward_message():
 
         chat_wnd = listen[who]
 
-        # 获取消息
-        messages = chat_wnd.GetAllMessage()
-        target_message = None
-        for msg in messages:
-            if getattr(msg, 'id', '') == message_id:
-                target_message = msg
-                break
+        # 通过消息ID索引查找消息，未命中时才抓取整个窗口
+        target_message = message_index.resolve(who, chat_wnd, message_id)
 
         if not target_message:
             return jsonify({
@@ -202,7 +195,7 @@ def forward_message():
             }), 404
 
         # 转发消息
-        target_message.forward(to_friends)
+        run_in_executor(target_message.forward, (to_friends,))
 
         return jsonify({
             'code': 0,
@@ -214,6 +207,8 @@ def forward_message():
             }
         })
     except Exception as e:
+        # 消息对象可能已随窗口刷新失效，下次操作时重新抓取
+        message_index.invalidate(who)
         logger.error(f"转发消息失败: {str(e)}")
         return jsonify({
             'code': 3001,
@@ -265,13 +260,8 @@ def tickle_message():
 
         chat_wnd = listen[who]
 
-        # 获取消息
-        messages = chat_wnd.GetAllMessage()
-        target_message = None
-        for msg in messages:
-            if getattr(msg, 'id', '') == message_id:
-                target_message = msg
-                break
+        # 通过消息ID索引查找消息，未命中时才抓取整个窗口
+        target_message = message_index.resolve(who, chat_wnd, message_id)
 
         if not target_message:
             return jsonify({
@@ -281,7 +271,7 @@ def tickle_message():
             }), 404
 
         # 拍一拍
-        target_message.tickle()
+        run_in_executor(target_message.tickle)
 
         return jsonify({
             'code': 0,
@@ -292,6 +282,8 @@ def tickle_message():
             }
         })
     except Exception as e:
+        # 消息对象可能已随窗口刷新失效，下次操作时重新抓取
+        message_index.invalidate(who)
         logger.error(f"拍一拍失败: {str(e)}")
         return jsonify({
             'code': 3001,
@@ -343,13 +335,8 @@ def delete_message():
 
         chat_wnd = listen[who]
 
-        # 获取消息
-        messages = chat_wnd.GetAllMessage()
-        target_message = None
-        for msg in messages:
-            if getattr(msg, 'id', '') == message_id:
-                target_message = msg
-                break
+        # 通过消息ID索引查找消息，未命中时才抓取整个窗口
+        target_message = message_index.resolve(who, chat_wnd, message_id)
 
         if not target_message:
             return jsonify({
@@ -359,7 +346,8 @@ def delete_message():
             }), 404
 
         # 删除消息
-        target_message.delete()
+        run_in_executor(target_message.delete)
+        message_index.discard(who, message_id)
 
         return jsonify({
             'code': 0,
@@ -370,6 +358,8 @@ def delete_message():
             }
         })
     except Exception as e:
+        # 消息对象可能已随窗口刷新失效，下次操作时重新抓取
+        message_index.invalidate(who)
         logger.error(f"删除消息失败: {str(e)}")
         return jsonify({
             'code': 3001,
@@ -393,6 +383,10 @@ def download_message():
     who = data.get('who')
     message_id = data.get('message_id')
     save_path = data.get('save_path')
+    try:
+        wait = float(data.get('wait') or 0)
+    except (TypeError, ValueError):
+        wait = 0
 
     if not who or not message_id:
         return jsonify({
@@ -413,13 +407,8 @@ def download_message():
 
         chat_wnd = listen[who]
 
-        # 获取消息
-        messages = chat_wnd.GetAllMessage()
-        target_message = None
-        for msg in messages:
-            if getattr(msg, 'id', '') == message_id:
-                target_message = msg
-                break
+        # 通过消息ID索引查找消息，未命中时才抓取整个窗口
+        target_message = message_index.resolve(who, chat_wnd, message_id)
 
         if not target_message:
             return jsonify({
@@ -428,23 +417,34 @@ def download_message():
                 'data': None
             }), 404
 
-        # 下载文件
-        if save_path:
-            result = target_message.download(save_path)
-        else:
-            result = target_message.download()
+        # 下载交给媒体处理流水线在后台执行，默认立即返回媒体ID，可通过 /api/media/<media_id> 查询状态
+        record = media_pipeline.download(who, message_id, target_message, save_path)
+        if wait > 0:
+            media_pipeline.wait(record, min(wait, MEDIA_MAX_WAIT))
+
+        media = record.to_dict()
+        if record.status == 'failed':
+            return jsonify({
+                'code': 3003,
+                'message': f'下载失败: {record.error}',
+                'data': media
+            }), 500
 
+        ready = record.status == 'ready'
         return jsonify({
             'code': 0,
-            'message': '下载成功',
+            'message': '下载成功' if ready else '已加入下载队列',
             'data': {
                 'who': who,
                 'message_id': message_id,
                 'save_path': save_path,
-                'result': str(result) if result else None
+                'result': record.path if ready else None,
+                **media
             }
         })
     except Exception as e:
+        # 消息对象可能已随窗口刷新失效，下次操作时重新抓取
+        message_index.invalidate(who)
         logger.error(f"下载失败: {str(e)}")
         return jsonify({
             'code': 3001,
@@ -487,13 +487,8 @@ def voice_to_text():
 
         chat_wnd = listen[who]
 
-        # 获取消息
-        messages = chat_wnd.GetAllMessage()
-        target_message = None
-        for msg in messages:
-            if getattr(msg, 'id', '') == message_id:
-                target_message = msg
-                break
+        # 通过消息ID索引查找消息，未命中时才抓取整个窗口
+        target_message = message_index.resolve(who, chat_wnd, message_id)
 
         if not target_message:
             return jsonify({
@@ -512,7 +507,7 @@ def voice_to_text():
             }), 400
 
         # 语音转文字
-        text_result = target_message.to_text()
+        text_result = run_in_executor(target_message.to_text)
 
         return jsonify({
             'code': 0,
@@ -524,6 +519,8 @@ def voice_to_text():
             }
         })
     except Exception as e:
+        # 消息对象可能已随窗口刷新失效，下次操作时重新抓取
+        message_index.invalidate(who)
         logger.error(f"语音转文字失败: {str(e)}")
         return jsonify({
             'code': 3001,
@@ -567,13 +564,8 @@ def select_message_option():
 
         chat_wnd = listen[who]
 
-        # 获取消息
-        messages = chat_wnd.GetAllMessage()
-        target_message = None
-        for msg in messages:
-            if getattr(msg, 'id', '') == message_id:
-                target_message = msg
-                break
+        # 通过消息ID索引查找消息，未命中时才抓取整个窗口
+        target_message = message_index.resolve(who, chat_wnd, message_id)
 
         if not target_message:
             return jsonify({
@@ -583,7 +575,7 @@ def select_message_option():
             }), 404
 
         # 执行右键菜单操作
-        result = target_message.select_option(option)
+        result = run_in_executor(target_message.select_option, (option,))
 
         return jsonify({
             'code': 0,
@@ -596,6 +588,8 @@ def select_message_option():
             }
         })
     except Exception as e:
+        # 消息对象可能已随窗口刷新失效，下次操作时重新抓取
+        message_index.invalidate(who)
         logger.error(f"右键菜单操作失败: {str(e)}")
         return jsonify({
             'code': 3001,
@@ -5,6 +5,7 @@
 
 from flask import Blueprint, jsonify, request
 from app.auth import require_api_key
+from app.api_queue import run_in_executor
 from app.unified_logger import logger
 from app.wechat import wechat_manager
 
@@ -247,7 +248,8 @@ def like_moment():
 
         # 获取指定索引的朋友圈对象并点赞
         moment = moments_list[moment_index]
-        result = moment.Like(like)
+        # 朋友圈条目的操作同样在UI自动化执行线程中执行
+        result = run_in_executor(moment.Like, (like,))
 
         return jsonify({
             'code': 0,
@@ -328,7 +330,7 @@ def comment_moment():
 
         # 获取指定索引的朋友圈对象并评论
         moment = moments_list[moment_index]
-        result = moment.Comment(text)
+        result = run_in_executor(moment.Comment, (text,))
 
         return jsonify({
             'code': 0,
@@ -3,9 +3,22 @@
 from app.unified_logger import logger
 from app.wechat import wechat_manager
 from app.system_monitor import get_system_resources
-from app.api_queue import queue_task, get_queue_stats
+from app.api_queue import (queue_task, get_queue_stats, is_chat_active, set_active_chat, QueueFullError,
+                           enqueue_task, wait_task, submit_job, tenant_label, run_in_executor, RetryLater)
+from app.rate_limiter import send_rate_limiter
+from app.idempotency import idempotent, attach_task, idempotency_store
+from app.message_model import serialize_message
+from app.message_hub import message_hub
+from app.message_dedup import message_dedup
+from app.message_poller import message_poller
+from app.media_pipeline import media_pipeline
+from app.message_index import message_index
+from app.message_store import message_store, parse_time, STORE_MAX_LIMIT
 from app.config import Config
+from collections import OrderedDict
+import json
 import os
+import queue
 import time
 from typing import Optional, List
 from urllib.parse import quote
@@ -13,9 +26,6 @@
 
 api_bp = Blueprint('api', __name__)
 
-# 全局消息缓存 - 用于存储回调函数接收到的消息
-_message_cache = {}
-
 # 记录程序启动时间
 start_time = time.time()
 
@@ -144,6 +154,71 @@ def get_wechat_status():
         }
     })
 
+def parse_bool(value, default=False):
+    """宽松地解析布尔值参数"""
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        value = value.lower()
+        if value in ('true', '1', 'yes', 'y', 'on'):
+            return True
+        if value in ('false', '0', 'no', 'n', 'off'):
+            return False
+    return default
+
+def wants_async(data):
+    """判断请求是否要求异步执行（请求体中的async字段或?async=true）"""
+    return parse_bool(data.get('async', request.args.get('async')))
+
+def job_accepted_response(task):
+    """异步任务已提交时的202响应"""
+    return jsonify({
+        'code': 0,
+        'message': '任务已提交',
+        'data': {
+            'job_id': task['job_id'],
+            'status': task['status'],
+            'status_url': f"/api/jobs/{task['job_id']}"
+        }
+    }), 202
+
+def queue_full_response(error):
+    """队列拒绝任务时的429响应，Retry-After告知客户端多久后重试"""
+    response = jsonify({
+        'code': 5004,
+        'message': str(error),
+        'data': {'retry_after': error.retry_after}
+    })
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 429
+
+def render_send_task(task):
+    """将发送任务的结果转换为幂等记录保存的响应，任务未执行时返回None"""
+    if task['status'] == 'cancelled':
+        return None
+    if task['status'] == 'error':
+        return {
+            'code': 3001,
+            'message': f"处理请求失败: {task['error']}",
+            'data': None
+        }, 500
+    return task['result']['response'], task['result']['status_code']
+
+def open_chat(wx_instance, receiver):
+    """
+    切换到接收人的聊天窗口
+
+    队列中连续发给同一接收人的任务复用已经打开的窗口，省去重复的ChatWith
+    """
+    if is_chat_active(receiver):
+        return receiver
+
+    chat_name = wx_instance.ChatWith(receiver)
+    set_active_chat(receiver if chat_name == receiver else None)
+    return chat_name
+
 def format_at_message(message: str, at_list: Optional[List[str]] = None) -> str:
     if not at_list:
         return message
@@ -161,6 +236,7 @@ def format_at_message(message: str, at_list: Optional[List[str]] = None) -> str:
 # 消息相关接口
 @api_bp.route('/message/send', methods=['POST'])
 @require_api_key
+@idempotent
 def send_message():
     # 在队列处理前获取所有请求数据
     try:
@@ -177,8 +253,14 @@ def send_message():
                 'data': None
             }), 400
 
-        # 将任务加入队列处理
-        result = _send_message_task(receiver, message, at_list, clear)
+        # 异步模式：立即返回任务ID，不占用请求线程等待发送结果
+        if wants_async(data):
+            return job_accepted_response(_send_message_task.submit(receiver, message, at_list, clear))
+
+        # 将任务加入队列处理，等待超时但任务已在执行时，幂等记录在任务结束后保存结果
+        task = _send_message_task.enqueue(receiver, message, at_list, clear)
+        attach_task(task, render_send_task)
+        result = wait_task(task, _send_message_task.timeout)
 
         # 处理队列任务返回的结果
         if isinstance(result, dict) and 'response' in result and 'status_code' in result:
@@ -191,6 +273,9 @@ def send_message():
             'message': '服务器内部错误',
             'data': None
         }), 500
+    except QueueFullError as e:
+        logger.warning(f"发送消息请求被拒绝: {str(e)}")
+        return queue_full_response(e)
     except Exception as e:
         logger.error(f"处理发送消息请求失败: {str(e)}")
         return jsonify({
@@ -199,7 +284,7 @@ def send_message():
             'data': None
         }), 500
 
-@queue_task(timeout=30)  # 使用队列处理请求，超时30秒
+@queue_task(timeout=30, affinity='receiver')  # 使用队列处理请求，超时30秒，同一接收人的任务尽量连续执行
 def _send_message_task(receiver, message, at_list, clear):
     """实际执行发送消息的队列任务"""
     wx_instance = wechat_manager.get_instance()
@@ -213,11 +298,17 @@ def _send_message_task(receiver, message, at_list, clear):
             'status_code': 400
         }
 
+    # 带@的消息连续发送两次，两个发送令牌都够时再发送，不够时放回暂缓队列，不在执行线程中等待
+    if at_list:
+        delay = send_rate_limiter.delay(receiver, 2)
+        if delay > 0:
+            return RetryLater(delay)
+
     try:
         formatted_message = format_at_message(message, at_list)
 
-        # 查找联系人
-        chat_name = wx_instance.ChatWith(receiver)
+        # 查找联系人（连续发给同一接收人时复用已打开的窗口）
+        chat_name = open_chat(wx_instance, receiver)
         if not chat_name:
             return {
                 'response': {
@@ -254,6 +345,7 @@ def _send_message_task(receiver, message, at_list, clear):
             'status_code': 200
         }
     except Exception as e:
+        set_active_chat(None)
         logger.error(f"发送消息失败: {str(e)}")
         return {
             'response': {
@@ -345,6 +437,7 @@ def send_typing_message():
 
 @api_bp.route('/message/send-file', methods=['POST'])
 @require_api_key
+@idempotent
 def send_file():
     # 在队列处理前获取所有请求数据
     try:
@@ -359,8 +452,14 @@ def send_file():
                 'data': None
             }), 400
 
-        # 将任务加入队列处理
-        result = _send_file_task(receiver, file_paths)
+        # 异步模式：立即返回任务ID，不占用请求线程等待发送结果
+        if wants_async(data):
+            return job_accepted_response(_send_file_task.submit(receiver, file_paths))
+
+        # 将任务加入队列处理，等待超时但任务已在执行时，幂等记录在任务结束后保存结果
+        task = _send_file_task.enqueue(receiver, file_paths)
+        attach_task(task, render_send_task)
+        result = wait_task(task, _send_file_task.timeout)
 
         # 处理队列任务返回的结果
         if isinstance(result, dict) and 'response' in result and 'status_code' in result:
@@ -373,6 +472,9 @@ def send_file():
             'message': '服务器内部错误',
             'data': None
         }), 500
+    except QueueFullError as e:
+        logger.warning(f"发送文件请求被拒绝: {str(e)}")
+        return queue_full_response(e)
     except Exception as e:
         logger.error(f"处理发送文件请求失败: {str(e)}")
         return jsonify({
@@ -381,7 +483,7 @@ def send_file():
             'data': None
         }), 500
 
-@queue_task(timeout=60)  # 使用队列处理请求，文件发送可能需要更长时间，设置60秒超时
+@queue_task(timeout=60, affinity='receiver', lane='bulk')  # 使用队列处理请求，文件发送可能需要更长时间，设置60秒超时，默认走批量通道
 def _send_file_task(receiver, file_paths):
     """实际执行发送文件的队列任务"""
     wx_instance = wechat_manager.get_instance()
@@ -399,8 +501,8 @@ def _send_file_task(receiver, file_paths):
     success_count = 0
 
     try:
-        # 查找联系人
-        chat_name = wx_instance.ChatWith(receiver)
+        # 查找联系人（连续发给同一接收人时复用已打开的窗口）
+        chat_name = open_chat(wx_instance, receiver)
         if not chat_name:
             return {
                 'response': {
@@ -451,6 +553,7 @@ def _send_file_task(receiver, file_paths):
             'status_code': 200
         }
     except Exception as e:
+        set_active_chat(None)
         logger.error(f"发送文件失败: {str(e)}")
         return {
             'response': {
@@ -461,9 +564,273 @@ def _send_file_task(receiver, file_paths):
             'status_code': 500
         }
 
+# 批量发送单次请求最多包含的条目数
+BATCH_MAX_ITEMS = 1000
+
+# 批量发送中每个条目的时间预算（秒），整批的截止时间按条目数累加
+BATCH_ITEM_TIMEOUT = 15
+
+# 同步等待结果的批量发送最多包含的条目数，超过时转为异步任务，避免请求线程长时间等待
+BATCH_SYNC_MAX_ITEMS = 8
+
+def _parse_batch_items(items):
+    """
+    校验并规范化批量发送的条目
+
+    Returns:
+        (有效条目列表, 无效条目的结果列表)
+    """
+    valid = []
+    invalid = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            item = {}
+        receiver = item.get('receiver')
+        message = item.get('message')
+        files = item.get('files') or []
+        if isinstance(files, str):
+            files = [files]
+
+        if not receiver or not (message or files):
+            invalid.append({
+                'index': index,
+                'receiver': receiver,
+                'code': 1002,
+                'message': '缺少必要参数',
+                'data': None
+            })
+            continue
+
+        valid.append({
+            'index': index,
+            'receiver': receiver,
+            'message': message,
+            'at_list': item.get('at_list', []),
+            'files': files,
+            'clear': "1" if item.get('clear', True) else "0"
+        })
+    return valid, invalid
+
+def _send_batch_item(item):
+    """在执行线程中发送单个条目，先发文字再发文件，文字发送失败时不再发送文件"""
+    result = None
+    if item['message']:
+        result = _send_message_task(item['receiver'], item['message'], item['at_list'], item['clear'])
+    if item['files'] and (result is None or result['response']['code'] == 0):
+        result = _send_file_task(item['receiver'], item['files'])
+
+    response = result['response']
+    return {
+        'index': item['index'],
+        'receiver': item['receiver'],
+        'code': response['code'],
+        'message': response['message'],
+        'data': response['data']
+    }
+
+def _batch_item_sends(item):
+    """条目需要的发送令牌数：带@的文字发送两次，文件另外发送一次"""
+    sends = 0
+    if item['message']:
+        sends += 2 if item['at_list'] else 1
+    if item['files']:
+        sends += 1
+    return sends
+
+def _send_batch_task(items, stop_at, progress=None, results=None):
+    """
+    实际执行批量发送的队列任务
+
+    条目按接收人分组（保持各接收人首次出现的顺序），同一接收人的条目连续发送，
+    每个聊天窗口只打开一次。超过截止时间后剩余条目不再发送。
+    接收人的发送令牌不足时先发送其他接收人的条目，剩余条目都在等待令牌时返回RetryLater，
+    任务放回暂缓队列，重新执行时跳过results中已完成的条目
+
+    Args:
+        items: 规范化后的条目列表
+        stop_at: 截止时间（时间戳）
+        progress: 可选的queue.Queue，每完成一个条目放入其结果，用于流式返回进度
+        results: 已完成条目的结果列表，任务重新执行时沿用同一个列表
+    """
+    if results is None:
+        results = []
+    finished = {result['index'] for result in results}
+    groups = OrderedDict()
+    for item in items:
+        if item['index'] not in finished:
+            groups.setdefault(item['receiver'], []).append(item)
+
+    retry_at = None
+    for receiver, group in groups.items():
+        for item in group:
+            now = time.time()
+            delay = send_rate_limiter.delay(receiver, _batch_item_sends(item)) if now <= stop_at else 0
+            if 0 < delay and now + delay <= stop_at:
+                # 该接收人的后续条目保持顺序一起推迟
+                retry_at = now + delay if retry_at is None else min(retry_at, now + delay)
+                break
+            if now > stop_at:
+                result = {
+                    'index': item['index'],
+                    'receiver': item['receiver'],
+                    'code': 3001,
+                    'message': '批量任务已超过截止时间，未发送',
+                    'data': None
+                }
+            elif delay > 0:
+                result = {
+                    'index': item['index'],
+                    'receiver': item['receiver'],
+                    'code': 3001,
+                    'message': '发送速率受限，截止时间前无法发送',
+                    'data': None
+                }
+            else:
+                try:
+                    result = _send_batch_item(item)
+                except Exception as e:
+                    set_active_chat(None)
+                    logger.error(f"批量发送条目失败: {str(e)}")
+                    result = {
+                        'index': item['index'],
+                        'receiver': item['receiver'],
+                        'code': 3001,
+                        'message': f'发送失败: {str(e)}',
+                        'data': None
+                    }
+            results.append(result)
+            if progress is not None:
+                progress.put(result)
+
+    if retry_at is not None:
+        return RetryLater(retry_at - time.time())
+    return results
+
+def _send_batch_job(items, invalid, stop_at, results):
+    """异步批量任务：执行后直接返回汇总结果，包含参数校验失败的条目"""
+    outcome = _send_batch_task(items, stop_at, results=results)
+    if isinstance(outcome, RetryLater):
+        return outcome
+    return _batch_summary(invalid + outcome)
+
+def _batch_summary(results):
+    """汇总批量发送的逐条结果"""
+    results = sorted(results, key=lambda result: result['index'])
+    failed_count = sum(1 for result in results if result['code'] != 0)
+    return {
+        'code': 0 if not failed_count else 3001,
+        'message': '发送完成' if not failed_count else '部分消息发送失败',
+        'data': {
+            'total': len(results),
+            'success_count': len(results) - failed_count,
+            'failed_count': failed_count,
+            'results': results
+        }
+    }
+
+def _stream_batch(task, progress, invalid):
+    """以NDJSON逐行返回批量发送进度，最后一行为汇总结果"""
+    results = list(invalid)
+    for result in invalid:
+        yield json.dumps({'type': 'item', **result}, ensure_ascii=False) + '\n'
+
+    while True:
+        try:
+            result = progress.get(timeout=1)
+        except queue.Empty:
+            if task['done'].is_set() and progress.empty():
+                break
+            continue
+        results.append(result)
+        yield json.dumps({'type': 'item', **result}, ensure_ascii=False) + '\n'
+
+    if task['status'] in ('error', 'cancelled'):
+        summary = {'code': 3001, 'message': f"批量发送失败: {task['error']}", 'data': None}
+    else:
+        summary = _batch_summary(results)
+    yield json.dumps({'type': 'summary', **summary}, ensure_ascii=False) + '\n'
+
+@api_bp.route('/message/send-batch', methods=['POST'])
+@require_api_key
+@idempotent
+def send_batch():
+    """批量发送消息和文件，整批作为一个队列任务执行"""
+    try:
+        data = request.get_json() or {}
+        items = data.get('items')
+
+        if not isinstance(items, list) or not items:
+            return jsonify({
+                'code': 1002,
+                'message': '缺少必要参数',
+                'data': None
+            }), 400
+
+        if len(items) > BATCH_MAX_ITEMS:
+            return jsonify({
+                'code': 1002,
+                'message': f'单次最多发送{BATCH_MAX_ITEMS}条',
+                'data': None
+            }), 400
+
+        valid, invalid = _parse_batch_items(items)
+        if not valid:
+            return jsonify(_batch_summary(invalid))
+
+        stop_at = time.time() + BATCH_ITEM_TIMEOUT * len(valid)
+
+        stream = parse_bool(data.get('stream', request.args.get('stream')))
+
+        # 异步模式：立即返回任务ID，任务结果为汇总结果；条目过多的同步请求同样转为异步任务
+        if wants_async(data) or (not stream and len(valid) > BATCH_SYNC_MAX_ITEMS):
+            task = submit_job(_send_batch_job, (valid, invalid, stop_at, []), lane='bulk', units=len(valid))
+            return job_accepted_response(task)
+
+        def render_batch_task(task):
+            if task['status'] == 'cancelled':
+                return None
+            if task['status'] == 'error':
+                return {'code': 3001, 'message': f"批量发送失败: {task['error']}", 'data': None}, 500
+            return _batch_summary(invalid + task['result']), 200
+
+        if stream:
+            progress = queue.Queue()
+            task = enqueue_task(_send_batch_task, (valid, stop_at, progress, []),
+                                deadline=stop_at, lane='bulk', units=len(valid))
+            attach_task(task, render_batch_task)
+            return Response(_stream_batch(task, progress, invalid), mimetype='application/x-ndjson')
+
+        task = enqueue_task(_send_batch_task, (valid, stop_at, None, []),
+                            deadline=stop_at, lane='bulk', units=len(valid))
+        attach_task(task, render_batch_task)
+        # 多等待一个条目的时间，让截止时间前开始发送的最后一条完成
+        results = wait_task(task, stop_at - time.time() + BATCH_ITEM_TIMEOUT)
+        return jsonify(_batch_summary(invalid + results))
+    except QueueFullError as e:
+        logger.warning(f"批量发送请求被拒绝: {str(e)}")
+        return queue_full_response(e)
+    except Exception as e:
+        logger.error(f"处理批量发送请求失败: {str(e)}")
+        return jsonify({
+            'code': 3001,
+            'message': f'处理请求失败: {str(e)}',
+            'data': None
+        }), 500
+
 @api_bp.route('/message/get-next-new', methods=['GET'])
 @require_api_key
 def get_next_new_message():
+    """获取新消息"""
+    return next_new_messages_response()
+
+def next_new_messages_response():
+    """
+    读取新消息并生成响应，所有获取新消息的接口共用，参数解析和返回格式保持一致
+
+    新消息由后台线程统一轮询，这里只读取轮询结果。
+    wait参数指定没有消息时最多等待的秒数（长轮询），max_messages限制本次返回的消息数量，
+    consumer参数指定消费者名称，同一API密钥下每个消费者有独立的读取位置
+    """
     wx_instance = wechat_manager.get_instance()
     if not wx_instance:
         logger.error("微信未初始化")
@@ -473,302 +840,35 @@ def get_next_new_message():
             'data': None
         }), 400
 
-    try:
-        # 更灵活的布尔值处理
-        def parse_bool(value):
-            if isinstance(value, bool):
-                return value
-            if isinstance(value, str):
-                value = value.lower()
-                if value in ('true', '1', 'yes', 'y', 'on'):
-                    return True
-                if value in ('false', '0', 'no', 'n', 'off'):
-                    return False
-            return False
-
-        # 获取参数并设置默认值
-        savepic = parse_bool(request.args.get('savepic', 'false'))
-        savevideo = parse_bool(request.args.get('savevideo', 'false'))
-        savefile = parse_bool(request.args.get('savefile', 'false'))
-        savevoice = parse_bool(request.args.get('savevoice', 'false'))
-        parseurl = parse_bool(request.args.get('parseurl', 'false'))
-
-        logger.debug(f"处理参数: savepic={savepic}, savevideo={savevideo}, savefile={savefile}, savevoice={savevoice}, parseurl={parseurl}")
-
-        # 获取当前使用的库
-        lib_name = getattr(wx_instance, '_lib_name', 'wxauto')
-        logger.debug(f"当前使用的库: {lib_name}")
-
-        # 根据不同的库构建不同的参数
-        if lib_name == 'wxautox':
-            # wxautox的GetNextNewMessage只支持filter_mute参数
-            params = {
-                'filter_mute': False  # 默认不过滤免打扰消息
-            }
-            logger.debug(f"使用wxautox参数: {params}")
-        else:
-            # wxauto的GetNextNewMessage可能不支持任何参数，使用空参数
-            params = {}
-            logger.debug(f"使用wxauto参数: {params}")
-
-        # 不再设置wxauto保存路径，避免导入错误
-        logger.debug("跳过wxauto保存路径设置，使用默认路径")
+    wait = request.args.get('wait', 0, type=float)
+    max_messages = request.args.get('max_messages', type=int)
+    consumer = request.args.get('consumer', 'default').strip()
+    if wait is None or wait < 0 or (max_messages is not None and max_messages <= 0):
+        return jsonify({
+            'code': 1002,
+            'message': 'wait不能为负数，max_messages必须为正整数',
+            'data': None
+        }), 400
+    if not consumer or len(consumer) > MAX_CONSUMER_NAME:
+        return jsonify({
+            'code': 1002,
+            'message': f'consumer长度需在1到{MAX_CONSUMER_NAME}之间',
+            'data': None
+        }), 400
 
-        # 调用GetNextNewMessage方法
-        try:
-            messages = wx_instance.GetNextNewMessage(**params)
-        except Exception as e:
-            logger.error(f"获取新消息失败: {str(e)}")
-            # 如果出现异常，返回空字典表示没有新消息
-            messages = {}
+    try:
+        consumer_id = f"{tenant_label(request.headers.get('X-API-Key'))}/{consumer}"
+        formatted_messages, missed = message_poller.read(consumer_id, wait=wait, max_messages=max_messages)
+        if missed:
+            logger.warning(f"消费者 {consumer_id} 读取过慢，错过了 {missed} 条新消息")
 
-        if not messages:
+        if not formatted_messages:
             return jsonify({
                 'code': 0,
                 'message': '没有新消息',
                 'data': {'messages': {}}
             })
 
-        # 辅助函数：清理群名中的人数信息
-        def clean_group_name(name):
-            # 匹配群名后面的 (数字) 模式
-            import re
-            return re.sub(r'\s*\(\d+\)$', '', name)
-
-        # 格式化消息 - 处理不同库的返回格式
-        formatted_messages = {}
-
-        # 检查当前使用的库
-        lib_name = wx_instance.get_lib_name() if hasattr(wx_instance, 'get_lib_name') else 'wxauto'
-
-        if lib_name == "wxautox":
-            # wxautox返回格式: {'chat_name': 'name', 'chat_type': 'type', 'msg': [messages]}
-            if isinstance(messages, dict) and 'chat_name' in messages and 'msg' in messages:
-                chat_name = messages.get('chat_name', 'Unknown')
-                msg_list = messages.get('msg', [])
-
-                # 清理群名中的人数信息
-                clean_name = clean_group_name(chat_name)
-                formatted_messages[clean_name] = []
-
-                for msg in msg_list:
-                    try:
-                        # 检查msg是否是对象
-                        if hasattr(msg, 'type'):
-                            # 检查消息类型
-                            if hasattr(msg, 'type') and getattr(msg, 'type', '') in ['image', 'file', 'video', 'voice']:
-                                # 检查文件是否存在且大小大于0
-                                if hasattr(msg, 'file_path') and getattr(msg, 'file_path', ''):
-                                    try:
-                                        file_path = getattr(msg, 'file_path', '')
-                                        if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
-                                            logger.warning(f"文件不存在或大小为0: {file_path}")
-                                    except Exception as e:
-                                        logger.error(f"检查文件失败: {str(e)}")
-
-                            formatted_messages[clean_name].append({
-                                'type': getattr(msg, 'type', 'unknown'),
-                                'content': getattr(msg, 'content', str(msg)),
-                                'sender': getattr(msg, 'sender', ''),
-                                'id': getattr(msg, 'id', ''),
-                                'mtype': getattr(msg, 'mtype', None),
-                                'sender_remark': getattr(msg, 'sender_remark', None),
-                                'file_path': getattr(msg, 'file_path', None)
-                            })
-                        else:
-                            # 如果msg是字符串或其他类型，转换为文本消息
-                            formatted_messages[clean_name].append({
-                                'type': 'text',
-                                'content': str(msg),
-                                'sender': '',
-                                'id': '',
-                                'mtype': None,
-                                'sender_remark': None,
-                                'file_path': None
-                            })
-                    except Exception as e:
-                        logger.error(f"处理消息时出错: {str(e)}")
-                        # 添加错误消息
-                        formatted_messages[clean_name].append({
-                            'type': 'error',
-                            'content': f'消息处理错误: {str(e)}',
-                            'sender': '',
-                            'id': '',
-                            'mtype': None,
-                            'sender_remark': None,
-                            'file_path': None
-                        })
-            else:
-                logger.warning(f"wxautox返回了意外的消息格式: {type(messages)}")
-        else:
-            # wxauto处理 - 根据日志分析，wxauto实际返回字典格式，不是列表格式
-            if isinstance(messages, dict):
-                # wxauto返回字典格式: {'chat_name': '消息测试', 'chat_type': 'group', 'msg': [...]}
-                if 'msg' in messages and isinstance(messages['msg'], list):
-                    # 使用正确的chat_name，而不是硬编码的"新消息"
-                    chat_name = messages.get('chat_name', '未知聊天')
-                    clean_name = clean_group_name(chat_name)
-                    formatted_messages[clean_name] = []
-
-                    for msg in messages['msg']:
-                        try:
-                            # 检查msg是否已经是字典格式（适配器已转换）
-                            if isinstance(msg, dict):
-                                # 已经是字典格式，直接使用
-                                msg_data = {
-                                    'type': msg.get('type', 'unknown'),
-                                    'content': msg.get('content', str(msg)),
-                                    'sender': msg.get('sender', ''),
-                                    'time': msg.get('time', ''),
-                                    'id': msg.get('id', ''),
-                                    'mtype': msg.get('mtype', None),
-                                    'sender_remark': msg.get('sender_remark', None),
-                                    'file_path': msg.get('file_path', None)
-                                }
-                            else:
-                                # 原始消息对象，需要转换
-                                # 检查消息类型
-                                if hasattr(msg, 'type') and getattr(msg, 'type', '') in ['image', 'file', 'video', 'voice']:
-                                    # 检查文件是否存在且大小大于0
-                                    if hasattr(msg, 'file_path') and getattr(msg, 'file_path', ''):
-                                        try:
-                                            file_path = getattr(msg, 'file_path', '')
-                                            if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
-                                                logger.warning(f"文件不存在或大小为0: {file_path}")
-                                        except Exception as e:
-                                            logger.error(f"检查文件失败: {str(e)}")
-
-                                msg_data = {
-                                    'type': getattr(msg, 'type', 'unknown'),
-                                    'content': getattr(msg, 'content', str(msg)),
-                                    'sender': getattr(msg, 'sender', ''),
-                                    'time': getattr(msg, 'time', ''),
-                                    'id': getattr(msg, 'id', ''),
-                                    'mtype': getattr(msg, 'mtype', None),
-                                    'sender_remark': getattr(msg, 'sender_remark', None),
-                                    'file_path': getattr(msg, 'file_path', None)
-                                }
-
-                            formatted_messages[clean_name].append(msg_data)
-                        except Exception as e:
-                            logger.error(f"处理wxauto消息时出错: {str(e)}")
-                            # 添加错误消息
-                            formatted_messages[clean_name].append({
-                                'type': 'error',
-                                'content': f'消息处理错误: {str(e)}',
-                                'sender': '',
-                                'time': '',
-                                'id': '',
-                                'mtype': None,
-                                'sender_remark': None,
-                                'file_path': None
-                            })
-                else:
-                    # 可能是其他字典格式: {chat_name: [messages]}
-                    for chat_name, msg_list in messages.items():
-                        if isinstance(msg_list, list):
-                            # 清理群名中的人数信息
-                            clean_name = clean_group_name(chat_name)
-                            formatted_messages[clean_name] = []
-
-                            for msg in msg_list:
-                                try:
-                                    # 检查消息类型
-                                    if hasattr(msg, 'type') and getattr(msg, 'type', '') in ['image', 'file', 'video', 'voice']:
-                                        # 检查文件是否存在且大小大于0
-                                        if hasattr(msg, 'file_path') and getattr(msg, 'file_path', ''):
-                                            try:
-                                                file_path = getattr(msg, 'file_path', '')
-                                                if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
-                                                    logger.warning(f"文件不存在或大小为0: {file_path}")
-                                            except Exception as e:
-                                                logger.error(f"检查文件失败: {str(e)}")
-
-                                    formatted_messages[clean_name].append({
-                                        'type': getattr(msg, 'type', 'unknown'),
-                                        'content': getattr(msg, 'content', str(msg)),
-                                        'sender': getattr(msg, 'sender', ''),
-                                        'time': getattr(msg, 'time', ''),
-                                        'id': getattr(msg, 'id', ''),
-                                        'mtype': getattr(msg, 'mtype', None),
-                                        'sender_remark': getattr(msg, 'sender_remark', None),
-                                        'file_path': getattr(msg, 'file_path', None)
-                                    })
-                                except Exception as e:
-                                    logger.error(f"处理wxauto消息时出错: {str(e)}")
-                                    # 添加错误消息
-                                    formatted_messages[clean_name].append({
-                                        'type': 'error',
-                                        'content': f'消息处理错误: {str(e)}',
-                                        'sender': '',
-                                        'time': '',
-                                        'id': '',
-                                        'mtype': None,
-                                        'sender_remark': None,
-                                        'file_path': None
-                                    })
-            elif isinstance(messages, list):
-                # 如果wxauto确实返回列表格式（向后兼容）
-                formatted_messages["新消息"] = []
-
-                for msg in messages:
-                    try:
-                        # 检查msg是否已经是字典格式（适配器已转换）
-                        if isinstance(msg, dict):
-                            # 已经是字典格式，直接使用
-                            msg_data = {
-                                'type': msg.get('type', 'unknown'),
-                                'content': msg.get('content', str(msg)),
-                                'sender': msg.get('sender', ''),
-                                'time': msg.get('time', ''),
-                                'id': msg.get('id', ''),
-                                'mtype': msg.get('mtype', None),
-                                'sender_remark': msg.get('sender_remark', None),
-                                'file_path': msg.get('file_path', None)
-                            }
-                        else:
-                            # 原始消息对象，需要转换
-                            # 检查消息类型
-                            if hasattr(msg, 'type') and getattr(msg, 'type', '') in ['image', 'file', 'video', 'voice']:
-                                # 检查文件是否存在且大小大于0
-                                if hasattr(msg, 'file_path') and getattr(msg, 'file_path', ''):
-                                    try:
-                                        file_path = getattr(msg, 'file_path', '')
-                                        if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
-                                            logger.warning(f"文件不存在或大小为0: {file_path}")
-                                    except Exception as e:
-                                        logger.error(f"检查文件失败: {str(e)}")
-
-                            msg_data = {
-                                'type': getattr(msg, 'type', 'unknown'),
-                                'content': getattr(msg, 'content', str(msg)),
-                                'sender': getattr(msg, 'sender', ''),
-                                'time': getattr(msg, 'time', ''),
-                                'id': getattr(msg, 'id', ''),
-                                'mtype': getattr(msg, 'mtype', None),
-                                'sender_remark': getattr(msg, 'sender_remark', None),
-                                'file_path': getattr(msg, 'file_path', None)
-                            }
-
-                        formatted_messages["新消息"].append(msg_data)
-                    except Exception as e:
-                        logger.error(f"处理wxauto消息时出错: {str(e)}")
-                        # 添加错误消息
-                        formatted_messages["新消息"].append({
-                            'type': 'error',
-                            'content': f'消息处理错误: {str(e)}',
-                            'sender': '',
-                            'time': '',
-                            'id': '',
-                            'mtype': None,
-                            'sender_remark': None,
-                            'file_path': None
-                        })
-
-            else:
-                # 其他格式，转换为字符串
-                formatted_messages = {"消息": [{"type": "text", "content": str(messages)}]}
-
         return jsonify({
             'code': 0,
             'message': '获取成功',
@@ -784,6 +884,85 @@ def clean_group_name(name):
             'data': None
         }), 500
 
+# 消息检索每页默认返回的数量
+SEARCH_DEFAULT_LIMIT = 20
+
+@api_bp.route('/message/search', methods=['GET'])
+@require_api_key
+def search_messages():
+    """
+    按关键词检索已保存的消息
+
+    查询参数：
+        q: 关键词，空格分隔的多个关键词需同时匹配
+        chat/sender/type: 按聊天对象、发送者、消息类型过滤
+        since/until: 接收时间范围[since, until)，Unix时间戳或'YYYY-MM-DD HH:MM:SS'
+        order: rank（按相关度，默认）或time（从新到旧）
+        limit: 每页消息数量
+        cursor: 上一页返回的next_cursor
+    """
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return jsonify({
+            'code': 1002,
+            'message': '缺少必要参数: q',
+            'data': None
+        }), 400
+
+    if message_store.enabled:
+        message_store.start()
+    if not message_store.enabled or not message_store.search_enabled:
+        return jsonify({
+            'code': 3001,
+            'message': '消息检索不可用: 消息存储未启用或SQLite不支持FTS5',
+            'data': None
+        }), 400
+
+    order = request.args.get('order', 'rank')
+    limit = request.args.get('limit', SEARCH_DEFAULT_LIMIT, type=int)
+    cursor = request.args.get('cursor')
+    try:
+        if order not in ('rank', 'time'):
+            raise ValueError('order只能为rank或time')
+        if limit is None or not 1 <= limit <= STORE_MAX_LIMIT:
+            raise ValueError(f'limit需在1到{STORE_MAX_LIMIT}之间')
+        since = request.args.get('since')
+        since = parse_time(since) if since else None
+        until = request.args.get('until')
+        until = parse_time(until) if until else None
+        if cursor:
+            cursor = message_store.parse_cursor(cursor)
+            if cursor is None:
+                raise ValueError('无效的cursor')
+    except ValueError as e:
+        return jsonify({
+            'code': 1002,
+            'message': str(e),
+            'data': None
+        }), 400
+
+    try:
+        messages, next_cursor = message_store.search(
+            query, chat=request.args.get('chat') or None, sender=request.args.get('sender') or None,
+            msg_type=request.args.get('type') or None, since=since, until=until,
+            limit=limit, cursor=cursor, order=order
+        )
+        return jsonify({
+            'code': 0,
+            'message': '检索成功',
+            'data': {
+                'messages': messages,
+                'next_cursor': next_cursor
+            }
+        })
+    except Exception as e:
+        logger.error(f"检索消息失败: {str(e)}")
+        return jsonify({
+            'code': 3001,
+            'message': f'检索消息失败: {str(e)}',
+            'data': None
+        }), 500
+
 @api_bp.route('/message/listen/add', methods=['POST'])
 @require_api_key
 def add_listen_chat():
@@ -831,33 +1010,18 @@ def add_listen_chat():
         if lib_name == 'wxautox':
             # wxautox实现
             def message_callback(msg, chat):
-                """wxautox的消息回调函数，统一使用全局缓存"""
+                """wxautox的消息回调函数，统一使用监听消息缓存"""
                 try:
-                    logger.info(f"wxautox收到消息: {msg}, 来自聊天: {chat}")
-
-                    # 将wxautox消息对象转换为可序列化的字典格式
-                    serializable_msg = {
-                        'type': getattr(msg, 'type', 'unknown'),
-                        'content': getattr(msg, 'content', str(msg)),
-                        'sender': getattr(msg, 'sender', ''),
-                        'id': getattr(msg, 'id', ''),
-                        'mtype': getattr(msg, 'mtype', None),
-                        'sender_remark': getattr(msg, 'sender_remark', None),
-                        'file_path': getattr(msg, 'file_path', None),
-                        'time': getattr(msg, 'time', None)
-                    }
+                    logger.debug(f"wxautox收到消息: {msg}, 来自聊天: {chat}")
 
-                    # 将消息存储到全局缓存中
-                    if nickname not in _message_cache:
-                        _message_cache[nickname] = []
-                    _message_cache[nickname].append(serializable_msg)
-
-                    logger.info(f"已将消息转换并存储到缓存: {serializable_msg}")
+                    # 将wxautox消息对象转换为可序列化的字典格式，存入监听消息缓存并唤醒等待中的请求
+                    _publish_listen_message(nickname, msg)
                 except Exception as e:
                     logger.error(f"回调函数处理消息时出错: {str(e)}")
 
             # 调用AddListenChat
-            result = original_instance.AddListenChat(nickname=nickname, callback=message_callback)
+            result = run_in_executor(original_instance.AddListenChat,
+                                     kwargs={'nickname': nickname, 'callback': message_callback})
 
             # 调试信息：检查AddListenChat的返回值类型
             logger.debug(f"wxautox AddListenChat返回值类型: {type(result)}, 值: {result}")
@@ -876,30 +1040,14 @@ def message_callback(msg, chat):
             def message_callback(msg, chat):
                 """wxauto的消息回调函数，接收msg和chat两个参数"""
                 try:
-                    logger.info(f"wxauto收到消息: {msg}, 来自聊天: {chat}")
-
-                    # 将wxauto消息对象转换为可序列化的字典格式
-                    serializable_msg = {
-                        'type': getattr(msg, 'type', 'unknown'),
-                        'content': getattr(msg, 'content', str(msg)),
-                        'sender': getattr(msg, 'sender', ''),
-                        'id': getattr(msg, 'id', ''),
-                        'mtype': getattr(msg, 'mtype', None),
-                        'sender_remark': getattr(msg, 'sender_remark', None),
-                        'file_path': getattr(msg, 'file_path', None),
-                        'time': getattr(msg, 'time', None)
-                    }
-
-                    # 将消息存储到全局缓存中
-                    if nickname not in _message_cache:
-                        _message_cache[nickname] = []
-                    _message_cache[nickname].append(serializable_msg)
+                    logger.debug(f"wxauto收到消息: {msg}, 来自聊天: {chat}")
 
-                    logger.info(f"已将消息转换并存储到缓存: {serializable_msg}")
+                    # 将wxauto消息对象转换为可序列化的字典格式，存入监听消息缓存并唤醒等待中的请求
+                    _publish_listen_message(nickname, msg)
                 except Exception as e:
                     logger.error(f"wxauto回调函数处理消息时出错: {str(e)}")
 
-            result = original_instance.AddListenChat(nickname, message_callback)
+            result = run_in_executor(original_instance.AddListenChat, (nickname, message_callback))
 
             # 调试信息：检查AddListenChat的返回值类型
             logger.debug(f"AddListenChat返回值类型: {type(result)}, 值: {result}")
@@ -927,10 +1075,30 @@ def message_callback(msg, chat):
             'data': None
         }), 500
 
+# 监听消息消费者名称的最大长度
+MAX_CONSUMER_NAME = 64
+
+def _publish_listen_message(nickname, msg):
+    """写入监听消息日志和消息存储，重新激活监听或重连后再次收到的消息不会重复交付"""
+    message_index.add(nickname, msg)
+    message = serialize_message(msg)
+    if message_dedup.is_new(nickname, message):
+        media_pipeline.attach(message)
+        # 后台轮询到的新消息由轮询器保存，这里只保存监听消息
+        message_store.add(nickname, message, 'listen')
+        message_hub.publish(nickname, message)
+
 @api_bp.route('/message/listen/get', methods=['GET'])
 @require_api_key
 def get_listen_messages():
-    """获取监听消息 - 统一处理wxauto和wxautox"""
+    """
+    获取监听消息 - 统一处理wxauto和wxautox
+
+    默认每次返回一个聊天对象的未读消息，batch=true时一次返回所有有未读消息的聊天对象，
+    max_messages和max_bytes限制单次返回的消息数量和字节数，由各聊天对象轮流分配。
+    wait参数指定没有消息时最多等待的秒数（长轮询），消息到达后立即返回；其余消息留给下次获取。
+    consumer参数指定消费者名称，同一API密钥下每个消费者有独立的读取位置，互不影响
+    """
     wx_instance = wechat_manager.get_instance()
     if not wx_instance:
         return jsonify({
@@ -939,33 +1107,39 @@ def get_listen_messages():
             'data': None
         }), 400
 
-    try:
-        lib_name = wx_instance.get_lib_name() if hasattr(wx_instance, 'get_lib_name') else 'wxauto'
-        logger.info(f"获取监听消息，使用库: {lib_name}")
-
-        # 统一从全局消息缓存获取消息
-        messages = {}
-        if _message_cache:
-            logger.info(f"缓存中的聊天对象: {list(_message_cache.keys())}")
-
-            # 找到第一个有消息的聊天对象
-            for chat_name, msg_list in _message_cache.items():
-                if msg_list:  # 如果有消息
-                    messages = {chat_name: msg_list}
-                    logger.info(f"返回 {chat_name} 的 {len(msg_list)} 条消息")
-                    # 清空缓存（消息已被消费）
-                    _message_cache[chat_name] = []
-                    break
+    wait = request.args.get('wait', 0, type=float)
+    max_messages = request.args.get('max_messages', type=int)
+    max_bytes = request.args.get('max_bytes', type=int)
+    batch = parse_bool(request.args.get('batch'))
+    consumer = request.args.get('consumer', 'default').strip()
+    if wait is None or wait < 0 or (max_messages is not None and max_messages <= 0) or \
+            (max_bytes is not None and max_bytes <= 0):
+        return jsonify({
+            'code': 1002,
+            'message': 'wait不能为负数，max_messages和max_bytes必须为正整数',
+            'data': None
+        }), 400
+    if not consumer or len(consumer) > MAX_CONSUMER_NAME:
+        return jsonify({
+            'code': 1002,
+            'message': f'consumer长度需在1到{MAX_CONSUMER_NAME}之间',
+            'data': None
+        }), 400
 
-        if not messages:
-            logger.info("缓存中没有新消息")
-            messages = {}
+    try:
+        # 读取位置按API密钥隔离，不同密钥使用相同的消费者名称互不影响
+        consumer_id = f"{tenant_label(request.headers.get('X-API-Key'))}/{consumer}"
+        messages, missed = message_hub.get(consumer_id, wait=wait, max_messages=max_messages,
+                                           batch=batch, max_bytes=max_bytes)
+        if messages:
+            logger.debug(f"返回 {len(messages)} 个聊天对象的 {sum(len(v) for v in messages.values())} 条消息")
+        if missed:
+            logger.warning(f"消费者 {consumer_id} 读取过慢，错过了 {missed} 条已被覆盖的消息")
 
-        # 直接返回消息，不需要复杂的格式化
         return jsonify({
             'code': 0,
             'message': '获取消息成功' if messages else '没有新消息',
-            'data': {'messages': messages}
+            'data': {'messages': messages, 'missed': missed}
         })
 
     except Exception as e:
@@ -1008,14 +1182,13 @@ def remove_listen_chat():
 
         # 统一调用RemoveListenChat方法
         if hasattr(original_instance, 'RemoveListenChat'):
-            result = original_instance.RemoveListenChat(nickname)
+            result = run_in_executor(original_instance.RemoveListenChat, (nickname,))
             logger.info(f"RemoveListenChat调用结果: {result}")
         else:
             logger.warning(f"{lib_name}库不支持RemoveListenChat方法")
 
-        # 从全局缓存中移除
-        if nickname in _message_cache:
-            del _message_cache[nickname]
+        # 从监听消息缓存中移除
+        if message_hub.remove(nickname):
             logger.info(f"已从缓存中移除监听对象: {nickname}")
 
         return jsonify({
@@ -1049,6 +1222,7 @@ def remove_listen_chat():
 
 @api_bp.route('/chat-window/message/send', methods=['POST'])
 @require_api_key
+@idempotent
 def chat_window_send_message():
     wx_instance = wechat_manager.get_instance()
     if not wx_instance:
@@ -1187,6 +1361,7 @@ def chat_window_send_message():
 
 @api_bp.route('/chat-window/message/send-typing', methods=['POST'])
 @require_api_key
+@idempotent
 def chat_window_send_typing_message():
     wx_instance = wechat_manager.get_instance()
     if not wx_instance:
@@ -1277,6 +1452,7 @@ def chat_window_send_typing_message():
 
 @api_bp.route('/chat-window/message/send-file', methods=['POST'])
 @require_api_key
+@idempotent
 def chat_window_send_file():
     wx_instance = wechat_manager.get_instance()
     if not wx_instance:
@@ -1372,6 +1548,7 @@ def chat_window_send_file():
 
 @api_bp.route('/chat-window/message/at-all', methods=['POST'])
 @require_api_key
+@idempotent
 def chat_window_at_all():
     wx_instance = wechat_manager.get_instance()
     if not wx_instance:
@@ -1967,6 +2144,14 @@ def get_queue_status():
     """获取队列状态"""
     try:
         stats = get_queue_stats()
+        stats['idempotency'] = idempotency_store.stats()
+        stats['listen'] = message_hub.stats()
+        stats['message_store'] = message_store.stats()
+        stats['dedup'] = message_dedup.stats()
+        stats['message_index'] = message_index.stats()
+        stats['new_messages'] = message_poller.stats()
+        stats['connection_monitor'] = wechat_manager.monitor_stats()
+        stats['media'] = media_pipeline.stats()
         return jsonify({
             'code': 0,
             'message': '获取成功',
@@ -0,0 +1,200 @@
+"""
+定时消息相关API路由
+在指定时间或延迟一段时间后发送消息、文件
+"""
+
+import time
+from datetime import datetime
+from flask import Blueprint, jsonify, request
+from app.auth import require_api_key
+from app.api_queue import tenant_label
+from app.unified_logger import logger
+from app.message_scheduler import message_scheduler, SCHEDULE_MAX_JITTER
+from app.api.routes import _send_message_task, _send_file_task
+
+schedule_bp = Blueprint('schedule', __name__)
+
+# 列表接口单次最多返回的数量
+MAX_LIST_LIMIT = 1000
+
+# 支持的时间字符串格式（本地时间）
+SEND_AT_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M')
+
+message_scheduler.register_handler(
+    'message',
+    lambda payload: _send_message_task.submit(payload['receiver'], payload['message'],
+                                              payload['at_list'], payload['clear'])
+)
+message_scheduler.register_handler(
+    'file',
+    lambda payload: _send_file_task.submit(payload['receiver'], payload['file_paths'])
+)
+message_scheduler.start()
+
+def parse_send_time(data):
+    """
+    解析计划发送时间
+
+    send_at支持时间戳或'YYYY-MM-DD HH:MM:SS'格式的本地时间，send_after为相对当前的秒数
+
+    Returns:
+        时间戳，参数无效时返回None
+    """
+    send_at = data.get('send_at')
+    send_after = data.get('send_after')
+
+    if send_at is not None:
+        if isinstance(send_at, (int, float)):
+            return float(send_at)
+        for fmt in SEND_AT_FORMATS:
+            try:
+                return datetime.strptime(str(send_at), fmt).timestamp()
+            except ValueError:
+                continue
+        return None
+
+    if send_after is not None:
+        try:
+            return time.time() + max(0.0, float(send_after))
+        except (TypeError, ValueError):
+            return None
+    return None
+
+def schedule_to_dict(record):
+    """将定时任务转换为响应数据，不返回API密钥"""
+    data = {key: value for key, value in record.items() if key != 'tenant'}
+    data['status_url'] = f"/api/jobs/{record['job_id']}" if record['job_id'] else None
+    return data
+
+@schedule_bp.route('/send', methods=['POST'])
+@require_api_key
+def schedule_send():
+    """添加定时发送任务，message和file_paths二选一"""
+    try:
+        data = request.get_json() or {}
+        receiver = data.get('receiver')
+        message = data.get('message')
+        file_paths = data.get('file_paths', [])
+
+        if not receiver or not (message or file_paths):
+            return jsonify({
+                'code': 1002,
+                'message': '缺少必要参数',
+                'data': None
+            }), 400
+
+        due_at = parse_send_time(data)
+        if due_at is None:
+            return jsonify({
+                'code': 1002,
+                'message': '缺少或无效的发送时间: send_at / send_after',
+                'data': None
+            }), 400
+
+        try:
+            jitter = float(data.get('jitter', 0))
+        except (TypeError, ValueError):
+            jitter = 0
+        if jitter < 0 or jitter > SCHEDULE_MAX_JITTER:
+            return jsonify({
+                'code': 1002,
+                'message': f'jitter需在0到{SCHEDULE_MAX_JITTER}秒之间',
+                'data': None
+            }), 400
+
+        if message:
+            kind = 'message'
+            payload = {
+                'receiver': receiver,
+                'message': message,
+                'at_list': data.get('at_list', []),
+                'clear': "1" if data.get('clear', True) else "0"
+            }
+        else:
+            kind = 'file'
+            payload = {'receiver': receiver, 'file_paths': file_paths}
+
+        # 定时任务默认使用批量通道，可通过X-Queue-Lane指定
+        lane = request.headers.get('X-Queue-Lane', 'bulk').strip().lower()
+        record = message_scheduler.schedule(kind, payload, due_at, jitter=jitter,
+                                            tenant=request.headers.get('X-API-Key'), lane=lane)
+        return jsonify({
+            'code': 0,
+            'message': '定时任务已添加',
+            'data': schedule_to_dict(record)
+        })
+    except Exception as e:
+        logger.error(f"添加定时任务失败: {str(e)}")
+        return jsonify({
+            'code': 3001,
+            'message': f'添加定时任务失败: {str(e)}',
+            'data': None
+        }), 500
+
+@schedule_bp.route('/list', methods=['GET'])
+@require_api_key
+def list_schedules():
+    """列出当前API密钥的定时任务，可按状态过滤"""
+    status = request.args.get('status')
+    limit = request.args.get('limit', 100, type=int)
+    limit = min(max(limit if limit is not None else 100, 1), MAX_LIST_LIMIT)
+    records = message_scheduler.list(tenant=request.headers.get('X-API-Key'), status=status, limit=limit)
+    return jsonify({
+        'code': 0,
+        'message': '获取成功',
+        'data': {
+            'schedules': [schedule_to_dict(record) for record in records],
+            'stats': message_scheduler.stats(tenant=request.headers.get('X-API-Key'))
+        }
+    })
+
+def _get_own_schedule(schedule_id):
+    """获取属于当前API密钥的定时任务"""
+    record = message_scheduler.get(schedule_id)
+    if not record or record['tenant'] != tenant_label(request.headers.get('X-API-Key')):
+        return None
+    return record
+
+@schedule_bp.route('/<schedule_id>', methods=['GET'])
+@require_api_key
+def get_schedule(schedule_id):
+    """获取定时任务状态"""
+    record = _get_own_schedule(schedule_id)
+    if not record:
+        return jsonify({
+            'code': 1004,
+            'message': f'定时任务不存在或已过期: {schedule_id}',
+            'data': None
+        }), 404
+
+    return jsonify({
+        'code': 0,
+        'message': '获取成功',
+        'data': schedule_to_dict(record)
+    })
+
+@schedule_bp.route('/<schedule_id>/cancel', methods=['POST'])
+@require_api_key
+def cancel_schedule(schedule_id):
+    """取消尚未发送的定时任务"""
+    record = _get_own_schedule(schedule_id)
+    if not record:
+        return jsonify({
+            'code': 1004,
+            'message': f'定时任务不存在或已过期: {schedule_id}',
+            'data': None
+        }), 404
+
+    if not message_scheduler.cancel(schedule_id):
+        record = message_scheduler.get(schedule_id)
+        return jsonify({
+            'code': 1005,
+            'message': f"定时任务状态为{record['status']}，无法取消",
+            'data': schedule_to_dict(record)
+        }), 409
+
+    return jsonify({
+        'code': 0,
+        'message': '定时任务已取消',
+        'data': schedule_to_dict(message_scheduler.get(schedule_id))
+    })
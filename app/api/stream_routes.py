@@ -0,0 +1,95 @@
+"""
+消息推送相关API路由
+通过Server-Sent Events推送监听对象收到的新消息，客户端无需轮询
+"""
+
+import json
+from flask import Blueprint, Response, jsonify, request, stream_with_context
+from app.auth import require_api_key
+from app.unified_logger import logger
+from app.message_hub import message_hub
+from app.message_poller import message_poller
+
+stream_bp = Blueprint('stream', __name__)
+
+# 默认心跳间隔（秒），没有消息时定期发送注释行，防止连接被代理或客户端判定为超时
+STREAM_HEARTBEAT = 15
+
+# 允许的心跳间隔范围（秒）
+STREAM_MIN_HEARTBEAT = 1
+STREAM_MAX_HEARTBEAT = 60
+
+# 断线重连的建议间隔（毫秒），通过SSE的retry字段告知客户端
+STREAM_RETRY_MS = 3000
+
+def _sse(event, data, event_id=None):
+    """格式化一条SSE事件"""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
+
+def _parse_cursor():
+    """断线重连时从Last-Event-ID请求头或last_event_id参数继续，否则只推送之后的新消息"""
+    value = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    if value is None or value == '':
+        return None
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        return None
+
+@stream_bp.route('/messages', methods=['GET'])
+@require_api_key
+def stream_messages():
+    """
+    订阅新消息推送（text/event-stream）
+
+    查询参数：
+        chats: 逗号分隔的聊天对象名称，只推送这些聊天对象的消息，不传则推送全部
+        heartbeat: 心跳间隔（秒）
+        last_event_id: 从指定事件之后继续推送，与Last-Event-ID请求头作用相同
+    """
+    chats = request.args.get('chats')
+    chats = frozenset(name.strip() for name in chats.split(',') if name.strip()) if chats else None
+    heartbeat = request.args.get('heartbeat', STREAM_HEARTBEAT, type=float)
+    if heartbeat is None or not STREAM_MIN_HEARTBEAT <= heartbeat <= STREAM_MAX_HEARTBEAT:
+        return jsonify({
+            'code': 1002,
+            'message': f'heartbeat需在{STREAM_MIN_HEARTBEAT}到{STREAM_MAX_HEARTBEAT}秒之间',
+            'data': None
+        }), 400
+
+    cursor = _parse_cursor()
+    resumed = cursor is not None
+    if cursor is None:
+        cursor = message_hub.last_event_id
+    # 没有客户端读取新消息时后台轮询可能已暂停，有订阅者时恢复
+    message_poller.touch()
+
+    def generate():
+        nonlocal cursor
+        logger.info(f"消息推送连接已建立，过滤: {sorted(chats) if chats else '全部'}，起始事件: {cursor}")
+        yield f"retry: {STREAM_RETRY_MS}\n\n"
+        yield _sse('ready', {'last_event_id': cursor, 'resumed': resumed})
+        try:
+            while True:
+                events, cursor, gap = message_hub.subscribe(cursor, chats, timeout=heartbeat)
+                if gap:
+                    # 断线期间的部分消息已被淘汰，客户端可通过其他接口补齐
+                    yield _sse('gap', {'last_event_id': cursor})
+                if not events:
+                    yield ": heartbeat\n\n"
+                    continue
+                for event_id, chat, message in events:
+                    yield _sse('message', {'chat': chat, 'message': message}, event_id)
+        except GeneratorExit:
+            logger.info("消息推送连接已断开")
+            raise
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
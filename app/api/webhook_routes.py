@@ -0,0 +1,26 @@
+"""
+Webhook推送相关API路由
+查询新消息Webhook推送的送达情况
+"""
+
+from flask import Blueprint, jsonify
+from app.auth import require_api_key
+from app.webhook_delivery import webhook_dispatcher
+from app.message_poller import message_poller
+
+webhook_bp = Blueprint('webhooks', __name__)
+
+webhook_dispatcher.start()
+# 配置了Webhook时由后台轮询获取新消息推送，不依赖客户端读取
+if webhook_dispatcher.started:
+    message_poller.start()
+
+@webhook_bp.route('/stats', methods=['GET'])
+@require_api_key
+def webhook_stats():
+    """各Webhook地址的待发送数量、送达延迟和失败统计"""
+    return jsonify({
+        'code': 0,
+        'message': '获取成功',
+        'data': webhook_dispatcher.stats()
+    })
@@ -3,6 +3,7 @@
 实现WeChat类的所有方法
 """
 
+import threading
 from flask import Blueprint, jsonify, request
 from app.auth import require_api_key
 from app.unified_logger import logger
@@ -466,11 +467,9 @@ def keep_running():
     timeout = data.get('timeout', 0)
 
     try:
-        # 调用KeepRunning方法
-        if timeout > 0:
-            wx_instance.KeepRunning(timeout)
-        else:
-            wx_instance.KeepRunning()
+        # KeepRunning会一直阻塞，在单独的线程中运行，不占用请求线程和UI自动化执行线程
+        args = (timeout,) if timeout > 0 else ()
+        threading.Thread(target=wx_instance.KeepRunning, args=args, daemon=True, name="WeChatKeepRunning").start()
 
         return jsonify({
             'code': 0,
@@ -1,24 +1,479 @@
 """
 API请求队列处理模块
-提供高并发支持和请求队列管理
+提供请求队列管理，所有微信UI自动化调用都在同一个执行线程中串行执行
 """
 
+import hashlib
+import heapq
+import inspect
+import math
 import queue
 import threading
 import time
 import traceback
+import uuid
+from collections import deque, OrderedDict
 from functools import wraps
 from app.unified_logger import logger
+from app.config import Config
+from app.rate_limiter import send_rate_limiter
+
+try:
+    import pythoncom
+except ImportError:
+    # 非Windows环境下没有pythoncom，执行线程跳过COM初始化
+    pythoncom = None
+
+# 队列容量上限，超过后拒绝新任务
+QUEUE_MAX_SIZE = Config.QUEUE_MAX_SIZE
+
+# 预估等待时间上限（秒），队列深度 × 最近平均执行时间超过该值时拒绝新任务
+QUEUE_MAX_WAIT = Config.QUEUE_MAX_WAIT
+
+# 没有执行耗时样本时假定的单个任务执行时间（秒）
+DEFAULT_EXEC_TIME = 1.0
+
+class QueueFullError(Exception):
+    """队列已满或预估等待时间过长，任务未被接受"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class RetryLater:
+    """
+    任务函数返回RetryLater表示暂时不能继续执行（例如发送令牌不足），
+    任务放回暂缓队列，delay秒后重新调用，期间执行线程先执行其他任务。
+    任务函数需要保证重新调用时不会重复已经完成的操作
+    """
+
+    __slots__ = ('delay',)
+
+    def __init__(self, delay):
+        self.delay = delay
+
+# 异步任务未指定截止时间时的默认有效期（秒），超过后未执行的任务会被丢弃
+# 异步任务不占用请求线程，准入时按此有效期而不是QUEUE_MAX_WAIT判断预估等待时间
+ASYNC_JOB_DEADLINE = 600
+
+# 排队中的异步任务总数上限，与同步请求的QUEUE_MAX_SIZE分开计算
+ASYNC_QUEUE_MAX_SIZE = Config.ASYNC_QUEUE_MAX_SIZE
+
+# 优先级通道默认配置：weight为加权轮询的权重，max_size为该通道的排队上限
+# interactive: 交互式发送；bulk: 批量发送；background: 读取、抓取等后台任务
+DEFAULT_LANES = {
+    'interactive': {'weight': 6, 'max_size': 200},
+    'bulk': {'weight': 3, 'max_size': 1000},
+    'background': {'weight': 1, 'max_size': 200}
+}
+
+# 未指定通道时使用的默认通道
+DEFAULT_LANE = 'interactive'
+
+def _load_lanes():
+    """合并app_config.json中的queue_lanes配置与默认配置"""
+    lanes = {}
+    configured = Config.QUEUE_LANES if isinstance(Config.QUEUE_LANES, dict) else {}
+    for name, defaults in DEFAULT_LANES.items():
+        options = dict(defaults)
+        if isinstance(configured.get(name), dict):
+            options.update(configured[name])
+        options['weight'] = max(1, int(options['weight']))
+        lanes[name] = options
+    return lanes
+
+LANES = _load_lanes()
+
+def resolve_lane(lane, default=DEFAULT_LANE):
+    """校验通道名称，无效时返回默认通道"""
+    return lane if lane in LANES else default
+
+# 按API密钥公平调度的默认配置：weight为赤字轮询的权重，max_size为单个密钥的排队上限，
+# async_max_size为单个密钥排队中的异步任务上限
+DEFAULT_TENANT = {'weight': 1, 'max_size': 500, 'async_max_size': 2000}
+
+def _load_tenants():
+    """读取app_config.json中的queue_tenants配置，default项作为未单独配置的密钥的默认值"""
+    configured = Config.QUEUE_TENANTS if isinstance(Config.QUEUE_TENANTS, dict) else {}
+    default = dict(DEFAULT_TENANT)
+    if isinstance(configured.get('default'), dict):
+        default.update(configured['default'])
+    tenants = {}
+    for key, options in configured.items():
+        if key != 'default' and isinstance(options, dict):
+            tenants[key] = dict(default, **options)
+    return default, tenants
+
+TENANT_DEFAULT, TENANTS = _load_tenants()
+
+def tenant_options(tenant):
+    """获取指定API密钥的调度配置"""
+    options = TENANTS.get(tenant, TENANT_DEFAULT)
+    return {
+        'weight': max(1, int(options['weight'])),
+        'max_size': options['max_size'],
+        'async_max_size': options.get('async_max_size', DEFAULT_TENANT['async_max_size'])
+    }
+
+def tenant_label(tenant):
+    """统计信息中显示的密钥名称，隐藏完整的API密钥"""
+    if tenant is None:
+        return 'internal'
+    # 附加摘要区分前缀相同的密钥
+    return f"{tenant[:4]}***{hashlib.sha1(tenant.encode('utf-8')).hexdigest()[:6]}"
+
+# 当前请求的队列选项（如截止时间、优先级通道、API密钥），由请求线程在处理请求前设置
+_request_context = threading.local()
+
+def set_request_context(deadline=None, lane=None):
+    """
+    设置当前请求线程的队列选项，请求内加入队列的所有任务都会使用
+
+    Args:
+        deadline: 绝对截止时间（时间戳），超过后任务不再执行
+        lane: 优先级通道，覆盖接口的默认通道
+    """
+    _request_context.deadline = deadline
+    _request_context.lane = lane if lane in LANES else None
+
+def set_request_tenant(tenant):
+    """设置当前请求所属的API密钥，在API密钥校验通过后调用"""
+    _request_context.tenant = tenant
+
+def clear_request_context():
+    """清除当前请求线程的队列选项"""
+    _request_context.__dict__.clear()
+
+def _tightest_deadline(*deadlines):
+    """取最早的截止时间，全部为空时返回None"""
+    values = [deadline for deadline in deadlines if deadline]
+    return min(values) if values else None
+
+# 接收人亲和重排窗口：只在队首之后这么多个任务里查找同一接收人的任务
+REORDER_WINDOW = 50
+
+# 同一接收人连续执行的最大任务数，超过后必须执行队首任务，避免其他接收人饿死
+MAX_AFFINITY_RUN = 20
+
+# 已打开聊天窗口的有效时间（秒），超时后重新调用ChatWith确认
+ACTIVE_CHAT_TTL = 30
+
+class _FairQueue:
+    """
+    单个优先级通道内按API密钥划分的子队列
+
+    各密钥的子队列按赤字轮询（DRR）出队：轮到某个密钥时补充与权重相等的额度，
+    每执行一个任务消耗1，额度用完后轮到下一个密钥。调用方需持有调度器的锁。
+    """
+
+    def __init__(self):
+        self._queues = {}
+        self._ring = deque()
+        self._deficit = {}
+        self.size = 0
+        self.async_size = 0
+
+    def append(self, task, left=False):
+        tenant = task['tenant']
+        tasks = self._queues.get(tenant)
+        if tasks is None:
+            tasks = self._queues[tenant] = deque()
+            self._ring.append(tenant)
+            self._deficit[tenant] = 0
+        if left:
+            tasks.appendleft(task)
+        else:
+            tasks.append(task)
+        self.size += 1
+        self.async_size += task['async_job']
+
+    def remove(self, task):
+        tasks = self._queues.get(task['tenant'])
+        if tasks is None:
+            raise ValueError('任务不在队列中')
+        tasks.remove(task)
+        self.size -= 1
+        self.async_size -= task['async_job']
+        if not tasks:
+            self._drop(task['tenant'])
+
+    def _drop(self, tenant):
+        """子队列为空时移出轮询，额度清零"""
+        del self._queues[tenant]
+        del self._deficit[tenant]
+        self._ring.remove(tenant)
+
+    def depth(self, tenant):
+        tasks = self._queues.get(tenant)
+        return len(tasks) if tasks else 0
+
+    def pop(self, last_affinity, allow_reorder):
+        """
+        取出下一个任务
+
+        Returns:
+            (任务, 是否因亲和性重排)
+        """
+        tenant = self._ring[0]
+        if self._deficit[tenant] <= 0:
+            self._deficit[tenant] = tenant_options(tenant)['weight']
+        tasks = self._queues[tenant]
+
+        index = 0
+        if last_affinity is not None and allow_reorder and tasks[0]['affinity'] != last_affinity:
+            # 在窗口内查找同一接收人最早的任务，保证该接收人的任务顺序不变
+            for i in range(1, min(REORDER_WINDOW, len(tasks))):
+                if tasks[i]['affinity'] == last_affinity:
+                    index = i
+                    break
+
+        if index:
+            task = tasks[index]
+            del tasks[index]
+        else:
+            task = tasks.popleft()
+        self.size -= 1
+        self.async_size -= task['async_job']
+
+        self._deficit[tenant] -= 1
+        if not tasks:
+            self._drop(tenant)
+        elif self._deficit[tenant] <= 0:
+            self._ring.rotate(-1)
+        return task, bool(index)
+
+    def __len__(self):
+        return self.size
+
+class TaskScheduler:
+    """
+    UI自动化任务调度队列
+
+    任务按优先级通道分开排队，通道之间按权重做平滑加权轮询，低优先级通道不会饿死。
+    通道内部再按API密钥分成子队列做赤字轮询，一个密钥的大量任务不会拖慢其他密钥。
+    子队列在FIFO的基础上按接收人亲和性重排：上一个任务是发给某个接收人时，
+    优先从重排窗口中取出同一接收人的下一个任务，让一次ChatWith服务连续多次发送。
+    同一接收人的任务始终保持先后顺序，连续执行次数受MAX_AFFINITY_RUN限制。
+    接收人的发送令牌不足时任务被暂缓，到可以发送时再放回队首，期间先执行其他任务。
+    """
+
+    def __init__(self):
+        self._lanes = {name: _FairQueue() for name in LANES}
+        self._lane_credit = {name: 0 for name in LANES}
+        self._tenant_depth = {}
+        # 排队中的异步任务数量（按API密钥），与同步请求分开做准入控制
+        self._async_depth = {}
+        # 排队中的操作数量（按API密钥，批量任务按units计），用于估算等待时间
+        self._tenant_units = {}
+        self._size = 0
+        self._deferred = []
+        self._cond = threading.Condition()
+        self._last_affinity = None
+        self._run_length = 0
+        self.reordered = 0
+        self.expired = 0
+        self.cancelled = 0
+        self.deferred = 0
+
+    def put(self, task):
+        """加入任务"""
+        with self._cond:
+            self._lanes[task['lane']].append(task)
+            self._count(task, 1)
+            self._size += 1
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """
+        取出下一个要执行的任务，超时抛出queue.Empty
+
+        已超过截止时间的任务直接标记为取消，不会交给执行线程
+        """
+        end_time = time.time() + timeout if timeout is not None else None
+        with self._cond:
+            while True:
+                now = time.time()
+                next_release = self._release_deferred(now)
+                if not self._size:
+                    waits = [wait for wait in (next_release, end_time - now if end_time else None)
+                             if wait is not None]
+                    if end_time is not None and now >= end_time:
+                        raise queue.Empty
+                    self._cond.wait(min(waits) if waits else None)
+                    continue
+
+                task = self._pop_next()
+                if task['deadline'] is not None and now > task['deadline'] and not task['retries']:
+                    self.expired += 1
+                    _mark_cancelled(task, '任务已超过截止时间，未执行')
+                    logger.debug(f"任务 {task['id']} 已超过截止时间，跳过执行")
+                    continue
+
+                # 亲和键即接收人，发送令牌不足时暂缓，先执行其他任务
+                if task['affinity'] is not None:
+                    delay = send_rate_limiter.delay(task['affinity'])
+                    if delay > 0:
+                        self._defer(task, now + delay)
+                        continue
+
+                # 在锁内切换为running，保证与取消操作互斥
+                task['status'] = 'running'
+                return task
+
+    def retry(self, task, ready_at):
+        """
+        将执行中返回RetryLater的任务放回暂缓队列
+
+        任务已经开始执行过，由任务函数自己处理截止时间，不再按截止时间过期，
+        以免部分完成的任务被丢弃；等待方超时后仍可取消
+        """
+        with self._cond:
+            task['status'] = 'pending'
+            task['retries'] += 1
+            self._defer(task, ready_at)
+            self._cond.notify()
+
+    def _defer(self, task, ready_at):
+        """暂缓任务直到ready_at（调用方需持有锁），任务仍计入所属API密钥的排队数量"""
+        heapq.heappush(self._deferred, (ready_at, task['id'], task))
+        self._count(task, 1)
+        self.deferred += 1
+
+    def _release_deferred(self, now):
+        """
+        将到期的暂缓任务放回队首（调用方需持有锁）
+
+        Returns:
+            距离下一个暂缓任务到期的秒数，没有暂缓任务时返回None
+        """
+        ready = []
+        while self._deferred and self._deferred[0][0] <= now:
+            ready.append(heapq.heappop(self._deferred)[2])
+        # 按任务编号倒序放回队首，同一接收人的任务保持原来的先后顺序
+        for task in sorted(ready, key=lambda task: task['id'], reverse=True):
+            self._lanes[task['lane']].append(task, left=True)
+            self._size += 1
+        return self._deferred[0][0] - now if self._deferred else None
+
+    def cancel(self, task, reason):
+        """取消仍在排队的任务，任务已开始执行或已结束时返回False"""
+        with self._cond:
+            if task['status'] != 'pending':
+                return False
+            deferred = [item for item in self._deferred if item[2] is task]
+            if deferred:
+                # 暂缓中的任务不在通道里，放回后按普通出队处理计数
+                self._deferred.remove(deferred[0])
+                heapq.heapify(self._deferred)
+                self._size += 1
+            else:
+                try:
+                    self._lanes[task['lane']].remove(task)
+                except ValueError:
+                    return False
+            self._taken(task)
+            self.cancelled += 1
+            _mark_cancelled(task, reason)
+            return True
+
+    def _taken(self, task):
+        """任务出队后更新计数（调用方需持有锁）"""
+        self._size -= 1
+        self._count(task, -1)
+
+    def _count(self, task, delta):
+        """更新任务所属API密钥的排队数量（调用方需持有锁）"""
+        counters = (self._tenant_depth, self._async_depth) if task['async_job'] else (self._tenant_depth,)
+        tenant = task['tenant']
+        for depths in counters:
+            depths[tenant] = depths.get(tenant, 0) + delta
+            if not depths[tenant]:
+                del depths[tenant]
+        units = self._tenant_units.get(tenant, 0) + delta * task['units']
+        if units:
+            self._tenant_units[tenant] = units
+        else:
+            self._tenant_units.pop(tenant, None)
+
+    def _pick_lane(self):
+        """平滑加权轮询选出下一个通道（调用方需持有锁）"""
+        total = 0
+        best = None
+        for name, tasks in self._lanes.items():
+            if not tasks:
+                # 空通道不累积权重，避免任务到来时集中抢占
+                self._lane_credit[name] = 0
+                continue
+            weight = LANES[name]['weight']
+            self._lane_credit[name] += weight
+            total += weight
+            if best is None or self._lane_credit[name] > self._lane_credit[best]:
+                best = name
+        self._lane_credit[best] -= total
+        return best
+
+    def _pop_next(self):
+        """按通道权重、密钥公平性和亲和性选出下一个任务（调用方需持有锁）"""
+        last = self._last_affinity
+        task, reordered = self._lanes[self._pick_lane()].pop(last, self._run_length < MAX_AFFINITY_RUN)
+        if reordered:
+            self.reordered += 1
+        self._taken(task)
+
+        affinity = task['affinity']
+        if affinity is not None and affinity == last:
+            self._run_length += 1
+        else:
+            self._last_affinity = affinity
+            self._run_length = 1
+        return task
+
+    def task_done(self):
+        """兼容queue.Queue接口"""
+        pass
+
+    def qsize(self, lane=None, async_jobs=None):
+        """
+        队列中等待的任务数量，指定lane时只统计该通道
+
+        Args:
+            async_jobs: True只统计异步任务，False只统计同步请求，None统计全部
+        """
+        with self._cond:
+            if lane is not None:
+                total, async_size = len(self._lanes[lane]), self._lanes[lane].async_size
+            else:
+                total, async_size = self._size + len(self._deferred), sum(self._async_depth.values())
+        if async_jobs is None:
+            return total
+        return async_size if async_jobs else total - async_size
+
+    def tenant_depths(self, async_jobs=None):
+        """各API密钥排队中的任务数量，async_jobs含义同qsize"""
+        with self._cond:
+            if async_jobs is None:
+                return dict(self._tenant_depth)
+            if async_jobs:
+                return dict(self._async_depth)
+            depths = {tenant: depth - self._async_depth.get(tenant, 0)
+                      for tenant, depth in self._tenant_depth.items()}
+            return {tenant: depth for tenant, depth in depths.items() if depth}
+
+    def tenant_units(self):
+        """各API密钥排队中的操作数量（同步请求和异步任务合计，批量任务按units计）"""
+        with self._cond:
+            return dict(self._tenant_units)
 
 # 全局请求队列
-request_queue = queue.Queue()
+request_queue = TaskScheduler()
 
 # 请求计数器
 request_counter = 0
 error_counter = 0
 
 # 队列处理线程数量
-WORKER_THREADS = 5
+# UI自动化只能串行执行，多个线程只会让ChatWith和SendMsg互相穿插，因此固定为1
+WORKER_THREADS = 1
 
 # 队列处理线程列表
 worker_threads = []
@@ -29,145 +484,650 @@
 # 锁，用于线程安全的计数器更新
 counter_lock = threading.Lock()
 
-def enqueue_request(func, *args, **kwargs):
+# 锁，保证任务完成回调只执行一次
+_callback_lock = threading.Lock()
+
+# 执行线程的线程标识，用于判断调用是否已经在执行线程中
+_executor_ident = None
+
+# 执行线程当前打开的聊天窗口及最后一次使用时间，只在执行线程中读写
+_active_chat = None
+_active_chat_time = 0
+
+# 因窗口已打开而省去的ChatWith次数
+chat_switches_saved = 0
+
+# 直接调用执行线程时的默认等待时间（秒）
+EXECUTOR_CALL_TIMEOUT = 120
+
+# 最近任务的等待耗时和执行耗时样本（秒）
+TIMING_SAMPLES = 200
+_wait_times = deque(maxlen=TIMING_SAMPLES)
+_exec_times = deque(maxlen=TIMING_SAMPLES)
+_lane_wait_times = {name: deque(maxlen=TIMING_SAMPLES) for name in LANES}
+
+# 各API密钥的统计：等待耗时、端到端耗时样本以及准入/拒绝计数
+_tenant_stats = {}
+
+def _tenant_stat(tenant):
+    """获取API密钥的统计记录（调用方需持有counter_lock）"""
+    stat = _tenant_stats.get(tenant)
+    if stat is None:
+        stat = _tenant_stats[tenant] = {
+            'wait_times': deque(maxlen=TIMING_SAMPLES),
+            'latencies': deque(maxlen=TIMING_SAMPLES),
+            'admitted': 0,
+            'rejected': 0
+        }
+    return stat
+
+# 准入控制计数
+admitted_counter = 0
+rejected_counter = 0
+
+# 异步任务表：job_id -> 任务，按提交顺序保存
+_jobs = OrderedDict()
+jobs_lock = threading.Lock()
+_last_job_purge = 0
+
+# 异步任务表最多保存的任务数量
+JOB_TABLE_SIZE = 10000
+
+# 异步任务完成后结果的保留时间（秒）
+JOB_TTL = 600
+
+def is_executor_thread():
+    """判断当前线程是否为UI自动化执行线程"""
+    return _executor_ident is not None and threading.get_ident() == _executor_ident
+
+def is_chat_active(receiver):
     """
-    将请求加入队列
-    
+    判断执行线程中是否已经打开了指定接收人的聊天窗口
+
+    只有上一个执行的任务就是发给同一接收人且未超时时才返回True，
+    调用方可以据此跳过ChatWith
+    """
+    global chat_switches_saved
+
+    if not is_executor_thread() or _active_chat is None or _active_chat != receiver:
+        return False
+    if time.time() - _active_chat_time > ACTIVE_CHAT_TTL:
+        return False
+
+    with counter_lock:
+        chat_switches_saved += 1
+    return True
+
+def set_active_chat(receiver):
+    """记录执行线程当前打开的聊天窗口，传入None表示窗口状态未知"""
+    global _active_chat, _active_chat_time
+
+    if not is_executor_thread():
+        return
+    _active_chat = receiver
+    _active_chat_time = time.time()
+
+def mean_exec_time():
+    """最近任务的平均执行时间（秒）"""
+    with counter_lock:
+        samples = list(_exec_times)
+    if not samples:
+        return DEFAULT_EXEC_TIME
+    return sum(samples) / len(samples)
+
+def estimate_wait():
+    """按排队中的操作数量 × 最近单个操作的平均执行时间估算新任务的等待时间（秒）"""
+    return sum(request_queue.tenant_units().values()) * mean_exec_time()
+
+def estimate_tenant_wait(tenant, depths=None, units=None):
+    """
+    按公平调度估算指定API密钥新任务的等待时间（秒）
+
+    其他密钥最多只能按权重比例插在该密钥的任务之间，
+    因此一个密钥积压大量任务不会抬高其他密钥的预估等待时间。
+    同步请求和异步任务在同一调度中轮询执行，两者的积压都计入；
+    批量任务按units折算，一个任务包含多少条操作就计多少份执行时间
+    """
+    if depths is None:
+        depths = request_queue.tenant_depths()
+    if units is None:
+        units = request_queue.tenant_units()
+    weight = tenant_options(tenant)['weight']
+    rounds = depths.get(tenant, 0) + 1
+    ahead = units.get(tenant, 0)
+    for other, depth in depths.items():
+        if other != tenant:
+            # 轮询按任务数分配，插队的操作数量按该密钥任务的平均units折算
+            other_units = units.get(other, depth)
+            ahead += min(other_units, rounds * tenant_options(other)['weight'] / weight * other_units / depth)
+    return ahead * mean_exec_time()
+
+def _admit(lane, tenant, async_job=False):
+    """
+    准入控制：队列、通道或API密钥的配额已满，或预估等待时间超过上限时抛出QueueFullError
+
+    同步请求和异步任务的排队数量分开计算：同步请求的请求线程要等待结果，按QUEUE_MAX_WAIT限制等待时间；
+    异步任务按ASYNC_JOB_DEADLINE限制，数量受ASYNC_QUEUE_MAX_SIZE和密钥的async_max_size限制，不受通道上限限制。
+    Retry-After按积压任务需要多久才能回落到限制以内来计算
+    """
+    global admitted_counter, rejected_counter
+
+    options = tenant_options(tenant)
+    depth = request_queue.qsize(async_jobs=async_job)
+    lane_depth = request_queue.qsize(lane, async_jobs=async_job)
+    lane_max_size = LANES[lane]['max_size']
+    tenant_depth = request_queue.tenant_depths(async_jobs=async_job).get(tenant, 0)
+    exec_time = mean_exec_time()
+    if async_job:
+        max_size, tenant_max_size, max_wait = ASYNC_QUEUE_MAX_SIZE, options['async_max_size'], ASYNC_JOB_DEADLINE
+    else:
+        max_size, tenant_max_size, max_wait = QUEUE_MAX_SIZE, options['max_size'], QUEUE_MAX_WAIT
+    # 数量上限分开计算，但同步请求和异步任务共用执行线程，预估等待时间按全部积压（含批量任务的units）计算
+    estimated_wait = estimate_tenant_wait(tenant)
+
+    retry_after = None
+    if depth >= max_size:
+        retry_after = (depth - max_size + 1) * exec_time
+        reason = f"队列已满（{depth}/{max_size}）"
+    elif tenant_depth >= tenant_max_size:
+        retry_after = estimated_wait - (tenant_max_size - 1) * exec_time
+        reason = f"API密钥排队任务过多（{tenant_depth}/{tenant_max_size}）"
+    elif not async_job and lane_depth >= lane_max_size:
+        # 通道按权重分到执行时间，积压回落需要的时间按其份额放大
+        share = LANES[lane]['weight'] / sum(options['weight'] for options in LANES.values())
+        retry_after = (lane_depth - lane_max_size + 1) * exec_time / share
+        reason = f"{lane}通道已满（{lane_depth}/{lane_max_size}）"
+    elif estimated_wait > max_wait:
+        retry_after = estimated_wait - max_wait
+        reason = f"预估等待时间过长（{estimated_wait:.1f}秒 > {max_wait}秒）"
+
+    with counter_lock:
+        stat = _tenant_stat(tenant)
+        if retry_after is None:
+            admitted_counter += 1
+            stat['admitted'] += 1
+            return
+        rejected_counter += 1
+        stat['rejected'] += 1
+
+    raise QueueFullError(f"任务未被接受: {reason}", max(1, math.ceil(retry_after)))
+
+def enqueue_task(func, args=(), kwargs=None, affinity=None, admission=True, deadline=None, lane=None, units=1,
+                 async_job=False):
+    """
+    将任务加入队列
+
     Args:
         func: 要执行的函数
         args: 位置参数
         kwargs: 关键字参数
-        
+        affinity: 亲和键（通常是接收人），相同亲和键的任务会尽量连续执行
+        admission: 是否进行准入控制，内部调用（如适配器方法）不受容量限制
+        deadline: 绝对截止时间（时间戳），与请求上下文中的截止时间取较早者
+        lane: 优先级通道，请求上下文中指定的通道优先
+        units: 任务包含的操作数量（如批量发送的条数），执行耗时按单个操作折算后计入统计
+        async_job: 是否为异步任务，异步任务使用单独的准入限制
+
     Returns:
-        任务ID
+        任务字典
     """
     global request_counter
-    
+
+    lane = getattr(_request_context, 'lane', None) or resolve_lane(lane)
+    tenant = getattr(_request_context, 'tenant', None)
+
+    if admission:
+        _admit(lane, tenant, async_job)
+
     with counter_lock:
         request_counter += 1
         task_id = request_counter
-        
+
     # 创建任务
     task = {
         'id': task_id,
         'func': func,
         'args': args,
-        'kwargs': kwargs,
-        'result_queue': queue.Queue(),
-        'timestamp': time.time()
+        'kwargs': kwargs or {},
+        'affinity': affinity,
+        'lane': lane,
+        'tenant': tenant,
+        'units': max(1, units),
+        'async_job': bool(async_job),
+        'deadline': _tightest_deadline(deadline, getattr(_request_context, 'deadline', None)),
+        'done': threading.Event(),
+        'status': 'pending',
+        'retries': 0,
+        'result': None,
+        'error': None,
+        'timestamp': time.time(),
+        'finished_at': None,
+        'wait_time': None,
+        'exec_time': None
     }
-    
+
     # 加入队列
     request_queue.put(task)
     logger.debug(f"任务 {task_id} 已加入队列")
-    
+
     return task
 
-def queue_processor():
-    """队列处理线程函数"""
-    global error_counter
-    
-    logger.info("队列处理线程已启动")
-    
-    while queue_running:
+def enqueue_request(func, *args, **kwargs):
+    """
+    将请求加入队列
+
+    Args:
+        func: 要执行的函数
+        args: 位置参数
+        kwargs: 关键字参数
+
+    Returns:
+        任务字典
+    """
+    return enqueue_task(func, args, kwargs)
+
+def _mark_cancelled(task, reason):
+    """将任务标记为已取消并唤醒等待者"""
+    task['status'] = 'cancelled'
+    task['error'] = reason
+    task['finished_at'] = time.time()
+    _finish_task(task)
+
+def _finish_task(task):
+    """唤醒等待者并执行任务完成回调"""
+    with _callback_lock:
+        task['done'].set()
+        callbacks = task.pop('callbacks', [])
+    for callback in callbacks:
         try:
-            # 从队列获取任务，超时1秒
-            try:
-                task = request_queue.get(timeout=1)
-            except queue.Empty:
-                continue
-                
-            # 处理任务
+            callback(task)
+        except Exception as e:
+            logger.error(f"任务 {task['id']} 完成回调执行失败: {str(e)}")
+
+def add_done_callback(task, callback):
+    """
+    注册任务完成（成功、失败或取消）后的回调，任务已完成时立即调用
+
+    回调在完成任务的线程（通常是执行线程）中运行，不能阻塞
+    """
+    with _callback_lock:
+        if not task['done'].is_set():
+            task.setdefault('callbacks', []).append(callback)
+            return
+    callback(task)
+
+def cancel_task(task, reason='任务已被取消'):
+    """
+    取消仍在排队的任务
+
+    Returns:
+        bool: 是否取消成功，任务已开始执行或已结束时返回False
+    """
+    return request_queue.cancel(task, reason)
+
+def wait_task(task, timeout):
+    """
+    等待任务执行完成
+
+    等待超时时会取消仍在排队的任务，避免调用方已经失败的任务之后仍被执行
+
+    Args:
+        task: enqueue_request返回的任务
+        timeout: 超时时间（秒）
+
+    Returns:
+        任务函数的返回值
+    """
+    if not task['done'].wait(timeout):
+        if cancel_task(task, '调用方等待超时，任务已取消'):
+            raise TimeoutError(f"任务 {task['id']} 处理超时，已从队列中取消")
+        raise TimeoutError(f"任务 {task['id']} 处理超时")
+    if task['status'] in ('error', 'cancelled'):
+        raise Exception(task['error'])
+    return task['result']
+
+def _run_task(task):
+    """在执行线程中运行单个任务并记录耗时"""
+    global error_counter
+
+    # 没有亲和键或亲和键不同的任务可能切换窗口，之前打开的聊天窗口不再可信
+    if task['affinity'] is None or task['affinity'] != _active_chat:
+        set_active_chat(None)
+
+    started = time.time()
+    task['wait_time'] = started - task['timestamp']
+    retry = None
+    try:
+        logger.debug(f"处理任务 {task['id']}")
+        result = task['func'](*task['args'], **task['kwargs'])
+        if isinstance(result, RetryLater):
+            retry = result
+        else:
+            task['result'] = result
+            task['status'] = 'success'
+    except Exception as e:
+        set_active_chat(None)
+        with counter_lock:
+            error_counter += 1
+        logger.error(f"任务 {task['id']} 处理失败: {str(e)}")
+        logger.debug(traceback.format_exc())
+        task['error'] = str(e)
+        task['status'] = 'error'
+    finally:
+        if retry is not None:
+            # 暂时不能继续执行，放回暂缓队列，不占用执行线程等待，也不计入执行耗时统计
+            logger.debug(f"任务 {task['id']} 暂缓 {retry.delay:.2f} 秒后重新执行")
+            request_queue.retry(task, time.time() + retry.delay)
+        else:
+            _complete_task(task, started)
+
+def _complete_task(task, started):
+    """记录任务耗时并唤醒等待者"""
+    task['finished_at'] = time.time()
+    task['exec_time'] = task['finished_at'] - started
+    with counter_lock:
+        _wait_times.append(task['wait_time'])
+        # 批量任务按单个操作折算，避免拉高准入控制使用的平均执行时间
+        _exec_times.append(task['exec_time'] / task['units'])
+        _lane_wait_times[task['lane']].append(task['wait_time'])
+        stat = _tenant_stat(task['tenant'])
+        stat['wait_times'].append(task['wait_time'])
+        stat['latencies'].append(task['finished_at'] - task['timestamp'])
+    logger.debug(f"任务 {task['id']} 完成，等待 {task['wait_time']:.3f}秒，执行 {task['exec_time']:.3f}秒")
+    _finish_task(task)
+
+def queue_processor():
+    """队列处理线程函数，整个生命周期只初始化一次COM环境"""
+    global error_counter, _executor_ident
+
+    _executor_ident = threading.get_ident()
+    if pythoncom:
+        pythoncom.CoInitialize()
+
+    logger.info("UI自动化执行线程已启动")
+
+    try:
+        while queue_running:
             try:
-                logger.debug(f"处理任务 {task['id']}")
-                result = task['func'](*task['args'], **task['kwargs'])
-                task['result_queue'].put(('success', result))
+                # 从队列获取任务，超时1秒
+                try:
+                    task = request_queue.get(timeout=1)
+                except queue.Empty:
+                    continue
+
+                try:
+                    _run_task(task)
+                finally:
+                    request_queue.task_done()
+
             except Exception as e:
                 with counter_lock:
                     error_counter += 1
-                logger.error(f"任务 {task['id']} 处理失败: {str(e)}")
+                logger.error(f"队列处理线程异常: {str(e)}")
                 logger.debug(traceback.format_exc())
-                task['result_queue'].put(('error', str(e)))
-            finally:
-                request_queue.task_done()
-                
-        except Exception as e:
-            with counter_lock:
-                error_counter += 1
-            logger.error(f"队列处理线程异常: {str(e)}")
-            logger.debug(traceback.format_exc())
-            
-    logger.info("队列处理线程已停止")
+    finally:
+        if pythoncom:
+            pythoncom.CoUninitialize()
+        _executor_ident = None
+
+    logger.info("UI自动化执行线程已停止")
 
 def start_queue_processors():
     """启动队列处理线程"""
     global queue_running, worker_threads
-    
+
     if queue_running:
         return
-        
+
     queue_running = True
     worker_threads = []
-    
-    # 创建并启动工作线程
+
+    # 创建并启动执行线程
     for i in range(WORKER_THREADS):
         thread = threading.Thread(target=queue_processor, daemon=True, name=f"QueueProcessor-{i}")
         thread.start()
         worker_threads.append(thread)
-        
+
     logger.info(f"已启动 {WORKER_THREADS} 个队列处理线程")
 
 def stop_queue_processors():
     """停止队列处理线程"""
     global queue_running
-    
+
     if not queue_running:
         return
-        
+
     queue_running = False
-    
+
     # 等待所有线程结束
     for thread in worker_threads:
         thread.join(timeout=2)
-        
+
     logger.info("所有队列处理线程已停止")
 
-def queue_task(timeout=30):
+def run_in_executor(func, args=(), kwargs=None, timeout=EXECUTOR_CALL_TIMEOUT, lane=None, affinity=None):
+    """
+    在执行线程中运行函数并等待结果
+
+    已经在执行线程中时直接调用，避免自己等待自己造成死锁
+
+    Args:
+        func: 要执行的函数
+        args: 位置参数
+        kwargs: 关键字参数
+        timeout: 超时时间（秒）
+        lane: 优先级通道
+        affinity: 亲和键（发送方法的接收人），接收人的发送令牌不足时任务先暂缓
+
+    Returns:
+        函数返回值
+    """
+    kwargs = kwargs or {}
+    if is_executor_thread() or not queue_running:
+        return func(*args, **kwargs)
+
+    task = enqueue_task(func, args, kwargs, affinity=affinity, admission=False, deadline=time.time() + timeout,
+                        lane=lane)
+    return wait_task(task, timeout)
+
+def _purge_jobs(now):
+    """清理过期和超出容量的已完成任务（调用方需持有jobs_lock）"""
+    global _last_job_purge
+
+    # 全表扫描最多每秒一次，容量超限时立即清理
+    if now - _last_job_purge < 1 and len(_jobs) <= JOB_TABLE_SIZE:
+        return
+    _last_job_purge = now
+
+    for job_id in list(_jobs.keys()):
+        finished_at = _jobs[job_id]['finished_at']
+        if finished_at is not None and now - finished_at > JOB_TTL:
+            del _jobs[job_id]
+
+    # 仍然超出容量时，从最早提交的任务开始淘汰
+    while len(_jobs) > JOB_TABLE_SIZE:
+        _jobs.popitem(last=False)
+
+def submit_job(func, args=(), kwargs=None, affinity=None, lane=None, units=1):
+    """
+    以异步方式提交任务，立即返回，不等待执行结果
+
+    Args:
+        func: 要执行的函数
+        args: 位置参数
+        kwargs: 关键字参数
+        affinity: 亲和键（通常是接收人）
+        lane: 优先级通道
+        units: 任务包含的操作数量
+
+    Returns:
+        任务字典，包含job_id
+    """
+    task = enqueue_task(func, args, kwargs, affinity=affinity,
+                        deadline=time.time() + ASYNC_JOB_DEADLINE, lane=lane, units=units, async_job=True)
+    task['job_id'] = uuid.uuid4().hex
+
+    with jobs_lock:
+        _jobs[task['job_id']] = task
+        _purge_jobs(time.time())
+
+    logger.debug(f"任务 {task['id']} 已作为异步任务提交，job_id: {task['job_id']}")
+    return task
+
+def get_job(job_id):
+    """根据job_id获取异步任务，不存在或已过期时返回None"""
+    with jobs_lock:
+        _purge_jobs(time.time())
+        return _jobs.get(job_id)
+
+def job_to_dict(task):
+    """将异步任务转换为可序列化的状态字典"""
+    def to_ms(value):
+        return round(value * 1000, 2) if value is not None else None
+
+    return {
+        'job_id': task.get('job_id'),
+        'status': task['status'],
+        'lane': task['lane'],
+        'result': task['result'],
+        'error': task['error'],
+        'submitted_at': task['timestamp'],
+        'deadline': task['deadline'],
+        'finished_at': task['finished_at'],
+        'wait_time_ms': to_ms(task['wait_time']),
+        'exec_time_ms': to_ms(task['exec_time'])
+    }
+
+def queue_task(timeout=30, affinity=None, lane=DEFAULT_LANE):
     """
     将API请求加入队列的装饰器
-    
+
     Args:
         timeout: 超时时间（秒）
-        
+        affinity: 作为亲和键的参数名（例如'receiver'），相同值的任务会尽量连续执行
+        lane: 接口的默认优先级通道，可被请求头X-Queue-Lane覆盖
+
     Returns:
         装饰器函数
     """
     def decorator(func):
+        signature = inspect.signature(func)
+
+        def get_affinity(args, kwargs):
+            if not affinity:
+                return None
+            return signature.bind(*args, **kwargs).arguments.get(affinity)
+
         @wraps(func)
         def wrapper(*args, **kwargs):
-            # 将请求加入队列
-            task = enqueue_request(func, *args, **kwargs)
-            
-            # 等待结果
-            try:
-                result_type, result = task['result_queue'].get(timeout=timeout)
-                if result_type == 'error':
-                    raise Exception(result)
-                return result
-            except queue.Empty:
-                raise TimeoutError(f"任务 {task['id']} 处理超时")
-                
+            # 已在执行线程中（例如被其他队列任务调用）时直接执行
+            if is_executor_thread():
+                return func(*args, **kwargs)
+
+            # 将请求加入队列并等待结果
+            # 调用方最多等待timeout秒，超过后任务即使还在排队也没有意义
+            return wait_task(enqueue(*args, **kwargs), timeout)
+
+        # 入队入口：返回任务，由调用方通过wait_task等待结果
+        def enqueue(*args, **kwargs):
+            return enqueue_task(func, args, kwargs, affinity=get_affinity(args, kwargs),
+                                deadline=time.time() + timeout, lane=lane)
+
+        # 异步提交入口：立即返回任务，不占用请求线程等待
+        def submit(*args, **kwargs):
+            return submit_job(func, args, kwargs, affinity=get_affinity(args, kwargs), lane=lane)
+
+        wrapper.enqueue = enqueue
+        wrapper.submit = submit
+        wrapper.timeout = timeout
         return wrapper
     return decorator
 
+def timing_summary(samples):
+    """计算耗时样本的统计值（毫秒）"""
+    if not samples:
+        return {'avg_ms': 0, 'p95_ms': 0, 'max_ms': 0, 'samples': 0}
+    ordered = sorted(samples)
+    p95_index = min(len(ordered) - 1, int(len(ordered) * 0.95))
+    return {
+        'avg_ms': round(sum(ordered) / len(ordered) * 1000, 2),
+        'p95_ms': round(ordered[p95_index] * 1000, 2),
+        'max_ms': round(ordered[-1] * 1000, 2),
+        'samples': len(ordered)
+    }
+
 def get_queue_stats():
     """获取队列统计信息"""
+    with counter_lock:
+        wait_times = list(_wait_times)
+        exec_times = list(_exec_times)
+        lane_wait_times = {name: list(samples) for name, samples in _lane_wait_times.items()}
+        tenant_stats = {
+            tenant: {
+                'wait_times': list(stat['wait_times']),
+                'latencies': list(stat['latencies']),
+                'admitted': stat['admitted'],
+                'rejected': stat['rejected']
+            }
+            for tenant, stat in _tenant_stats.items()
+        }
+
+    depths = request_queue.tenant_depths()
+    async_depths = request_queue.tenant_depths(async_jobs=True)
+    tenants = {}
+    for tenant in set(tenant_stats) | set(depths):
+        stat = tenant_stats.get(tenant, {'wait_times': [], 'latencies': [], 'admitted': 0, 'rejected': 0})
+        options = tenant_options(tenant)
+        tenants[tenant_label(tenant)] = {
+            'queue_size': depths.get(tenant, 0),
+            'async_queue_size': async_depths.get(tenant, 0),
+            'max_size': options['max_size'],
+            'async_max_size': options['async_max_size'],
+            'weight': options['weight'],
+            'admitted_count': stat['admitted'],
+            'rejected_count': stat['rejected'],
+            'wait_time': timing_summary(stat['wait_times']),
+            'latency': timing_summary(stat['latencies'])
+        }
+
+    lanes = {}
+    for name, options in LANES.items():
+        lanes[name] = {
+            'queue_size': request_queue.qsize(name),
+            'max_size': options['max_size'],
+            'weight': options['weight'],
+            'wait_time': timing_summary(lane_wait_times[name])
+        }
+
     return {
         'queue_size': request_queue.qsize(),
+        'max_queue_size': QUEUE_MAX_SIZE,
+        'max_wait': QUEUE_MAX_WAIT,
+        'async_queue_size': request_queue.qsize(async_jobs=True),
+        'max_async_queue_size': ASYNC_QUEUE_MAX_SIZE,
+        'async_max_wait': ASYNC_JOB_DEADLINE,
+        'estimated_wait': round(estimate_wait(), 2),
         'request_count': request_counter,
+        'admitted_count': admitted_counter,
+        'rejected_count': rejected_counter,
         'error_count': error_counter,
+        'expired_count': request_queue.expired,
+        'cancelled_count': request_queue.cancelled,
         'worker_threads': len(worker_threads),
-        'queue_running': queue_running
+        'queue_running': queue_running,
+        'executor_alive': any(thread.is_alive() for thread in worker_threads),
+        'job_count': len(_jobs),
+        'affinity': {
+            'reorder_window': REORDER_WINDOW,
+            'max_run': MAX_AFFINITY_RUN,
+            'reordered_tasks': request_queue.reordered,
+            'chat_switches_saved': chat_switches_saved
+        },
+        'rate_limit': dict(send_rate_limiter.levels(), deferred_tasks=request_queue.deferred),
+        'wait_time': timing_summary(wait_times),
+        'exec_time': timing_summary(exec_times),
+        'lanes': lanes,
+        'tenants': tenants
     }
 
 # 启动队列处理器
@@ -1,6 +1,7 @@
 from functools import wraps
 from flask import request, jsonify
 from app.config import Config
+from app.api_queue import set_request_tenant
 
 def require_api_key(f):
     @wraps(f)
@@ -22,5 +23,8 @@ def decorated_function(*args, **kwargs):
                 'data': None
             }), 401
 
+        # 请求中加入队列的任务按API密钥公平调度
+        set_request_tenant(api_key)
+
         return f(*args, **kwargs)
     return decorated_function
\ No newline at end of file
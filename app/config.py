@@ -33,6 +33,36 @@ class Config:
         # Flask配置
         PORT = app_config.get('port', 5000)
 
+        # 请求队列准入控制配置
+        QUEUE_MAX_SIZE = app_config.get('queue_max_size', 1000)
+        QUEUE_MAX_WAIT = app_config.get('queue_max_wait', 120)
+        QUEUE_LANES = app_config.get('queue_lanes', {})
+        QUEUE_TENANTS = app_config.get('queue_tenants', {})
+        ASYNC_QUEUE_MAX_SIZE = app_config.get('async_queue_max_size', 5000)
+
+        # 发送接口幂等记录配置
+        IDEMPOTENCY_TTL = app_config.get('idempotency_ttl', 86400)
+        IDEMPOTENCY_MAX_ENTRIES = app_config.get('idempotency_max_entries', 10000)
+        IDEMPOTENCY_PERSIST = app_config.get('idempotency_persist', False)
+
+        # 发送速率限制配置
+        SEND_RATE_LIMIT = app_config.get('send_rate_limit', {})
+
+        # 新消息Webhook推送配置
+        WEBHOOKS = app_config.get('webhooks', [])
+
+        # 监听消息日志配置
+        LISTEN_BUFFER = app_config.get('listen_buffer', {})
+
+        # 消息存储配置
+        MESSAGE_STORE = app_config.get('message_store', {})
+
+        # 消息去重配置
+        MESSAGE_DEDUP = app_config.get('message_dedup', {})
+
+        # 新消息后台轮询配置
+        MESSAGE_POLLER = app_config.get('message_poller', {})
+
         # 微信库选择配置
         configured_lib = app_config.get('wechat_lib', 'wxauto').lower()
 
@@ -59,15 +89,42 @@ class Config:
         # 如果无法导入config_manager，则使用默认值
         PORT = 5000
         WECHAT_LIB = 'wxauto'
+        QUEUE_MAX_SIZE = 1000
+        QUEUE_MAX_WAIT = 120
+        QUEUE_LANES = {}
+        QUEUE_TENANTS = {}
+        ASYNC_QUEUE_MAX_SIZE = 5000
+        IDEMPOTENCY_TTL = 86400
+        IDEMPOTENCY_MAX_ENTRIES = 10000
+        IDEMPOTENCY_PERSIST = False
+        SEND_RATE_LIMIT = {}
+        WEBHOOKS = []
+        LISTEN_BUFFER = {}
+        MESSAGE_STORE = {}
+        MESSAGE_DEDUP = {}
+        MESSAGE_POLLER = {}
+
+    # API密钥缓存：(配置文件修改时间, 密钥列表)
+    _api_keys_cache = (None, None)
 
     @staticmethod
     def get_api_keys():
-        """动态获取API密钥列表"""
+        """动态获取API密钥列表，配置文件修改后自动重新加载"""
         if config_manager:
             try:
-                # 每次都重新加载配置文件以获取最新的API密钥
+                # 每个请求都会校验密钥，只在配置文件修改时间变化时重新读取文件
+                try:
+                    mtime = config_manager.APP_CONFIG_FILE.stat().st_mtime_ns
+                except OSError:
+                    mtime = None
+                cached_mtime, cached_keys = Config._api_keys_cache
+                if mtime is not None and mtime == cached_mtime:
+                    return cached_keys
+
                 app_config = config_manager.load_app_config()
-                return app_config.get('api_keys', ['test-key-2'])
+                keys = app_config.get('api_keys', ['test-key-2'])
+                Config._api_keys_cache = (mtime, keys)
+                return keys
             except Exception:
                 # 如果加载失败，使用默认值
                 return ['test-key-2']
@@ -105,7 +162,8 @@ def get_current_log_file():
         return str(Config.LOGS_DIR / log_filename)
 
     # 微信监控配置
-    WECHAT_CHECK_INTERVAL = 60  # 连接检查间隔（秒）
+    WECHAT_CHECK_INTERVAL = 60  # 连接正常时的最长检查间隔（秒）
+    WECHAT_CHECK_MIN_INTERVAL = 10  # 重连后的检查间隔（秒），连接保持正常时逐渐增大到WECHAT_CHECK_INTERVAL
     WECHAT_AUTO_RECONNECT = True  # 自动重连
     WECHAT_RECONNECT_DELAY = 30  # 重连延迟（秒）
     WECHAT_MAX_RETRY = 3  # 最大重试次数
@@ -38,7 +38,50 @@ def ensure_dirs():
     "port": 5000,
     "wechat_lib": "wxauto",
     "auto_start_enabled": False,
-    "auto_start_countdown": 5
+    "auto_start_countdown": 5,
+    "queue_max_size": 1000,
+    "queue_max_wait": 120,
+    "queue_lanes": {
+        "interactive": {"weight": 6, "max_size": 200},
+        "bulk": {"weight": 3, "max_size": 1000},
+        "background": {"weight": 1, "max_size": 200}
+    },
+    "queue_tenants": {
+        "default": {"weight": 1, "max_size": 500, "async_max_size": 2000}
+    },
+    "async_queue_max_size": 5000,
+    "idempotency_ttl": 86400,
+    "idempotency_max_entries": 10000,
+    "idempotency_persist": False,
+    "send_rate_limit": {
+        "enabled": True,
+        "global": {"rate": 2.0, "burst": 20},
+        "receiver": {"rate": 0.5, "burst": 10}
+    },
+    "webhooks": [],
+    "listen_buffer": {
+        "max_messages": 1000,
+        "overflow": "drop_oldest"
+    },
+    "message_store": {
+        "enabled": True,
+        "retention_days": 90
+    },
+    "message_dedup": {
+        "enabled": True,
+        "lru_size": 10000,
+        "bloom_capacity": 200000,
+        "error_rate": 0.001,
+        "content_window": 300
+    },
+    "message_poller": {
+        "enabled": True,
+        "min_interval": 0.5,
+        "max_interval": 10,
+        "backoff": 2.0,
+        "idle_timeout": 300,
+        "filter_mute": False
+    }
 }
 
 def load_log_filter_config(force_defaults=False):
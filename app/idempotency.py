@@ -0,0 +1,303 @@
+"""
+发送接口的幂等处理
+客户端通过Idempotency-Key请求头重试时，返回首次请求的结果，或等待仍在处理中的首次请求，
+避免同一条消息被重复发送
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import request, jsonify, make_response, g, Response
+from app.unified_logger import logger
+from app.config import Config
+
+# 幂等记录最多保存的数量，超过后淘汰最久未使用的记录
+IDEMPOTENCY_MAX_ENTRIES = Config.IDEMPOTENCY_MAX_ENTRIES
+
+# 幂等记录的保留时间（秒）
+IDEMPOTENCY_TTL = Config.IDEMPOTENCY_TTL
+
+# 重复请求等待首次请求完成的最长时间（秒），超过后返回409
+IDEMPOTENCY_WAIT = 60
+
+# 扫描清理过期记录的最短间隔（秒）
+IDEMPOTENCY_PURGE_INTERVAL = 1
+
+# 持久化文件，启用后服务重启也能识别已发送过的请求
+IDEMPOTENCY_FILE = Config.API_DIR / "idempotency.jsonl"
+
+class IdempotencyConflict(Exception):
+    """同一个Idempotency-Key被用于内容不同的请求"""
+
+class IdempotencyStore:
+    """
+    Idempotency-Key到请求结果的LRU+TTL映射
+
+    记录状态：pending（首次请求处理中）、done（已保存结果）、released（首次请求未执行，允许重新执行）
+    """
+
+    def __init__(self, max_entries=IDEMPOTENCY_MAX_ENTRIES, ttl=IDEMPOTENCY_TTL, persist_path=None):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._persist_path = persist_path
+        self._persisted_lines = 0
+        self._last_purge = 0
+        self.hits = 0
+        self.misses = 0
+        self.conflicts = 0
+
+        if persist_path:
+            self._load()
+
+    def reserve(self, scope, fingerprint):
+        """
+        为请求占用幂等记录
+
+        Returns:
+            (记录, 是否为新建的记录)，新建时调用方负责执行请求并调用complete或release
+        """
+        now = time.time()
+        with self._lock:
+            self._purge(now)
+            entry = self._entries.get(scope)
+            if entry is not None and entry['status'] == 'done' and entry['expires_at'] < now:
+                # 已过期的记录视为不存在，请求重新执行
+                del self._entries[scope]
+                entry = None
+            if entry is not None and entry['status'] != 'released':
+                if entry['fingerprint'] != fingerprint:
+                    self.conflicts += 1
+                    raise IdempotencyConflict(scope)
+                self._entries.move_to_end(scope)
+                self.hits += 1
+                return entry, False
+
+            entry = {
+                'scope': scope,
+                'fingerprint': fingerprint,
+                'status': 'pending',
+                'body': None,
+                'status_code': None,
+                'mimetype': None,
+                'expires_at': now + self._ttl,
+                'done': threading.Event()
+            }
+            self._entries[scope] = entry
+            self.misses += 1
+            return entry, True
+
+    def complete(self, entry, body, status_code, mimetype='application/json'):
+        """保存请求结果并唤醒等待中的重复请求，记录已完成时忽略"""
+        with self._lock:
+            if entry['status'] != 'pending':
+                return
+            entry['body'] = body
+            entry['status_code'] = status_code
+            entry['mimetype'] = mimetype
+            entry['status'] = 'done'
+            entry['done'].set()
+        self._persist(entry)
+
+    def release(self, entry):
+        """首次请求没有执行（如被拒绝或取消），删除记录，之后的重试会重新执行"""
+        with self._lock:
+            if entry['status'] != 'pending':
+                return
+            entry['status'] = 'released'
+            if self._entries.get(entry['scope']) is entry:
+                del self._entries[entry['scope']]
+            entry['done'].set()
+
+    def _purge(self, now):
+        """清理过期和超出数量的记录（调用方需持有锁），处理中的记录不会被淘汰"""
+        # 命中的记录会移到末尾，记录按最近使用而不是过期时间排序，过期记录需要全表扫描，最多每秒一次
+        if now - self._last_purge >= IDEMPOTENCY_PURGE_INTERVAL:
+            self._last_purge = now
+            expired = [scope for scope, entry in self._entries.items()
+                       if entry['expires_at'] < now and entry['status'] != 'pending']
+            for scope in expired:
+                del self._entries[scope]
+
+        # 仍然超出数量时，从最久未使用的记录开始淘汰
+        if len(self._entries) > self._max_entries:
+            for scope in list(self._entries):
+                if len(self._entries) <= self._max_entries:
+                    break
+                if self._entries[scope]['status'] != 'pending':
+                    del self._entries[scope]
+
+    def _persist(self, entry):
+        """追加写入已完成的记录，文件行数过多时压缩"""
+        if not self._persist_path:
+            return
+        line = json.dumps({
+            'scope': entry['scope'],
+            'fingerprint': entry['fingerprint'],
+            'body': entry['body'],
+            'status_code': entry['status_code'],
+            'mimetype': entry['mimetype'],
+            'expires_at': entry['expires_at']
+        }, ensure_ascii=False)
+        try:
+            with self._file_lock:
+                with open(self._persist_path, 'a', encoding='utf-8') as f:
+                    f.write(line + '\n')
+                self._persisted_lines += 1
+                if self._persisted_lines > self._max_entries * 2:
+                    self._compact()
+        except Exception as e:
+            logger.warning(f"保存幂等记录失败: {str(e)}")
+
+    def _compact(self):
+        """只保留内存中已完成的记录重写持久化文件（调用方需持有文件锁）"""
+        with self._lock:
+            entries = [entry for entry in self._entries.values() if entry['status'] == 'done']
+        tmp_path = self._persist_path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps({key: entry[key] for key in
+                                    ('scope', 'fingerprint', 'body', 'status_code', 'mimetype', 'expires_at')},
+                                   ensure_ascii=False) + '\n')
+        tmp_path.replace(self._persist_path)
+        self._persisted_lines = len(entries)
+
+    def _load(self):
+        """启动时加载未过期的持久化记录"""
+        if not self._persist_path.exists():
+            return
+        now = time.time()
+        try:
+            with open(self._persist_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record['expires_at'] < now:
+                        continue
+                    record['status'] = 'done'
+                    record['done'] = threading.Event()
+                    record['done'].set()
+                    self._entries[record['scope']] = record
+                    self._entries.move_to_end(record['scope'])
+            with self._lock:
+                self._purge(now)
+            with self._file_lock:
+                self._compact()
+            logger.info(f"已加载 {len(self._entries)} 条幂等记录")
+        except Exception as e:
+            logger.warning(f"加载幂等记录失败: {str(e)}")
+
+    def stats(self):
+        """幂等记录统计信息"""
+        with self._lock:
+            pending = sum(1 for entry in self._entries.values() if entry['status'] == 'pending')
+            return {
+                'entries': len(self._entries),
+                'pending': pending,
+                'max_entries': self._max_entries,
+                'ttl': self._ttl,
+                'persist': bool(self._persist_path),
+                'hits': self.hits,
+                'misses': self.misses,
+                'conflicts': self.conflicts
+            }
+
+# 全局幂等记录
+idempotency_store = IdempotencyStore(persist_path=IDEMPOTENCY_FILE if Config.IDEMPOTENCY_PERSIST else None)
+
+def _replay(entry):
+    """按保存的结果重放响应"""
+    response = Response(entry['body'], status=entry['status_code'], mimetype=entry['mimetype'])
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def attach_task(task, render):
+    """
+    将当前请求的幂等记录与队列任务关联
+
+    请求本身没有拿到最终结果（如等待超时但任务已在执行）时，记录保持处理中，
+    任务结束后由render(task)生成结果保存；render返回None表示任务未执行，记录被释放。
+    没有Idempotency-Key的请求调用此函数没有任何效果。
+    """
+    entry = getattr(g, 'idempotency_entry', None)
+    if entry is None:
+        return
+    entry['task'] = task
+
+    def on_done(task):
+        rendered = render(task)
+        if rendered is None:
+            idempotency_store.release(entry)
+            return
+        body, status_code = rendered
+        idempotency_store.complete(entry, json.dumps(body, ensure_ascii=False), status_code)
+
+    from app.api_queue import add_done_callback
+    add_done_callback(task, on_done)
+
+def idempotent(view):
+    """
+    为发送接口启用Idempotency-Key
+
+    同一API密钥、同一路径、同一Idempotency-Key的重复请求直接返回首次请求的结果；
+    首次请求仍在处理中时等待其完成。请求内容不同时返回422。
+    5xx和429等未确定执行结果的响应不会被保存，除非请求已关联到仍在执行的队列任务。
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return view(*args, **kwargs)
+
+        scope = f"{request.headers.get('X-API-Key', '')}:{request.path}:{key}"
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+
+        # 首次请求被释放（未执行）时重新占用记录执行一次
+        for _ in range(2):
+            try:
+                entry, created = idempotency_store.reserve(scope, fingerprint)
+            except IdempotencyConflict:
+                return jsonify({
+                    'code': 1006,
+                    'message': 'Idempotency-Key已被用于内容不同的请求',
+                    'data': None
+                }), 422
+
+            if created:
+                break
+
+            if not entry['done'].wait(IDEMPOTENCY_WAIT):
+                response = jsonify({
+                    'code': 1007,
+                    'message': '相同Idempotency-Key的请求正在处理中',
+                    'data': None
+                })
+                response.headers['Retry-After'] = '1'
+                return response, 409
+            if entry['status'] == 'done':
+                return _replay(entry)
+        else:
+            return view(*args, **kwargs)
+
+        g.idempotency_entry = entry
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            idempotency_store.release(entry)
+            raise
+
+        task = entry.get('task')
+        if response.status_code < 500 and response.status_code != 429 and not response.is_streamed:
+            idempotency_store.complete(entry, response.get_data(as_text=True), response.status_code,
+                                       response.mimetype)
+        elif task is None:
+            idempotency_store.release(entry)
+        return response
+    return wrapper
@@ -0,0 +1,227 @@
+"""
+媒体文件处理流水线
+图片、文件、语音的下载和保存交给后台线程池处理，请求和消息读取不等待文件读写。
+文件按内容的SHA-256保存到 data/api/media 下，相同内容（如多次转发的同一张图片）只保存一份。
+每个媒体文件有一个媒体ID，状态为 pending（排队中）、processing（处理中）、ready（已保存）或 failed（失败）
+"""
+
+import hashlib
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from app.unified_logger import logger
+from app.config import Config
+
+# 按内容哈希保存的媒体文件目录
+MEDIA_DIR = Config.API_DIR / "media"
+
+# 处理媒体文件的线程数量，下载本身在UI自动化执行线程中串行执行，这里主要用于计算哈希和复制文件
+MEDIA_WORKERS = 2
+
+# 最多保存的媒体记录数量，超过后淘汰最早的记录（已保存的文件不删除）
+MEDIA_MAX_RECORDS = 10000
+
+# 下载等待UI自动化执行线程的最长时间（秒）
+MEDIA_DOWNLOAD_TIMEOUT = 120
+
+# 计算哈希时每次读取的字节数
+HASH_CHUNK_SIZE = 1024 * 1024
+
+MEDIA_STATUSES = ('pending', 'processing', 'ready', 'failed')
+
+def file_sha256(path):
+    """计算文件内容的SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class MediaRecord:
+    __slots__ = ('id', 'status', 'name', 'source', 'sha256', 'path', 'size', 'error',
+                 'created_at', 'updated_at', 'done')
+
+    def __init__(self, name, source):
+        self.id = uuid.uuid4().hex
+        self.status = 'pending'
+        self.name = name
+        self.source = source
+        self.sha256 = None
+        self.path = None
+        self.size = None
+        self.error = None
+        self.created_at = self.updated_at = time.time()
+        self.done = threading.Event()
+
+    def to_dict(self):
+        return {
+            'media_id': self.id,
+            'status': self.status,
+            'name': self.name,
+            'sha256': self.sha256,
+            'path': self.path,
+            'size': self.size,
+            'error': self.error,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
+        }
+
+class MediaPipeline:
+    """媒体文件的后台处理队列和按内容寻址的存储"""
+
+    def __init__(self, root=MEDIA_DIR, workers=MEDIA_WORKERS, max_records=MEDIA_MAX_RECORDS):
+        self._root = Path(root)
+        self._workers = workers
+        self._max_records = max_records
+        self._pool = None
+        self._records = OrderedDict()
+        # 来源（文件路径或聊天对象/消息ID）到媒体ID，同一来源重复提交时复用同一条记录
+        self._sources = {}
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.stored = 0
+        self.deduplicated = 0
+        self.failed = 0
+        self.bytes_stored = 0
+        self.bytes_saved = 0
+
+    def _submit(self, source, name, func, *args):
+        """创建媒体记录并提交后台任务，同一来源已有未失败的记录时直接返回该记录"""
+        with self._lock:
+            media_id = self._sources.get(source)
+            record = self._records.get(media_id) if media_id else None
+            if record is not None and record.status != 'failed':
+                return record
+
+            record = MediaRecord(name, source)
+            self._records[record.id] = record
+            self._sources[source] = record.id
+            while len(self._records) > self._max_records:
+                _, old = self._records.popitem(last=False)
+                if self._sources.get(old.source) == old.id:
+                    del self._sources[old.source]
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="MediaWorker")
+            self.submitted += 1
+
+        self._pool.submit(self._process, record, func, *args)
+        return record
+
+    def _process(self, record, func, *args):
+        record.status = 'processing'
+        record.updated_at = time.time()
+        try:
+            func(record, *args)
+            record.status = 'ready'
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            record.status = 'failed'
+            record.error = str(e)
+            logger.error(f"处理媒体文件 {record.name} 失败: {str(e)}")
+        finally:
+            record.updated_at = time.time()
+            record.done.set()
+
+    def _store(self, record, path, move):
+        """将文件按内容哈希保存，相同内容已存在时不再保存"""
+        path = Path(path)
+        if not path.is_file():
+            raise FileNotFoundError(f"文件不存在: {path}")
+        sha256 = file_sha256(path)
+        size = path.stat().st_size
+        target = self._root / sha256[:2] / (sha256 + path.suffix.lower())
+
+        if target.exists():
+            with self._lock:
+                self.deduplicated += 1
+                self.bytes_saved += size
+            if move:
+                path.unlink()
+        else:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            # 先写临时文件再改名，并发保存相同内容时不会得到不完整的文件
+            partial = target.with_name(f"{target.name}.{uuid.uuid4().hex}.part")
+            if move:
+                shutil.move(str(path), str(partial))
+            else:
+                shutil.copyfile(path, partial)
+            os.replace(partial, target)
+            with self._lock:
+                self.stored += 1
+                self.bytes_stored += size
+
+        record.sha256 = sha256
+        record.size = size
+        record.path = str(target)
+
+    def _ingest(self, record, path):
+        # 消息中的file_path已返回给客户端，保留原文件
+        self._store(record, path, move=False)
+
+    def _download(self, record, message, save_path):
+        # 延迟导入，避免与队列模块循环导入
+        from app.api_queue import run_in_executor
+
+        # 下载需要操作微信界面，交给UI自动化执行线程，使用后台通道不影响发送
+        args = (save_path,) if save_path else ()
+        result = run_in_executor(message.download, args, timeout=MEDIA_DOWNLOAD_TIMEOUT, lane='background')
+        if not result or not os.path.isfile(str(result)):
+            raise FileNotFoundError(f"下载结果不是文件: {result}")
+        # 用户指定了保存位置时保留原文件
+        self._store(record, result, move=not save_path)
+
+    def ingest(self, path):
+        """保存已在本地的文件（如wxauto自动保存的图片），返回媒体记录"""
+        path = str(path)
+        return self._submit(f"file:{os.path.abspath(path)}", os.path.basename(path), self._ingest, path)
+
+    def download(self, chat, message_id, message, save_path=None):
+        """排队下载消息中的图片/文件，返回媒体记录"""
+        name = getattr(message, 'content', None) or message_id
+        return self._submit(f"message:{chat}/{message_id}", str(name), self._download, message, save_path)
+
+    def attach(self, message):
+        """消息带有本地文件时为其分配媒体ID，只提交后台任务，不读取文件"""
+        if isinstance(message, dict) and message.get('file_path') and 'media_id' not in message:
+            message['media_id'] = self.ingest(message['file_path']).id
+        return message
+
+    def attach_grouped(self, grouped):
+        for messages in grouped.values():
+            if isinstance(messages, list):
+                for message in messages:
+                    self.attach(message)
+        return grouped
+
+    def get(self, media_id):
+        with self._lock:
+            return self._records.get(media_id)
+
+    def wait(self, record, timeout):
+        """等待媒体记录处理完成，返回是否已完成"""
+        return record.done.wait(max(timeout, 0))
+
+    def stats(self):
+        with self._lock:
+            statuses = dict.fromkeys(MEDIA_STATUSES, 0)
+            for record in self._records.values():
+                statuses[record.status] += 1
+        return {
+            'records': sum(statuses.values()),
+            'statuses': statuses,
+            'submitted': self.submitted,
+            'stored': self.stored,
+            'deduplicated': self.deduplicated,
+            'failed': self.failed,
+            'bytes_stored': self.bytes_stored,
+            'bytes_saved': self.bytes_saved
+        }
+
+# 全局媒体处理流水线
+media_pipeline = MediaPipeline()
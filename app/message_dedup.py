@@ -0,0 +1,186 @@
+"""
+消息去重
+重新激活监听、微信重连后，GetNextNewMessage和监听回调可能再次返回已经交付过的消息。
+有消息ID时按(聊天对象, 消息ID)去重：最近的消息在LRU集合中精确判断，更早的消息由轮换的布隆过滤器判断，
+内存占用固定；没有消息ID时按内容哈希在较短的时间窗口内去重，避免误去掉重复发送的相同内容
+"""
+
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from app.unified_logger import logger
+from app.config import Config
+
+# 默认去重配置
+DEFAULT_MESSAGE_DEDUP = {
+    'enabled': True,
+    'lru_size': 10000,          # LRU集合保存的最近消息数量
+    'bloom_capacity': 200000,   # 每代布隆过滤器容纳的消息数量，写满后轮换，共保留两代
+    'error_rate': 0.001,        # 布隆过滤器的误判率
+    'content_window': 300       # 没有消息ID时，相同内容在此时间（秒）内视为重复
+}
+
+def _load_config():
+    """合并app_config.json中的message_dedup配置与默认配置"""
+    config = dict(DEFAULT_MESSAGE_DEDUP)
+    if isinstance(Config.MESSAGE_DEDUP, dict):
+        config.update(Config.MESSAGE_DEDUP)
+    return config
+
+class BloomFilter:
+    """定长布隆过滤器，k个哈希位置由一次blake2b摘要切分得到"""
+
+    def __init__(self, capacity, error_rate):
+        bits = max(int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.size = bits
+        self.hashes = max(int(round(bits / capacity * math.log(2))), 1)
+        self.bits = bytearray((bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def add(self, key):
+        bits = self.bits
+        for p in self._positions(key):
+            bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+class RotatingBloomFilter:
+    """两代布隆过滤器，当前代写满后丢弃上一代，保留最近2*capacity条消息"""
+
+    def __init__(self, capacity, error_rate):
+        self._capacity = capacity
+        self._error_rate = error_rate
+        self._current = BloomFilter(capacity, error_rate)
+        self._previous = None
+        self.rotations = 0
+
+    def __contains__(self, key):
+        return key in self._current or (self._previous is not None and key in self._previous)
+
+    def add(self, key):
+        if self._current.count >= self._capacity:
+            self._previous = self._current
+            self._current = BloomFilter(self._capacity, self._error_rate)
+            self.rotations += 1
+        self._current.add(key)
+
+    @property
+    def memory(self):
+        return len(self._current.bits) + (len(self._previous.bits) if self._previous else 0)
+
+class MessageDeduplicator:
+    """判断消息是否已经交付过，线程安全"""
+
+    def __init__(self, enabled=True, lru_size=10000, bloom_capacity=200000, error_rate=0.001, content_window=300):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._recent = OrderedDict()
+        self._lru_size = lru_size
+        self._bloom = RotatingBloomFilter(bloom_capacity, error_rate)
+        self._content_window = content_window
+        self.checked = 0
+        self.duplicates = 0
+        self.lru_hits = 0
+        self.bloom_hits = 0
+        self.content_hits = 0
+
+    @staticmethod
+    def _key(chat, message):
+        """(消息键, 是否为消息ID)"""
+        msg_id = message.get('id')
+        if msg_id not in (None, ''):
+            return f"id\x00{chat}\x00{msg_id}".encode('utf-8'), True
+        parts = (chat, message.get('type'), message.get('sender'), message.get('content'), message.get('time'))
+        digest = hashlib.blake2b('\x00'.join(str(part) for part in parts).encode('utf-8'), digest_size=16)
+        return b"content\x00" + digest.digest(), False
+
+    def is_new(self, chat, message):
+        """消息第一次出现时返回True并记录，重复时返回False"""
+        if not self.enabled or not isinstance(message, dict) or message.get('error'):
+            return True
+        key, by_id = self._key(chat, message)
+        now = time.time()
+        with self._lock:
+            self.checked += 1
+            seen = self._recent.get(key)
+            if seen is not None:
+                if by_id or now - seen < self._content_window:
+                    self._recent.move_to_end(key)
+                    self.duplicates += 1
+                    if by_id:
+                        self.lru_hits += 1
+                    else:
+                        self.content_hits += 1
+                    return False
+            elif by_id and key in self._bloom:
+                self.duplicates += 1
+                self.bloom_hits += 1
+                return False
+
+            self._recent[key] = now
+            self._recent.move_to_end(key)
+            if len(self._recent) > self._lru_size:
+                self._recent.popitem(last=False)
+            if by_id:
+                self._bloom.add(key)
+        return True
+
+    def filter(self, chat, messages):
+        """过滤掉已经交付过的消息"""
+        if not self.enabled:
+            return messages
+        return [message for message in messages if self.is_new(chat, message)]
+
+    def filter_grouped(self, grouped):
+        """过滤 {聊天对象: [消息]} 格式的消息，去掉过滤后没有消息的聊天对象"""
+        if not self.enabled:
+            return grouped
+        result = {}
+        for chat, messages in grouped.items():
+            if not isinstance(messages, list):
+                result[chat] = messages
+                continue
+            messages = self.filter(chat, messages)
+            if messages:
+                result[chat] = messages
+        suppressed = sum(len(v) for v in grouped.values() if isinstance(v, list)) - \
+            sum(len(v) for v in result.values() if isinstance(v, list))
+        if suppressed:
+            logger.debug(f"已过滤 {suppressed} 条重复消息")
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'checked': self.checked,
+                'duplicates': self.duplicates,
+                'lru_hits': self.lru_hits,
+                'bloom_hits': self.bloom_hits,
+                'content_hits': self.content_hits,
+                'recent': len(self._recent),
+                'bloom_rotations': self._bloom.rotations,
+                'bloom_bytes': self._bloom.memory
+            }
+
+_config = _load_config()
+
+# 全局消息去重器
+message_dedup = MessageDeduplicator(
+    enabled=bool(_config['enabled']),
+    lru_size=max(int(_config['lru_size']), 1),
+    bloom_capacity=max(int(_config['bloom_capacity']), 1),
+    error_rate=float(_config['error_rate']),
+    content_window=_config['content_window']
+)
@@ -0,0 +1,87 @@
+"""
+聊天窗口消息的增量读取
+GetAllMessage每次返回窗口中的全部消息。为每条消息计算指纹，并对连续DELTA_ANCHOR条消息的指纹
+计算滚动哈希作为位置标记（cursor）。客户端带上一次返回的cursor时，在当前窗口中找到该位置，
+只序列化和返回其后的消息；窗口被清空、重新加载或位置已滚出窗口时找不到该位置，返回reset并从头开始。
+cursor由客户端保存，多个客户端各自的读取位置互不影响
+"""
+
+import hashlib
+
+# 位置标记包含的连续消息数量，越大越不容易因内容相同的消息而误匹配
+DELTA_ANCHOR = 3
+
+# cursor格式版本前缀
+CURSOR_PREFIX = 'd1.'
+
+# 窗口开头之前的位置（尚未读取任何消息）
+START_ANCHOR = 0
+
+# 滚动哈希的模数（梅森素数）和基数
+_MOD = (1 << 61) - 1
+_BASE = 1000003
+
+def fingerprint(msg):
+    """消息指纹：有消息ID时使用ID，否则使用类型、发送者、内容和时间，不做完整序列化"""
+    if isinstance(msg, dict):
+        get = msg.get
+    else:
+        get = lambda name: getattr(msg, name, None)
+    msg_id = get('id')
+    if msg_id not in (None, ''):
+        key = f"id\x00{msg_id}"
+    else:
+        key = '\x00'.join(str(get(name)) for name in ('type', 'sender', 'content', 'time'))
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') % _MOD
+
+def rolling_anchors(fingerprints, size=DELTA_ANCHOR):
+    """
+    计算每个位置的位置标记：以该消息结尾的连续size条消息指纹的多项式滚动哈希
+
+    窗口开头不足size条时对已有的消息计算，位置标记不会为START_ANCHOR
+    """
+    anchors = []
+    high = pow(_BASE, size, _MOD)
+    value = 0
+    for i, fp in enumerate(fingerprints):
+        value = (value * _BASE + fp + 1) % _MOD
+        if i >= size:
+            value = (value - (fingerprints[i - size] + 1) * high) % _MOD
+        anchors.append(value or 1)
+    return anchors
+
+def encode_cursor(anchor):
+    return f"{CURSOR_PREFIX}{anchor:x}"
+
+def parse_cursor(value):
+    """解析cursor，无效时抛出ValueError"""
+    if not value.startswith(CURSOR_PREFIX):
+        raise ValueError(f'无效的cursor: {value}')
+    return int(value[len(CURSOR_PREFIX):], 16)
+
+def compute_delta(messages, since=None, limit=None):
+    """
+    计算需要返回的消息范围
+
+    Args:
+        messages: GetAllMessage返回的消息列表（未序列化）
+        since: 上一次返回的cursor解析后的位置标记，None表示从窗口开头读取
+        limit: 最多返回的消息数量，None表示不限制
+
+    Returns:
+        (起始下标, 结束下标, 新的cursor, 是否有更多消息, 是否因找不到since位置而从头开始)
+    """
+    anchors = rolling_anchors([fingerprint(msg) for msg in messages])
+    start = 0
+    reset = False
+    if since is not None and since != START_ANCHOR:
+        try:
+            # 相同位置标记出现多次时取最早的一处，宁可重复返回也不遗漏消息
+            start = anchors.index(since) + 1
+        except ValueError:
+            reset = True
+
+    end = len(messages) if limit is None else min(len(messages), start + limit)
+    anchor = anchors[end - 1] if end > 0 else START_ANCHOR
+    return start, end, encode_cursor(anchor), end < len(messages), reset
@@ -0,0 +1,406 @@
+"""
+监听消息日志
+监听回调将消息追加到每个聊天对象的环形日志中，每条消息有单调递增的偏移量。
+/api/message/listen/get 的每个消费者按自己的读取位置读取，多个消费者互不影响，
+读取时可以等待新消息到达（长轮询），也可以一次读取所有有新消息的聊天对象（批量读取）。
+同时为每条消息分配全局递增的事件ID并保留最近的消息，供推送流的订阅者读取和断线续传
+"""
+
+import itertools
+import json
+import threading
+import time
+from collections import OrderedDict, deque
+from app.unified_logger import logger
+from app.config import Config
+
+# 默认的监听日志配置
+DEFAULT_LISTEN_BUFFER = {
+    'max_messages': 1000,       # 每个聊天对象保留的消息数量
+    'overflow': 'drop_oldest'   # 日志已满时的处理方式：drop_oldest（覆盖最早的消息）、drop_newest（丢弃新消息）
+}
+
+OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest')
+
+# 长轮询的最长等待时间（秒）
+LISTEN_MAX_WAIT = 60
+
+# 推送流保留的最近消息数量，断线重连时从中补发
+STREAM_REPLAY_SIZE = 5000
+
+# 消费者超过此时间（秒）未读取时删除其读取位置，不再阻止drop_newest策略下的写入
+CONSUMER_IDLE_TTL = 3600
+
+# 最多保留的消费者数量，超过后淘汰最久未读取的消费者
+MAX_CONSUMERS = 200
+
+def _load_config():
+    """合并app_config.json中的listen_buffer配置与默认配置"""
+    config = dict(DEFAULT_LISTEN_BUFFER)
+    if isinstance(Config.LISTEN_BUFFER, dict):
+        config.update(Config.LISTEN_BUFFER)
+    config['max_messages'] = max(int(config['max_messages']), 1)
+    if config['overflow'] not in OVERFLOW_POLICIES:
+        logger.warning(f"未知的监听日志溢出策略: {config['overflow']}，使用drop_oldest")
+        config['overflow'] = 'drop_oldest'
+    return config
+
+class _ChatLog:
+    """单个聊天对象的定长环形日志，偏移量为offset的消息保存在buffer[offset % capacity]"""
+
+    __slots__ = ('buffer', 'capacity', 'next_offset')
+
+    def __init__(self, capacity):
+        self.buffer = [None] * capacity
+        self.capacity = capacity
+        self.next_offset = 0
+
+    @property
+    def first_offset(self):
+        """仍保留的最早消息的偏移量"""
+        return max(self.next_offset - self.capacity, 0)
+
+    @property
+    def full(self):
+        return self.next_offset >= self.capacity
+
+    def append(self, message):
+        self.buffer[self.next_offset % self.capacity] = message
+        self.next_offset += 1
+
+    def read(self, offset, limit):
+        """读取从offset开始的最多limit条消息，只访问返回的消息"""
+        end = self.next_offset if limit is None else min(self.next_offset, offset + limit)
+        capacity = self.capacity
+        buffer = self.buffer
+        return [buffer[i % capacity] for i in range(offset, end)]
+
+def _message_size(message):
+    """消息序列化为JSON后的字节数，用于批量读取的字节预算"""
+    return len(json.dumps(message, ensure_ascii=False).encode('utf-8'))
+
+class _Consumer:
+    __slots__ = ('cursors', 'last_seen', 'rotation')
+
+    def __init__(self):
+        self.cursors = {}
+        self.last_seen = time.time()
+        # 批量读取时从第rotation个有新消息的聊天对象开始分配，每次读取后后移
+        self.rotation = 0
+
+class MessageHub:
+    """按聊天对象分组的监听消息日志，写入时唤醒等待中的读取请求"""
+
+    def __init__(self, max_buffer=None, overflow=None, replay_size=STREAM_REPLAY_SIZE):
+        config = _load_config()
+        self._chats = OrderedDict()
+        self._consumers = OrderedDict()
+        self._cond = threading.Condition()
+        self._max_buffer = max_buffer or config['max_messages']
+        self._overflow = overflow or config['overflow']
+        self._waiters = 0
+        # 推送流事件：(事件ID, 聊天对象, 消息)，事件ID连续递增
+        self._events = deque(maxlen=replay_size)
+        self._last_event_id = 0
+        self._subscribers = 0
+        # 推送流订阅者最后一次等待消息的时间
+        self.last_subscribed = 0
+        self._listeners = []
+        self.published = 0
+        self.delivered = 0
+        self.evicted = 0
+        self.rejected = 0
+        self.wakeups = 0
+        self.timeouts = 0
+
+    def _slowest_cursor(self, chat):
+        """
+        读过该聊天对象的消费者中最慢的读取位置（调用方需持有锁），没有消费者读过时返回None
+
+        没有读过该聊天对象的消费者第一次读取时从仍保留的最早消息开始，不需要为其保留消息
+        """
+        cursors = [consumer.cursors[chat] for consumer in self._consumers.values() if chat in consumer.cursors]
+        return min(cursors) if cursors else None
+
+    def publish(self, chat, message, log=True):
+        """
+        写入一条消息并唤醒等待中的请求，推送流和监听器始终会收到消息
+
+        Args:
+            log: 为False时只推送给推送流和监听器，不写入监听日志（如后台轮询到的非监听对象的新消息）
+        """
+        with self._cond:
+            if log:
+                self._append(chat, message)
+            self.published += 1
+            self._last_event_id += 1
+            event_id = self._last_event_id
+            self._events.append((event_id, chat, message))
+            self._cond.notify_all()
+            listeners = self._listeners
+
+        for listener in listeners:
+            try:
+                listener(event_id, chat, message)
+            except Exception as e:
+                logger.error(f"消息监听器处理失败: {str(e)}")
+
+    def _append(self, chat, message):
+        """按溢出策略将消息追加到聊天对象的日志（调用方需持有锁）"""
+        log = self._chats.get(chat)
+        if log is None:
+            log = self._chats[chat] = _ChatLog(self._max_buffer)
+        slowest = self._slowest_cursor(chat) if log.full else None
+        # 最早的消息还有消费者没有读取
+        unread = slowest is not None and slowest <= log.first_offset
+        if not log.full:
+            log.append(message)
+        elif self._overflow == 'drop_newest' and unread:
+            # 丢弃新消息，等消费者读取
+            self.rejected += 1
+            if self.rejected % 100 == 1:
+                logger.warning(f"监听消息未及时读取，已丢弃 {self.rejected} 条新消息")
+        else:
+            if unread:
+                self.evicted += 1
+                if self.evicted % 100 == 1:
+                    logger.warning(f"监听消息未及时读取，已覆盖 {self.evicted} 条最早的消息")
+            log.append(message)
+
+    def add_listener(self, listener):
+        """注册新消息监听器listener(事件ID, 聊天对象, 消息)，在写入消息的线程中调用，不应阻塞"""
+        with self._cond:
+            self._listeners = self._listeners + [listener]
+
+    def _consumer(self, name, now):
+        """获取消费者，不存在时创建（调用方需持有锁）"""
+        consumer = self._consumers.get(name)
+        if consumer is None:
+            # 清理长时间未读取的消费者
+            while self._consumers:
+                oldest = next(iter(self._consumers.values()))
+                if len(self._consumers) < MAX_CONSUMERS and now - oldest.last_seen < CONSUMER_IDLE_TTL:
+                    break
+                self._consumers.popitem(last=False)
+            consumer = self._consumers[name] = _Consumer()
+        else:
+            self._consumers.move_to_end(name)
+        consumer.last_seen = now
+        return consumer
+
+    def _read(self, consumer, max_messages):
+        """
+        从消费者的读取位置读取第一个有新消息的聊天对象（调用方需持有锁）
+
+        Returns:
+            ({聊天对象: [消息]}, 因日志覆盖而错过的消息数量)
+        """
+        for chat, log in self._chats.items():
+            # 第一次读取该聊天对象时从仍保留的最早消息开始
+            cursor = consumer.cursors.get(chat, log.first_offset)
+            if cursor >= log.next_offset:
+                continue
+            missed = max(log.first_offset - cursor, 0)
+            cursor += missed
+            messages = log.read(cursor, max_messages)
+            consumer.cursors[chat] = cursor + len(messages)
+            self.delivered += len(messages)
+            return {chat: messages}, missed
+        return {}, 0
+
+    def _read_batch(self, consumer, max_messages, max_bytes):
+        """
+        读取所有有新消息的聊天对象（调用方需持有锁）
+
+        按轮转顺序每轮从每个聊天对象取一条消息，直到消息数量或字节数达到预算，
+        消息很多的聊天对象不会占满预算而让其他聊天对象一直读不到。
+        超过字节预算的单条消息在响应为空时仍会返回，避免读取停滞
+
+        Returns:
+            ({聊天对象: [消息]}, 因日志覆盖而错过的消息数量)
+        """
+        pending = []
+        missed = 0
+        for chat, log in self._chats.items():
+            cursor = consumer.cursors.get(chat, log.first_offset)
+            if cursor >= log.next_offset:
+                continue
+            skipped = max(log.first_offset - cursor, 0)
+            missed += skipped
+            pending.append([chat, log, cursor + skipped, []])
+        if not pending:
+            return {}, 0
+
+        start = consumer.rotation % len(pending)
+        pending = pending[start:] + pending[:start]
+        consumer.rotation += 1
+
+        count = 0
+        size = 0
+        active = pending
+        while active and (max_messages is None or count < max_messages):
+            remaining = []
+            for entry in active:
+                if max_messages is not None and count >= max_messages:
+                    break
+                chat, log, offset, taken = entry
+                message = log.buffer[offset % log.capacity]
+                if max_bytes is not None:
+                    message_size = _message_size(message)
+                    if count and size + message_size > max_bytes:
+                        # 该聊天对象的下一条消息放不下，其他聊天对象的较小消息仍可继续分配
+                        continue
+                    size += message_size
+                taken.append(message)
+                count += 1
+                entry[2] = offset + 1
+                if entry[2] < log.next_offset:
+                    remaining.append(entry)
+            active = remaining
+
+        result = {}
+        for chat, log, offset, taken in pending:
+            # 错过的消息也要推进读取位置，即使本次没有分配到消息
+            consumer.cursors[chat] = offset
+            if taken:
+                result[chat] = taken
+        self.delivered += count
+        return result, missed
+
+    def get(self, consumer='default', wait=0, max_messages=None, batch=False, max_bytes=None):
+        """
+        按消费者的读取位置读取消息
+
+        Args:
+            consumer: 消费者名称，每个消费者有独立的读取位置
+            wait: 没有消息时最多等待的秒数，0表示立即返回
+            max_messages: 最多返回的消息数量，None表示不限制
+            batch: False时只返回第一个有新消息的聊天对象，True时返回所有有新消息的聊天对象
+            max_bytes: 批量读取时返回消息的JSON总字节数上限，None表示不限制
+
+        Returns:
+            ({聊天对象: [消息]}, 因日志覆盖而错过的消息数量)，没有消息时为空字典
+        """
+        wait = min(max(wait or 0, 0), LISTEN_MAX_WAIT)
+        deadline = time.time() + wait
+        if batch:
+            read = lambda state: self._read_batch(state, max_messages, max_bytes)
+        else:
+            read = lambda state: self._read(state, max_messages)
+        with self._cond:
+            state = self._consumer(consumer, time.time())
+            result = read(state)
+            if result[0] or wait <= 0:
+                return result
+
+            self._waiters += 1
+            try:
+                while True:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        return {}, 0
+                    self._cond.wait(remaining)
+                    result = read(state)
+                    if result[0]:
+                        self.wakeups += 1
+                        return result
+            finally:
+                self._waiters -= 1
+                state.last_seen = time.time()
+
+    @property
+    def last_event_id(self):
+        with self._cond:
+            return self._last_event_id
+
+    def _events_after(self, cursor, chats):
+        """
+        读取事件ID大于cursor的事件（调用方需持有锁）
+
+        Returns:
+            (匹配的事件列表, 新的cursor, 是否有事件已被淘汰而无法补发)
+        """
+        if cursor > self._last_event_id:
+            # 客户端的事件ID来自服务重启之前，从保留的最早事件开始补发
+            cursor = 0
+        if cursor >= self._last_event_id:
+            return [], cursor, False
+
+        first_id = self._events[0][0] if self._events else self._last_event_id + 1
+        gap = cursor + 1 < first_id
+        start = max(cursor + 1 - first_id, 0)
+        events = [event for event in itertools.islice(self._events, start, None)
+                  if chats is None or event[1] in chats]
+        return events, self._last_event_id, gap
+
+    def subscribe(self, cursor, chats=None, timeout=None):
+        """
+        等待并读取事件ID大于cursor的消息，不会从未读缓存中取走消息
+
+        Args:
+            cursor: 已收到的最后一个事件ID，0表示从当前保留的最早事件开始
+            chats: 只返回这些聊天对象的消息，None表示全部
+            timeout: 没有新消息时最多等待的秒数
+
+        Returns:
+            (事件列表, 新的cursor, 是否有消息已被淘汰而无法补发)，超时时事件列表为空
+        """
+        deadline = time.time() + (timeout or 0)
+        with self._cond:
+            self._subscribers += 1
+            self.last_subscribed = time.time()
+            try:
+                gap = False
+                while True:
+                    events, cursor, missed = self._events_after(cursor, chats)
+                    gap = gap or missed
+                    if events:
+                        return events, cursor, gap
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return [], cursor, gap
+                    self._cond.wait(remaining)
+            finally:
+                self._subscribers -= 1
+                self.last_subscribed = time.time()
+
+    @property
+    def subscribers(self):
+        """正在等待消息的推送流订阅者数量"""
+        return self._subscribers
+
+    def remove(self, chat):
+        """移除聊天对象的日志及各消费者在其上的读取位置"""
+        with self._cond:
+            for consumer in self._consumers.values():
+                consumer.cursors.pop(chat, None)
+            return self._chats.pop(chat, None) is not None
+
+    def stats(self):
+        """日志统计信息"""
+        with self._cond:
+            consumers = []
+            for name, consumer in self._consumers.items():
+                lag = sum(log.next_offset - max(consumer.cursors.get(chat, 0), log.first_offset)
+                          for chat, log in self._chats.items())
+                consumers.append({'consumer': name, 'lag': lag, 'last_seen': consumer.last_seen})
+            return {
+                'chats': len(self._chats),
+                'retained': sum(log.next_offset - log.first_offset for log in self._chats.values()),
+                'max_buffer': self._max_buffer,
+                'overflow': self._overflow,
+                'consumers': consumers,
+                'waiters': self._waiters,
+                'subscribers': self._subscribers,
+                'last_event_id': self._last_event_id,
+                'published': self.published,
+                'delivered': self.delivered,
+                'evicted': self.evicted,
+                'rejected': self.rejected,
+                'wakeups': self.wakeups,
+                'timeouts': self.timeouts
+            }
+
+# 全局监听消息日志
+message_hub = MessageHub()
@@ -0,0 +1,147 @@
+"""
+消息ID索引
+消息操作接口（点击、引用、转发、删除等）需要通过消息ID找到窗口中的消息对象。
+为每个聊天窗口维护消息ID到消息对象的索引，由获取所有消息和监听回调增量更新，
+命中时无需再调用GetAllMessage抓取整个窗口；未命中时抓取一次并刷新索引。
+聊天窗口对象变化（重新监听、窗口重新加载）、加载更多消息或索引过期时整体失效。
+索引按聊天对象名称保存，并持有窗口对象本身用于比较，窗口对象不会被回收后复用同一个id；
+每次重建或失效都推进该聊天的代数，抓取期间索引已失效时抓取结果不会覆盖新的索引
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from app.unified_logger import logger
+
+# 每个聊天窗口最多索引的消息数量，超过后淘汰最早加入的消息
+INDEX_MAX_PER_CHAT = 2000
+
+# 索引的有效时间（秒），窗口中的消息对象可能因界面刷新而失效，超过后重新抓取
+INDEX_TTL = 300
+
+class _ChatIndex:
+    __slots__ = ('window', 'generation', 'messages', 'refreshed_at')
+
+    def __init__(self, window, generation):
+        self.window = window
+        self.generation = generation
+        self.messages = OrderedDict()
+        self.refreshed_at = time.time()
+
+class MessageIndex:
+    """按聊天对象名称保存的消息ID索引，线程安全"""
+
+    def __init__(self, max_per_chat=INDEX_MAX_PER_CHAT, ttl=INDEX_TTL):
+        self._chats = {}
+        self._generations = {}
+        self._lock = threading.Lock()
+        self._max_per_chat = max_per_chat
+        self._ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.scrapes = 0
+        self.not_found = 0
+        self.invalidations = 0
+
+    def _new_entry(self, chat, chat_wnd):
+        """为聊天窗口建立新的索引并推进代数（调用方需持有锁）"""
+        generation = self._generations[chat] = self._generations.get(chat, 0) + 1
+        entry = self._chats[chat] = _ChatIndex(chat_wnd, generation)
+        return entry
+
+    def _entry(self, chat, chat_wnd, now):
+        """获取聊天窗口的索引，窗口对象变化或过期时重建（调用方需持有锁）"""
+        entry = self._chats.get(chat)
+        if entry is not None and chat_wnd is not None and entry.window is not None and entry.window is not chat_wnd:
+            self.invalidations += 1
+            entry = None
+        if entry is not None and now - entry.refreshed_at > self._ttl:
+            entry = None
+        if entry is None:
+            entry = self._new_entry(chat, chat_wnd)
+        elif entry.window is None:
+            entry.window = chat_wnd
+        return entry
+
+    def _add(self, entry, messages):
+        for msg in messages:
+            msg_id = getattr(msg, 'id', None)
+            if msg_id in (None, ''):
+                continue
+            entry.messages[msg_id] = msg
+            entry.messages.move_to_end(msg_id)
+        while len(entry.messages) > self._max_per_chat:
+            entry.messages.popitem(last=False)
+
+    def add(self, chat, msg, chat_wnd=None):
+        """加入一条新收到的消息（如监听回调中的消息对象）"""
+        with self._lock:
+            self._add(self._entry(chat, chat_wnd, time.time()), (msg,))
+
+    def refresh(self, chat, chat_wnd, messages):
+        """用GetAllMessage的结果重建聊天窗口的索引"""
+        with self._lock:
+            self._add(self._new_entry(chat, chat_wnd), messages)
+
+    def resolve(self, chat, chat_wnd, message_id):
+        """
+        按消息ID查找消息对象，未命中时抓取一次窗口中的全部消息
+
+        Returns:
+            消息对象，窗口中没有该消息时返回None
+        """
+        with self._lock:
+            entry = self._entry(chat, chat_wnd, time.time())
+            msg = entry.messages.get(message_id)
+            if msg is not None:
+                self.hits += 1
+                return msg
+            self.misses += 1
+            generation = entry.generation
+
+        # 抓取窗口不持有锁，避免阻塞其他聊天窗口的查找
+        messages = chat_wnd.GetAllMessage()
+        with self._lock:
+            self.scrapes += 1
+            if self._generations.get(chat) == generation:
+                entry = self._new_entry(chat, chat_wnd)
+            else:
+                # 抓取期间索引已失效或重建（如加载了更多消息），抓取结果只用于本次查找
+                entry = _ChatIndex(chat_wnd, generation)
+            self._add(entry, messages)
+            msg = entry.messages.get(message_id)
+            if msg is None:
+                self.not_found += 1
+                logger.debug(f"聊天窗口 {chat} 中没有消息ID: {message_id}")
+            return msg
+
+    def discard(self, chat, message_id):
+        """从索引中移除已删除的消息"""
+        with self._lock:
+            entry = self._chats.get(chat)
+            if entry is not None:
+                entry.messages.pop(message_id, None)
+
+    def invalidate(self, chat):
+        """丢弃聊天窗口的索引，例如加载了更多消息或消息对象操作失败、可能已失效时"""
+        with self._lock:
+            self._generations[chat] = self._generations.get(chat, 0) + 1
+            if self._chats.pop(chat, None) is not None:
+                self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'chats': len(self._chats),
+                'indexed': sum(len(entry.messages) for entry in self._chats.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+                'scrapes': self.scrapes,
+                'not_found': self.not_found,
+                'invalidations': self.invalidations
+            }
+
+# 全局消息ID索引
+message_index = MessageIndex()
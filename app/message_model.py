@@ -0,0 +1,179 @@
+"""
+统一的消息模型
+将wxauto/wxautox返回的消息对象、适配器转换后的字典统一转换为API响应格式，
+供所有获取消息的接口和监听回调共用
+"""
+
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from app.unified_logger import logger
+
+# 群名后面的人数信息，如"工作群 (25)"
+GROUP_SUFFIX_RE = re.compile(r'\s*\(\d+\)$')
+
+# 需要检查本地文件的消息类型
+MEDIA_TYPES = frozenset(('image', 'file', 'video', 'voice'))
+
+# 按扩展名推断的消息类型
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif')
+VOICE_EXTENSIONS = ('.mp3', '.wav', '.amr')
+
+# 文件状态缓存的条目上限和有效期（秒）；图片、文件可能在消息到达后才下载完成，因此缓存不宜过久
+FILE_STAT_CACHE_SIZE = 4096
+FILE_STAT_TTL = 30
+
+_MISSING = object()
+
+def clean_group_name(name):
+    """清理群名中的人数信息"""
+    return GROUP_SUFFIX_RE.sub('', name) if isinstance(name, str) else name
+
+class _FileStatCache:
+    """按路径缓存文件是否存在及大小，避免同一文件被反复stat"""
+
+    def __init__(self, max_size=FILE_STAT_CACHE_SIZE, ttl=FILE_STAT_TTL):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_size = max_size
+        self._ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def stat(self, path):
+        """
+        Returns:
+            (是否为已存在的文件, 文件大小)
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and now - entry[0] < self._ttl:
+                self.hits += 1
+                return entry[1], entry[2]
+
+        try:
+            size = os.stat(path).st_size
+            exists = True
+        except (OSError, ValueError, TypeError):
+            size = 0
+            exists = False
+
+        with self._lock:
+            self.misses += 1
+            self._entries[path] = (now, exists, size)
+            self._entries.move_to_end(path)
+            if len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+        return exists, size
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+file_stat_cache = _FileStatCache()
+
+def _infer_mtype(path):
+    """按扩展名推断媒体类型"""
+    lower = path.lower()
+    if lower.endswith(IMAGE_EXTENSIONS):
+        return 'image'
+    if lower.endswith(VOICE_EXTENSIONS):
+        return 'voice'
+    return 'file'
+
+def _extract(msg, infer_file):
+    """
+    一次读取消息的全部字段
+
+    Returns:
+        (type, content, sender, time, id, mtype, sender_remark, file_path)
+    """
+    if isinstance(msg, dict):
+        get = msg.get
+        content = get('content', _MISSING)
+        type_, sender, time_, id_ = get('type', 'unknown'), get('sender', ''), get('time', ''), get('id', '')
+        mtype, sender_remark, file_path = get('mtype'), get('sender_remark'), get('file_path')
+    elif hasattr(msg, 'type'):
+        content = getattr(msg, 'content', _MISSING)
+        type_, sender, time_, id_ = msg.type, getattr(msg, 'sender', ''), getattr(msg, 'time', ''), getattr(msg, 'id', '')
+        mtype = getattr(msg, 'mtype', None)
+        sender_remark = getattr(msg, 'sender_remark', None)
+        file_path = getattr(msg, 'file_path', None)
+    else:
+        return 'text', str(msg), '', '', '', None, None, None
+
+    # 只有缺少content时才需要str(msg)，避免每条消息都格式化一次
+    if content is _MISSING:
+        content = str(msg)
+
+    if file_path:
+        if type_ in MEDIA_TYPES:
+            exists, size = file_stat_cache.stat(file_path)
+            if not exists or size == 0:
+                logger.warning(f"文件不存在或大小为0: {file_path}")
+    elif infer_file and content and isinstance(content, str) and file_stat_cache.stat(content)[0]:
+        file_path = content
+        mtype = _infer_mtype(content)
+    return type_, content, sender, time_, id_, mtype, sender_remark, file_path
+
+def serialize_message(msg, infer_file=False):
+    """将单条消息直接转换为可序列化的字典（不创建中间对象），转换失败时各字段为None并带有error字段"""
+    try:
+        type_, content, sender, time_, id_, mtype, sender_remark, file_path = _extract(msg, infer_file)
+    except Exception as e:
+        logger.error(f"处理消息时出错: {str(e)}")
+        # 与正常消息保持相同的字段，取不到的字段为None，错误原因放在error字段
+        return {
+            'type': None,
+            'content': None,
+            'sender': None,
+            'time': None,
+            'id': None,
+            'mtype': None,
+            'sender_remark': None,
+            'file_path': None,
+            'error': f'消息处理错误: {str(e)}'
+        }
+    return {
+        'type': type_,
+        'content': content,
+        'sender': sender,
+        'time': time_,
+        'id': id_,
+        'mtype': mtype,
+        'sender_remark': sender_remark,
+        'file_path': file_path
+    }
+
+def serialize_messages(messages, infer_file=False):
+    """将消息列表转换为可序列化的字典列表"""
+    return [serialize_message(msg, infer_file) for msg in messages]
+
+def normalize_new_messages(messages, infer_file=False):
+    """
+    将GetNextNewMessage的各种返回格式统一为 {聊天名称: [消息]}
+
+    支持的格式：
+    - {'chat_name': str, 'chat_type': str, 'msg': list}（wxautox及适配器转换后的wxauto）
+    - {聊天名称: list}
+    - list（无法确定聊天名称，归入"新消息"）
+    - 其他值按文本消息归入"消息"
+    """
+    if not messages:
+        return {}
+
+    if isinstance(messages, dict):
+        msg_list = messages.get('msg')
+        if isinstance(msg_list, list):
+            chat_name = clean_group_name(messages.get('chat_name') or '未知聊天')
+            return {chat_name: serialize_messages(msg_list, infer_file)}
+        return {clean_group_name(chat_name): serialize_messages(msg_list, infer_file)
+                for chat_name, msg_list in messages.items() if isinstance(msg_list, list)}
+
+    if isinstance(messages, (list, tuple)):
+        return {"新消息": serialize_messages(messages, infer_file)}
+
+    return {"消息": [{"type": "text", "content": str(messages)}]}
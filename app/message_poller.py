@@ -0,0 +1,230 @@
+"""
+新消息后台轮询
+由一个后台线程调用GetNextNewMessage，去重后写入新消息缓冲区和消息存储，并推送给推送流和Webhook。
+获取新消息接口只读取缓冲区，每个消费者有独立的读取位置，
+轮询次数与客户端数量和请求频率无关。轮询间隔随消息活跃程度自适应调整，
+长时间没有请求读取、也没有推送流或Webhook订阅时暂停轮询，避免无人使用时占用UI
+"""
+
+import threading
+import time
+from collections import OrderedDict, deque
+from app.unified_logger import logger
+from app.adaptive_poll import AdaptiveInterval
+from app.api_queue import timing_summary
+from app.config import Config
+from app.message_hub import MessageHub, message_hub
+from app.message_model import normalize_new_messages
+from app.message_dedup import message_dedup
+from app.message_store import message_store
+from app.media_pipeline import media_pipeline
+from app.webhook_delivery import webhook_dispatcher
+
+# 默认轮询配置
+DEFAULT_MESSAGE_POLLER = {
+    'enabled': True,
+    'min_interval': 0.5,    # 取到新消息后的轮询间隔（秒）
+    'max_interval': 10,     # 长时间没有新消息时的最长轮询间隔（秒）
+    'backoff': 2.0,         # 每次没有新消息时间隔增大的倍数
+    'idle_timeout': 300,    # 超过此时间（秒）没有请求读取新消息时暂停轮询，0表示一直轮询
+    'filter_mute': False    # wxautox是否过滤免打扰消息
+}
+
+# 连续取到新消息时最多连续轮询的次数，之后让出执行线程给其他任务
+POLL_DRAIN_LIMIT = 20
+
+# 参与延迟统计的最近消息数量
+LATENCY_SAMPLES = 1000
+
+# 等待首次读取以计算延迟的消息数量上限
+LATENCY_PENDING_LIMIT = 5000
+
+def _load_config():
+    """合并app_config.json中的message_poller配置与默认配置"""
+    config = dict(DEFAULT_MESSAGE_POLLER)
+    if isinstance(Config.MESSAGE_POLLER, dict):
+        config.update(Config.MESSAGE_POLLER)
+    return config
+
+class NewMessagePoller:
+    """后台轮询新消息并写入缓冲区"""
+
+    def __init__(self, enabled=True, min_interval=0.5, max_interval=10, backoff=2.0, idle_timeout=300,
+                 filter_mute=False):
+        self.enabled = enabled
+        self.schedule = AdaptiveInterval(min_interval, max_interval, backoff)
+        self.idle_timeout = idle_timeout
+        self.filter_mute = filter_mute
+        self.buffer = MessageHub()
+        self._lock = threading.Lock()
+        self._poll_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._last_read = 0
+        # 消息对象 -> (消息, 写入缓冲区的时间, 到达时间的最大误差)，第一次被读取时计算延迟
+        self._pending_latency = OrderedDict()
+        self._latency_lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.polls = 0
+        self.empty_polls = 0
+        self.errors = 0
+        self.received = 0
+        self.last_poll = None
+        self.last_error = None
+
+    def start(self):
+        """启动轮询线程，已启动时不做任何事"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True, name="NewMessagePoller")
+            self._thread.start()
+        logger.info(f"新消息后台轮询已启动，间隔 {self.schedule.floor}-{self.schedule.ceiling} 秒")
+
+    def _idle(self, now):
+        """超过idle_timeout没有请求读取，且没有推送流或Webhook订阅新消息"""
+        if not self.idle_timeout or webhook_dispatcher.started or message_hub.subscribers:
+            return False
+        return now - max(self._last_read, message_hub.last_subscribed) > self.idle_timeout
+
+    def touch(self):
+        """有推送流订阅时启动或恢复后台轮询"""
+        self._last_read = time.time()
+        if self.enabled:
+            self.start()
+            self._wakeup.set()
+
+    def _run(self):
+        while True:
+            if self._idle(time.time()):
+                # 暂停轮询，直到有请求读取新消息或有订阅者；清除后再检查一次，避免错过唤醒
+                self._wakeup.clear()
+                if self._idle(time.time()):
+                    self._wakeup.wait()
+                continue
+
+            if self.poll_once():
+                # 有新消息时继续取完积压的消息，并缩短之后的轮询间隔
+                drained = 1
+                while drained < POLL_DRAIN_LIMIT and self.poll_once():
+                    drained += 1
+                self.schedule.activity()
+            else:
+                self.schedule.idle()
+            self.schedule.wait()
+
+    def poll_once(self):
+        """
+        调用一次GetNextNewMessage并写入缓冲区
+
+        Returns:
+            本次是否取到了新消息
+        """
+        # 延迟导入，避免与微信管理模块循环导入
+        from app.wechat import wechat_manager
+
+        wx_instance = wechat_manager.get_instance()
+        if not wx_instance or not getattr(wx_instance, '_instance', True):
+            return False
+
+        lib_name = getattr(wx_instance, '_lib_name', 'wxauto')
+        params = {'filter_mute': self.filter_mute} if lib_name == 'wxautox' else {}
+        with self._poll_lock:
+            now = time.time()
+            # 新消息在上一次轮询之后到达，到达时间最多早于本次轮询这么久
+            arrival_bound = now - self.last_poll if self.last_poll else 0
+            self.polls += 1
+            self.last_poll = now
+            self.schedule.record_poll(now)
+            try:
+                messages = wx_instance.GetNextNewMessage(**params)
+            except Exception as e:
+                self.errors += 1
+                self.last_error = str(e)
+                logger.error(f"后台获取新消息失败: {str(e)}")
+                return False
+
+            if not messages:
+                self.empty_polls += 1
+                return False
+
+            grouped = message_dedup.filter_grouped(normalize_new_messages(messages))
+            # 带文件的消息分配媒体ID，文件在后台保存，不阻塞轮询
+            media_pipeline.attach_grouped(grouped)
+            message_store.add_grouped(grouped, 'new')
+            published_at = time.time()
+            with self._latency_lock:
+                for chat_messages in grouped.values():
+                    for message in chat_messages:
+                        self._pending_latency[id(message)] = (message, published_at, arrival_bound)
+                while len(self._pending_latency) > LATENCY_PENDING_LIMIT:
+                    self._pending_latency.popitem(last=False)
+            for chat, chat_messages in grouped.items():
+                for message in chat_messages:
+                    self.buffer.publish(chat, message)
+                    # 推送流和Webhook也会收到后台轮询到的新消息，不写入监听消息日志
+                    message_hub.publish(chat, message, log=False)
+                    self.received += 1
+            return True
+
+    def _record_latency(self, messages):
+        """记录消息从到达（估计）到第一次被读取的延迟"""
+        now = time.time()
+        with self._latency_lock:
+            for chat_messages in messages.values():
+                for message in chat_messages:
+                    entry = self._pending_latency.pop(id(message), None)
+                    if entry is not None and entry[0] is message:
+                        self._latencies.append(now - entry[1] + entry[2])
+
+    def read(self, consumer, wait=0, max_messages=None):
+        """
+        按消费者的读取位置读取缓冲区中的新消息
+
+        Returns:
+            ({聊天对象: [消息]}, 因缓冲区覆盖而错过的消息数量)
+        """
+        now = time.time()
+        stopped = not (self._thread and self._thread.is_alive()) or self._idle(now)
+        self._last_read = now
+        if not self.enabled or stopped:
+            # 未启用后台轮询或轮询刚恢复时，由请求线程先轮询一次，避免第一次读取时没有消息
+            self.poll_once()
+        if self.enabled:
+            self.start()
+            self._wakeup.set()
+        result = self.buffer.get(consumer, wait=wait, max_messages=max_messages, batch=True)
+        if result[0]:
+            self._record_latency(result[0])
+        return result
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'running': bool(self._thread and self._thread.is_alive()),
+            'paused': bool(self._idle(time.time())),
+            'schedule': self.schedule.stats(),
+            # 到达时间按上一次轮询时间估计，为延迟的上限
+            'delivery_latency': timing_summary(list(self._latencies)),
+            'polls': self.polls,
+            'empty_polls': self.empty_polls,
+            'errors': self.errors,
+            'received': self.received,
+            'last_poll': self.last_poll,
+            'last_error': self.last_error,
+            'buffer': self.buffer.stats()
+        }
+
+_config = _load_config()
+
+# 全局新消息轮询器
+message_poller = NewMessagePoller(
+    enabled=bool(_config['enabled']),
+    min_interval=_config['min_interval'],
+    max_interval=_config['max_interval'],
+    backoff=_config['backoff'],
+    idle_timeout=_config['idle_timeout'],
+    filter_mute=bool(_config['filter_mute'])
+)
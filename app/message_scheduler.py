@@ -0,0 +1,353 @@
+"""
+定时消息调度模块
+按发送时间排序的最小堆保存定时发送任务，到期后提交到请求队列执行，并持久化到磁盘，服务重启后继续调度
+"""
+
+import heapq
+import json
+import random
+import threading
+import time
+import uuid
+from app.unified_logger import logger
+from app.config import Config
+from app.api_queue import (QueueFullError, add_done_callback, tenant_label,
+                           set_request_context, set_request_tenant, clear_request_context)
+
+# 持久化文件
+SCHEDULE_FILE = Config.API_DIR / "scheduled_messages.json"
+
+# 同时提交到请求队列、尚未完成的定时任务数量上限，到期任务较多时分批送入执行线程
+SCHEDULE_MAX_INFLIGHT = 10
+
+# 允许的最大随机延迟（秒）
+SCHEDULE_MAX_JITTER = 3600
+
+# 已结束的定时任务保留时间（秒），之后从列表中清除
+SCHEDULE_HISTORY_TTL = 86400
+
+# 持久化的最小间隔（秒），多次修改合并为一次写入
+SCHEDULE_SAVE_INTERVAL = 1.0
+
+class MessageScheduler:
+    """
+    定时消息调度器
+
+    定时任务状态：scheduled（等待发送）、submitting（已到期，正在提交，不能再取消）、
+    submitted（已提交到请求队列）、success、error、cancelled（已取消）、
+    interrupted（提交后服务重启，结果未知，不会重新发送）
+
+    记录中的tenant为API密钥的脱敏名称，持久化文件中不保存完整密钥。
+    提交到请求队列时按脱敏名称在配置的密钥中找回完整密钥
+    """
+
+    def __init__(self, path=SCHEDULE_FILE):
+        self._path = path
+        self._records = {}
+        self._heap = []
+        # 定时任务ID到完整API密钥，只保存在内存中
+        self._api_keys = {}
+        self._handlers = {}
+        self._cond = threading.Condition()
+        self._inflight = 0
+        self._dirty = False
+        self._last_save = 0
+        self._thread = None
+        self._running = False
+        self.dispatched = 0
+        self.deferred = 0
+        self._load()
+
+    def register_handler(self, kind, handler):
+        """
+        注册定时任务类型的处理函数
+
+        Args:
+            kind: 任务类型，如'message'、'file'
+            handler: handler(payload)，将任务提交到请求队列并返回队列任务
+        """
+        with self._cond:
+            self._handlers[kind] = handler
+            self._cond.notify()
+
+    def schedule(self, kind, payload, due_at, jitter=0, tenant=None, lane=None):
+        """
+        添加定时任务
+
+        Args:
+            kind: 任务类型
+            payload: 任务参数，需能序列化为JSON
+            due_at: 计划发送时间（时间戳）
+            jitter: 随机延迟上限（秒），大量任务计划在同一时刻时用于分散执行
+            tenant: 所属API密钥，记录中只保存脱敏名称
+            lane: 提交时使用的优先级通道
+
+        Returns:
+            定时任务记录
+        """
+        jitter = min(max(jitter or 0, 0), SCHEDULE_MAX_JITTER)
+        record = {
+            'schedule_id': uuid.uuid4().hex,
+            'kind': kind,
+            'payload': payload,
+            'send_at': due_at,
+            'due_at': due_at + random.uniform(0, jitter) if jitter else due_at,
+            'tenant': tenant_label(tenant),
+            'lane': lane,
+            'status': 'scheduled',
+            'job_id': None,
+            'error': None,
+            'attempts': 0,
+            'created_at': time.time(),
+            'finished_at': None
+        }
+        with self._cond:
+            self._records[record['schedule_id']] = record
+            self._api_keys[record['schedule_id']] = tenant
+            heapq.heappush(self._heap, (record['due_at'], record['schedule_id']))
+            self._dirty = True
+            self._cond.notify()
+        logger.debug(f"已添加定时任务 {record['schedule_id']}，计划时间: {record['due_at']:.0f}")
+        return record
+
+    def cancel(self, schedule_id):
+        """取消等待发送的定时任务，返回是否取消成功"""
+        with self._cond:
+            record = self._records.get(schedule_id)
+            if not record or record['status'] != 'scheduled':
+                return False
+            # 堆中的条目在出堆时按状态跳过，不需要在这里删除
+            record['status'] = 'cancelled'
+            record['finished_at'] = time.time()
+            self._dirty = True
+            self._cond.notify()
+            return True
+
+    def get(self, schedule_id):
+        """获取定时任务记录"""
+        with self._cond:
+            record = self._records.get(schedule_id)
+            return dict(record) if record else None
+
+    def list(self, tenant=None, status=None, limit=100):
+        """按计划时间列出定时任务，tenant为API密钥时只列出该密钥的任务"""
+        label = tenant_label(tenant) if tenant is not None else None
+        with self._cond:
+            records = [dict(record) for record in self._records.values()
+                       if (label is None or record['tenant'] == label)
+                       and (status is None or record['status'] == status)]
+        records.sort(key=lambda record: record['due_at'])
+        return records[:limit]
+
+    def stats(self, tenant=None):
+        """调度器统计信息，tenant为API密钥时只统计该密钥的任务"""
+        label = tenant_label(tenant) if tenant is not None else None
+        with self._cond:
+            records = [record for record in self._records.values() if label is None or record['tenant'] == label]
+            counts = {}
+            for record in records:
+                counts[record['status']] = counts.get(record['status'], 0) + 1
+            due = [record['due_at'] for record in records if record['status'] == 'scheduled']
+            stats = {
+                'records': len(records),
+                'status_counts': counts,
+                'inflight': counts.get('submitting', 0) + counts.get('submitted', 0),
+                'max_inflight': SCHEDULE_MAX_INFLIGHT,
+                'next_due_at': min(due) if due else None
+            }
+            if label is None:
+                stats.update(inflight=self._inflight, dispatched=self.dispatched, deferred=self.deferred)
+            return stats
+
+    def start(self):
+        """启动调度线程"""
+        with self._cond:
+            if self._thread and self._thread.is_alive():
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, daemon=True, name="MessageScheduler")
+            self._thread.start()
+        logger.info("定时消息调度器已启动")
+
+    def stop(self):
+        """停止调度线程并保存"""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout=5)
+        self._save()
+        logger.info("定时消息调度器已停止")
+
+    def _next_ready(self):
+        """
+        取出下一个可以提交的到期任务（调用方需持有锁）
+
+        Returns:
+            (任务记录, 需要等待的秒数)，没有可提交的任务时记录为None
+        """
+        while self._heap:
+            due_at, schedule_id = self._heap[0]
+            record = self._records.get(schedule_id)
+            if not record or record['status'] != 'scheduled' or record['due_at'] != due_at:
+                heapq.heappop(self._heap)
+                continue
+            now = time.time()
+            if due_at > now:
+                return None, due_at - now
+            if self._inflight >= SCHEDULE_MAX_INFLIGHT or record['kind'] not in self._handlers:
+                return None, None
+            heapq.heappop(self._heap)
+            return record, 0
+        return None, None
+
+    def _run(self):
+        """调度线程：等待最早到期的任务并提交到请求队列"""
+        while True:
+            with self._cond:
+                while self._running:
+                    record, wait = self._next_ready()
+                    if record:
+                        break
+                    self._maybe_save()
+                    # 没有到期任务时等到最早的计划时间；被提交数量限制时等待已提交任务完成
+                    self._cond.wait(min(wait, SCHEDULE_SAVE_INTERVAL) if wait is not None else SCHEDULE_SAVE_INTERVAL)
+                if not self._running:
+                    return
+                self._inflight += 1
+                # 在锁内标记为提交中，之后取消操作不再生效，避免取消成功后仍然发送
+                record['status'] = 'submitting'
+                handler = self._handlers[record['kind']]
+
+            self._dispatch(record, handler)
+
+    def _api_key(self, record):
+        """找回定时任务所属的完整API密钥，密钥已从配置中删除时返回脱敏名称"""
+        api_key = self._api_keys.get(record['schedule_id'])
+        if api_key is None and record['tenant'] != tenant_label(None):
+            api_key = next((key for key in Config.get_api_keys() if tenant_label(key) == record['tenant']),
+                           record['tenant'])
+            self._api_keys[record['schedule_id']] = api_key
+        return api_key
+
+    def _dispatch(self, record, handler):
+        """以定时任务所属API密钥的身份提交到请求队列"""
+        with self._cond:
+            if record['status'] != 'submitting':
+                self._inflight -= 1
+                self._cond.notify()
+                return
+        set_request_context(lane=record['lane'])
+        set_request_tenant(self._api_key(record))
+        try:
+            record['attempts'] += 1
+            task = handler(record['payload'])
+        except QueueFullError as e:
+            # 队列繁忙时按Retry-After推迟，不算失败
+            with self._cond:
+                self._inflight -= 1
+                self.deferred += 1
+                record['status'] = 'scheduled'
+                record['due_at'] = time.time() + e.retry_after
+                heapq.heappush(self._heap, (record['due_at'], record['schedule_id']))
+                self._dirty = True
+            logger.debug(f"定时任务 {record['schedule_id']} 因队列繁忙推迟 {e.retry_after} 秒")
+            return
+        except Exception as e:
+            logger.error(f"提交定时任务 {record['schedule_id']} 失败: {str(e)}")
+            with self._cond:
+                self._inflight -= 1
+                record['status'] = 'error'
+                record['error'] = str(e)
+                record['finished_at'] = time.time()
+                self._dirty = True
+            return
+        finally:
+            clear_request_context()
+
+        with self._cond:
+            self.dispatched += 1
+            record['status'] = 'submitted'
+            record['job_id'] = task.get('job_id')
+            self._dirty = True
+        add_done_callback(task, lambda task: self._on_done(record, task))
+
+    def _on_done(self, record, task):
+        """队列任务结束后记录结果"""
+        with self._cond:
+            self._inflight -= 1
+            record['status'] = task['status'] if task['status'] in ('success', 'cancelled') else 'error'
+            # 发送函数自身捕获异常并返回错误码，按返回的响应判断是否发送成功
+            result = task['result']
+            if record['status'] == 'success' and isinstance(result, dict) and 'response' in result:
+                if result['response'].get('code') != 0:
+                    record['status'] = 'error'
+                    record['error'] = result['response'].get('message')
+            elif task['error']:
+                record['error'] = task['error']
+            record['finished_at'] = time.time()
+            self._dirty = True
+            self._cond.notify()
+
+    def _purge(self, now):
+        """清理过期的已结束记录（调用方需持有锁）"""
+        for schedule_id in [schedule_id for schedule_id, record in self._records.items()
+                            if record['finished_at'] and now - record['finished_at'] > SCHEDULE_HISTORY_TTL]:
+            del self._records[schedule_id]
+            self._api_keys.pop(schedule_id, None)
+
+    def _maybe_save(self):
+        """有修改且距离上次保存超过间隔时保存（调用方需持有锁）"""
+        now = time.time()
+        if self._dirty and now - self._last_save >= SCHEDULE_SAVE_INTERVAL:
+            self._purge(now)
+            self._write(list(self._records.values()))
+            self._dirty = False
+            self._last_save = now
+
+    def _save(self):
+        with self._cond:
+            self._write(list(self._records.values()))
+            self._dirty = False
+
+    def _write(self, records):
+        """写入临时文件后替换，避免写入过程中断导致文件损坏"""
+        try:
+            tmp_path = self._path.with_suffix('.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(records, f, ensure_ascii=False)
+            tmp_path.replace(self._path)
+        except Exception as e:
+            logger.error(f"保存定时任务失败: {str(e)}")
+
+    def _load(self):
+        """加载持久化的定时任务"""
+        if not self._path.exists():
+            return
+        try:
+            with open(self._path, 'r', encoding='utf-8') as f:
+                records = json.load(f)
+        except Exception as e:
+            logger.error(f"加载定时任务失败: {str(e)}")
+            return
+
+        labels = {tenant_label(key) for key in Config.get_api_keys()} | {tenant_label(None)}
+        for record in records:
+            if record['tenant'] not in labels and '***' not in str(record['tenant']):
+                # 旧版本保存的是完整API密钥，改为脱敏名称
+                self._api_keys[record['schedule_id']] = record['tenant']
+                record['tenant'] = tenant_label(record['tenant'])
+                self._dirty = True
+            if record['status'] in ('submitting', 'submitted'):
+                # 已提交的任务随上次进程的内存队列丢失，可能已经发送，不再重复提交
+                record['status'] = 'interrupted'
+                record['finished_at'] = time.time()
+                self._dirty = True
+            self._records[record['schedule_id']] = record
+            if record['status'] == 'scheduled':
+                self._heap.append((record['due_at'], record['schedule_id']))
+        heapq.heapify(self._heap)
+        logger.info(f"已加载 {len(self._heap)} 个待发送的定时任务")
+
+# 全局定时消息调度器，处理函数由路由模块注册后启动
+message_scheduler = MessageScheduler()
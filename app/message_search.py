@@ -0,0 +1,89 @@
+"""
+消息全文检索的分词和摘要
+中文没有空格分词，SQLite自带的分词器会把一整句中文当作一个词。
+写入索引前将连续的中日韩文字切分为重叠的二元组（"你好世界" -> "你好 好世 世界 界"），
+查询时用同样的方式切分关键词并组成短语查询，任意长度的中文关键词都能匹配
+"""
+
+import html
+import re
+
+# 中日韩文字（含扩展A、兼容汉字、假名和韩文音节）
+CJK_CHARS = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff'
+CJK_RE = re.compile(f'[{CJK_CHARS}]+')
+
+# 连续的中日韩文字，或其他文字中的词（与FTS5 unicode61分词器的切分方式基本一致）
+WORD_RE = re.compile(f'[{CJK_CHARS}]+|[^\\W_{CJK_CHARS}]+')
+
+# 摘要长度（字符）及关键词高亮标记
+SNIPPET_CHARS = 64
+SNIPPET_PRE = '<b>'
+SNIPPET_POST = '</b>'
+
+def _bigrams(run, tail):
+    """连续中文切分为二元组，tail为True时追加最后一个字，保证每个字都是某个词的开头"""
+    if len(run) == 1:
+        return [run]
+    tokens = [run[i:i + 2] for i in range(len(run) - 1)]
+    if tail:
+        tokens.append(run[-1])
+    return tokens
+
+def _tokens(text, tail):
+    tokens = []
+    for word in WORD_RE.findall(text):
+        if CJK_RE.fullmatch(word):
+            tokens.extend(_bigrams(word, tail))
+        else:
+            tokens.append(word.lower())
+    return tokens
+
+def index_text(text):
+    """生成写入全文索引的文本"""
+    if not text:
+        return ''
+    return ' '.join(_tokens(text, True))
+
+def build_match_query(query):
+    """
+    将用户输入的关键词转换为FTS5查询语句，空格分隔的多个关键词需同时匹配
+
+    Returns:
+        FTS5 MATCH表达式，关键词中没有可检索的字符时返回None
+    """
+    phrases = []
+    for term in query.split():
+        tokens = _tokens(term, False)
+        if not tokens:
+            continue
+        if len(tokens) == 1 and len(tokens[0]) == 1 and CJK_RE.fullmatch(tokens[0]):
+            # 单个汉字：匹配以该字开头的二元组
+            phrases.append(f'"{tokens[0]}"*')
+        else:
+            phrases.append('"' + ' '.join(token.replace('"', '""') for token in tokens) + '"')
+    return ' AND '.join(phrases) if phrases else None
+
+def make_snippet(text, query, size=SNIPPET_CHARS):
+    """截取原文中第一个关键词附近的片段，并高亮所有关键词；原文做HTML转义，只有高亮标记是HTML"""
+    if not text:
+        return ''
+    terms = sorted({term for term in query.split() if term}, key=len, reverse=True)
+    if not terms:
+        return html.escape(text[:size])
+    pattern = re.compile('|'.join(re.escape(term) for term in terms), re.IGNORECASE)
+
+    first = pattern.search(text)
+    start = 0
+    if first and len(text) > size:
+        start = min(max(first.start() - size // 4, 0), len(text) - size)
+    end = start + size
+    # 在原文上匹配关键词，匹配到的和未匹配的部分分别转义，避免转义后的实体影响匹配
+    parts = []
+    last = start
+    for match in pattern.finditer(text, start, end):
+        parts.append(html.escape(text[last:match.start()]))
+        parts.append(f"{SNIPPET_PRE}{html.escape(match.group(0))}{SNIPPET_POST}")
+        last = match.end()
+    parts.append(html.escape(text[last:end]))
+    fragment = ''.join(parts)
+    return ('…' if start > 0 else '') + fragment + ('…' if end < len(text) else '')
@@ -0,0 +1,442 @@
+"""
+消息存储模块
+将获取新消息、监听回调和获取聊天记录时见到的消息保存到SQLite数据库（WAL模式），
+由单独的写入线程批量写入，历史消息查询直接读取数据库，无需再从微信界面加载。
+写入时同步维护FTS5全文索引，支持按关键词检索消息
+"""
+
+import queue
+import sqlite3
+import threading
+import time
+from app.unified_logger import logger
+from app.config import Config
+from app.message_search import index_text, build_match_query, make_snippet
+
+# 默认存储配置
+DEFAULT_MESSAGE_STORE = {
+    'enabled': True,
+    'retention_days': 90    # 消息保留天数，0表示永久保留
+}
+
+# 数据库文件
+MESSAGE_DB_FILE = Config.API_DIR / "messages.db"
+
+# 每个写入事务最多包含的消息数量
+STORE_BATCH_SIZE = 500
+
+# 攒批的最长等待时间（秒）
+STORE_BATCH_WAIT = 0.2
+
+# 写入队列长度上限，超过后丢弃新消息，避免数据库异常时占用过多内存
+STORE_QUEUE_SIZE = 50000
+
+# 清理过期消息的间隔（秒）
+STORE_PURGE_INTERVAL = 3600
+
+# 单次查询最多返回的消息数量
+STORE_MAX_LIMIT = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat TEXT NOT NULL,
+    msg_id TEXT,
+    type TEXT,
+    content TEXT,
+    sender TEXT,
+    sender_remark TEXT,
+    mtype TEXT,
+    file_path TEXT,
+    msg_time TEXT,
+    received_at REAL NOT NULL,
+    source TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_messages_chat_time ON messages (chat, received_at, seq);
+CREATE INDEX IF NOT EXISTS idx_messages_sender_time ON messages (sender, received_at, seq);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_chat_msg_id ON messages (chat, msg_id) WHERE msg_id IS NOT NULL AND msg_id != '';
+"""
+
+# 全文索引，rowid与messages.seq一致，body为切分后的文本
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(body, tokenize='unicode61');
+"""
+
+# 启动时补建索引每批处理的消息数量
+FTS_BACKFILL_BATCH = 5000
+
+COLUMNS = ('seq', 'chat', 'msg_id', 'type', 'content', 'sender', 'sender_remark', 'mtype', 'file_path',
+           'msg_time', 'received_at', 'source')
+
+def _load_config():
+    """合并app_config.json中的message_store配置与默认配置"""
+    config = dict(DEFAULT_MESSAGE_STORE)
+    if isinstance(Config.MESSAGE_STORE, dict):
+        config.update(Config.MESSAGE_STORE)
+    return config
+
+def _text(value):
+    """消息字段可能是数字或其他对象，统一保存为字符串"""
+    if value is None or isinstance(value, str):
+        return value
+    return str(value)
+
+def parse_time(value):
+    """解析时间参数，支持Unix时间戳和'YYYY-MM-DD HH:MM:SS'、'YYYY-MM-DD'格式"""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            continue
+    raise ValueError(f'无效的时间: {value}')
+
+def _fts_row(seq, content, file_path):
+    """生成全文索引记录，文件类消息的内容是路径，不建立索引"""
+    if not content or file_path:
+        return None
+    return seq, index_text(content)
+
+def row_to_dict(row):
+    """将数据库记录转换为与获取消息接口一致的格式"""
+    return {
+        'type': row['type'],
+        'content': row['content'],
+        'sender': row['sender'],
+        'time': row['msg_time'],
+        'id': row['msg_id'],
+        'mtype': row['mtype'],
+        'sender_remark': row['sender_remark'],
+        'file_path': row['file_path'],
+        'chat': row['chat'],
+        'received_at': row['received_at'],
+        'source': row['source']
+    }
+
+class MessageStore:
+    """
+    SQLite消息存储
+
+    写入：add/add_many只将消息放入队列，写入线程每批最多STORE_BATCH_SIZE条在一个事务中写入。
+    同一聊天对象中相同消息ID的消息只保存一次，新写入的消息在同一事务中加入全文索引。
+    读取：每个线程使用自己的只读连接，WAL模式下读取不会被写入阻塞
+    """
+
+    def __init__(self, path=MESSAGE_DB_FILE, enabled=True, retention_days=0):
+        self._path = path
+        self.enabled = enabled
+        self._retention_days = retention_days
+        self._queue = queue.Queue(maxsize=STORE_QUEUE_SIZE)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._ready = threading.Event()
+        self.search_enabled = False
+        self.written = 0
+        self.duplicates = 0
+        self.dropped = 0
+        self.batches = 0
+        self.errors = 0
+
+    def _connect(self):
+        connection = sqlite3.connect(str(self._path), timeout=10, check_same_thread=False)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def start(self):
+        """创建数据库并启动写入线程"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            connection = self._connect()
+            connection.executescript(SCHEMA)
+            try:
+                connection.executescript(FTS_SCHEMA)
+                self.search_enabled = True
+                self._backfill(connection)
+            except sqlite3.OperationalError as e:
+                logger.warning(f"SQLite不支持FTS5，消息检索不可用: {str(e)}")
+            connection.close()
+            self._ready.set()
+            self._thread = threading.Thread(target=self._run, daemon=True, name="MessageStoreWriter")
+            self._thread.start()
+        logger.info(f"消息存储已启动: {self._path}")
+
+    def _backfill(self, connection):
+        """为尚未建立索引的消息补建全文索引（如升级前保存的消息）"""
+        total = 0
+        while True:
+            last = connection.execute("SELECT IFNULL(MAX(rowid), 0) FROM messages_fts").fetchone()[0]
+            rows = connection.execute(
+                "SELECT seq, content, file_path FROM messages WHERE seq > ? ORDER BY seq LIMIT ?",
+                (last, FTS_BACKFILL_BATCH)
+            ).fetchall()
+            if not rows:
+                break
+            entries = [entry for entry in (_fts_row(*row) for row in rows) if entry]
+            # 没有可索引内容的消息也写入空记录，作为补建进度
+            if not entries or entries[-1][0] != rows[-1][0]:
+                entries.append((rows[-1][0], ''))
+            with connection:
+                connection.executemany("INSERT INTO messages_fts (rowid, body) VALUES (?, ?)", entries)
+            total += len(rows)
+        if total:
+            logger.info(f"已为 {total} 条消息补建全文索引")
+
+    def add(self, chat, message, source):
+        """保存一条消息（异步）"""
+        self.add_many(chat, [message], source)
+
+    def add_many(self, chat, messages, source):
+        """
+        保存一批消息（异步）
+
+        Args:
+            chat: 聊天对象名称
+            messages: 与获取消息接口格式一致的消息字典列表
+            source: 消息来源，如'new'（获取新消息）、'listen'（监听）、'history'（聊天记录）
+        """
+        if not self.enabled or not messages:
+            return
+        if not self._ready.is_set():
+            self.start()
+        received_at = time.time()
+        for message in messages:
+            if not isinstance(message, dict) or message.get('error'):
+                continue
+            row = (chat, _text(message.get('id')) or None, _text(message.get('type')), _text(message.get('content')),
+                   _text(message.get('sender')), _text(message.get('sender_remark')), _text(message.get('mtype')),
+                   _text(message.get('file_path')), _text(message.get('time')), received_at, source)
+            try:
+                self._queue.put_nowait(row)
+            except queue.Full:
+                self.dropped += 1
+                if self.dropped % 1000 == 1:
+                    logger.warning(f"消息存储写入队列已满，已丢弃 {self.dropped} 条消息")
+
+    def add_grouped(self, grouped, source):
+        """保存 {聊天对象: [消息]} 格式的消息"""
+        for chat, messages in grouped.items():
+            if isinstance(messages, list):
+                self.add_many(chat, messages, source)
+
+    def _run(self):
+        """写入线程：批量写入队列中的消息，定期清理过期消息"""
+        connection = self._connect()
+        last_purge = 0
+        while True:
+            try:
+                rows = [self._queue.get(timeout=STORE_PURGE_INTERVAL)]
+            except queue.Empty:
+                rows = []
+
+            # 攒批：等待一小段时间让同一时刻到达的消息在一个事务中写入
+            deadline = time.time() + STORE_BATCH_WAIT
+            while rows and len(rows) < STORE_BATCH_SIZE:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    rows.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            if rows:
+                self._write(connection, rows)
+
+            now = time.time()
+            if self._retention_days and now - last_purge >= STORE_PURGE_INTERVAL:
+                last_purge = now
+                self._purge(connection, now - self._retention_days * 86400)
+
+    def _write(self, connection, rows):
+        try:
+            written = 0
+            entries = []
+            with connection:
+                for row in rows:
+                    cursor = connection.execute(
+                        "INSERT OR IGNORE INTO messages (chat, msg_id, type, content, sender, sender_remark, mtype, "
+                        "file_path, msg_time, received_at, source) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        row
+                    )
+                    if cursor.rowcount:
+                        written += 1
+                        entry = _fts_row(cursor.lastrowid, row[3], row[7])
+                        if entry:
+                            entries.append(entry)
+                if entries and self.search_enabled:
+                    connection.executemany("INSERT INTO messages_fts (rowid, body) VALUES (?, ?)", entries)
+            self.written += written
+            self.duplicates += len(rows) - written
+            self.batches += 1
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"写入 {len(rows)} 条消息失败: {str(e)}")
+
+    def _purge(self, connection, before):
+        """删除早于before的消息"""
+        try:
+            with connection:
+                if self.search_enabled:
+                    connection.execute("DELETE FROM messages_fts WHERE rowid IN "
+                                       "(SELECT seq FROM messages WHERE received_at < ?)", (before,))
+                deleted = connection.execute("DELETE FROM messages WHERE received_at < ?", (before,)).rowcount
+            if deleted:
+                logger.info(f"已清理 {deleted} 条过期消息")
+        except Exception as e:
+            logger.error(f"清理过期消息失败: {str(e)}")
+
+    def _reader(self):
+        """当前线程的只读连接"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            if not self._ready.is_set():
+                self.start()
+            connection = sqlite3.connect(f"file:{self._path}?mode=ro", uri=True, timeout=10)
+            connection.row_factory = sqlite3.Row
+            self._local.connection = connection
+        return connection
+
+    def query(self, chat=None, sender=None, since=None, until=None, msg_id=None,
+              limit=100, cursor=None, order='desc'):
+        """
+        按聊天对象、发送者、时间范围查询消息，使用键集分页
+
+        Args:
+            cursor: 上一页返回的next_cursor，格式为"received_at:seq"
+            order: 'desc'从新到旧，'asc'从旧到新
+
+        Returns:
+            (消息列表, 下一页的cursor)，没有更多消息时cursor为None
+        """
+        conditions = []
+        params = []
+        if chat is not None:
+            conditions.append("chat = ?")
+            params.append(chat)
+        if sender is not None:
+            conditions.append("sender = ?")
+            params.append(sender)
+        if msg_id is not None:
+            conditions.append("msg_id = ?")
+            params.append(msg_id)
+        if since is not None:
+            conditions.append("received_at >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("received_at < ?")
+            params.append(until)
+        if cursor:
+            received_at, seq = cursor
+            op = '<' if order == 'desc' else '>'
+            conditions.append(f"(received_at {op} ? OR (received_at = ? AND seq {op} ?))")
+            params.extend((received_at, received_at, seq))
+
+        direction = 'DESC' if order == 'desc' else 'ASC'
+        limit = max(1, min(int(limit), STORE_MAX_LIMIT))
+        sql = (f"SELECT {', '.join(COLUMNS)} FROM messages"
+               f"{' WHERE ' + ' AND '.join(conditions) if conditions else ''}"
+               f" ORDER BY received_at {direction}, seq {direction} LIMIT ?")
+        params.append(limit + 1)
+
+        rows = self._reader().execute(sql, params).fetchall()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = f"{rows[-1]['received_at']!r}:{rows[-1]['seq']}"
+        return [row_to_dict(row) for row in rows], next_cursor
+
+    def search(self, query, chat=None, sender=None, msg_type=None, since=None, until=None,
+               limit=20, cursor=None, order='rank'):
+        """
+        按关键词检索消息
+
+        Args:
+            query: 空格分隔的关键词，需同时匹配
+            order: 'rank'按相关度排序，'time'按接收时间从新到旧
+            cursor: 上一页返回的next_cursor，格式为"排序值:seq"
+
+        Returns:
+            (消息列表, 下一页的cursor)，每条消息附带score和snippet
+        """
+        match = build_match_query(query)
+        if match is None:
+            return [], None
+
+        conditions = ["messages_fts MATCH ?"]
+        params = [match]
+        for column, value in (('m.chat', chat), ('m.sender', sender), ('m.type', msg_type)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            conditions.append("m.received_at >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("m.received_at < ?")
+            params.append(until)
+
+        # bm25得分越小越相关
+        key, direction, op = ('f.rank', 'ASC', '>') if order == 'rank' else ('m.received_at', 'DESC', '<')
+        if cursor:
+            value, seq = cursor
+            conditions.append(f"({key} {op} ? OR ({key} = ? AND m.seq {op} ?))")
+            params.extend((value, value, seq))
+
+        limit = max(1, min(int(limit), STORE_MAX_LIMIT))
+        sql = (f"SELECT {', '.join('m.' + column for column in COLUMNS)}, f.rank AS score "
+               f"FROM messages_fts f JOIN messages m ON m.seq = f.rowid "
+               f"WHERE {' AND '.join(conditions)} ORDER BY {key} {direction}, m.seq {direction} LIMIT ?")
+        params.append(limit + 1)
+
+        rows = self._reader().execute(sql, params).fetchall()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            next_cursor = f"{(last['score'] if order == 'rank' else last['received_at'])!r}:{last['seq']}"
+
+        results = []
+        for row in rows:
+            message = row_to_dict(row)
+            message['score'] = -row['score']
+            message['snippet'] = make_snippet(row['content'], query)
+            results.append(message)
+        return results, next_cursor
+
+    @staticmethod
+    def parse_cursor(value):
+        """解析分页cursor，无效时返回None"""
+        try:
+            key, seq = value.rsplit(':', 1)
+            return float(key), int(seq)
+        except (AttributeError, ValueError):
+            return None
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'search_enabled': self.search_enabled,
+            'path': str(self._path),
+            'queued': self._queue.qsize(),
+            'written': self.written,
+            'duplicates': self.duplicates,
+            'dropped': self.dropped,
+            'batches': self.batches,
+            'errors': self.errors,
+            'retention_days': self._retention_days
+        }
+
+_config = _load_config()
+
+# 全局消息存储
+message_store = MessageStore(enabled=bool(_config['enabled']), retention_days=_config['retention_days'])
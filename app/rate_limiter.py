@@ -0,0 +1,182 @@
+"""
+发送速率控制模块
+使用令牌桶分别限制全局和每个接收人的发送速率，避免触发微信的频率限制
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from app.unified_logger import logger
+from app.config import Config
+
+# 默认速率配置：rate为每秒补充的令牌数，burst为令牌桶容量（允许的突发发送数）
+DEFAULT_SEND_RATE_LIMIT = {
+    'enabled': True,
+    'global': {'rate': 2.0, 'burst': 20},
+    'receiver': {'rate': 0.5, 'burst': 10}
+}
+
+# 最多保留的接收人令牌桶数量，超过后淘汰最久未使用且已回满的令牌桶
+MAX_RECEIVER_BUCKETS = 5000
+
+# 单次等待令牌的最长时间（秒），防止配置错误导致执行线程长时间挂起
+MAX_ACQUIRE_WAIT = 300
+
+def _load_config():
+    """合并app_config.json中的send_rate_limit配置与默认配置"""
+    configured = Config.SEND_RATE_LIMIT if isinstance(Config.SEND_RATE_LIMIT, dict) else {}
+    config = {
+        'enabled': configured.get('enabled', DEFAULT_SEND_RATE_LIMIT['enabled']),
+        'global': dict(DEFAULT_SEND_RATE_LIMIT['global']),
+        'receiver': dict(DEFAULT_SEND_RATE_LIMIT['receiver'])
+    }
+    for level in ('global', 'receiver'):
+        if isinstance(configured.get(level), dict):
+            config[level].update(configured[level])
+    return config
+
+class TokenBucket:
+    """令牌桶，调用方负责加锁"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.time()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now, count=1):
+        """还需要等待多少秒才有count个令牌，count超过容量时按容量计算"""
+        self._refill(now)
+        count = min(count, self.capacity)
+        if self.tokens >= count:
+            return 0.0
+        if self.rate <= 0:
+            return float('inf')
+        return (count - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def level(self, now):
+        self._refill(now)
+        return round(self.tokens, 2)
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class SendRateLimiter:
+    """全局和按接收人的两级发送速率限制"""
+
+    def __init__(self, config):
+        self.enabled = bool(config['enabled'])
+        self._global_config = config['global']
+        self._receiver_config = config['receiver']
+        self._global = TokenBucket(config['global']['rate'], config['global']['burst'])
+        self._receivers = OrderedDict()
+        self._lock = threading.Lock()
+        self.delayed = 0
+        self.delayed_seconds = 0.0
+
+    def _receiver_bucket(self, receiver, now):
+        """获取接收人的令牌桶（调用方需持有锁）"""
+        bucket = self._receivers.get(receiver)
+        if bucket is None:
+            if len(self._receivers) >= MAX_RECEIVER_BUCKETS:
+                # 淘汰已回满的令牌桶，删除它不会放宽限制
+                for name in list(self._receivers):
+                    if self._receivers[name].is_full(now):
+                        del self._receivers[name]
+                        break
+            bucket = self._receivers[receiver] = TokenBucket(self._receiver_config['rate'],
+                                                             self._receiver_config['burst'])
+        else:
+            self._receivers.move_to_end(receiver)
+        return bucket
+
+    def _delay(self, receiver, now, count=1):
+        """调用方需持有锁"""
+        delay = self._global.delay(now, count)
+        if receiver:
+            delay = max(delay, self._receiver_bucket(receiver, now).delay(now, count))
+        return delay
+
+    def delay(self, receiver=None, count=1):
+        """
+        向指定接收人连续发送count条消息前还需要等待的秒数，不消耗令牌
+
+        调度器和执行线程中的任务用它决定是否先暂缓、执行其他接收人的任务，而不是在执行线程中等待
+        """
+        if not self.enabled:
+            return 0.0
+        with self._lock:
+            return self._delay(receiver, time.time(), count)
+
+    def acquire(self, receiver=None):
+        """
+        消耗一个全局令牌和一个接收人令牌，令牌不足时等待，不会失败
+
+        执行线程中的发送任务在执行前已通过delay确认令牌足够，这里的等待只是兜底
+
+        Returns:
+            等待的秒数
+        """
+        if not self.enabled:
+            return 0.0
+
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.time()
+                delay = self._delay(receiver, now)
+                if delay <= 0 or waited >= MAX_ACQUIRE_WAIT:
+                    self._global.take(now)
+                    if receiver:
+                        self._receiver_bucket(receiver, now).take(now)
+                    if waited:
+                        self.delayed += 1
+                        self.delayed_seconds += waited
+                    return waited
+            delay = min(delay, MAX_ACQUIRE_WAIT - waited)
+            logger.debug(f"发送速率受限，等待 {delay:.2f} 秒后发送给 {receiver or '当前聊天'}")
+            time.sleep(delay)
+            waited += delay
+
+    def levels(self, limit=20):
+        """
+        当前令牌余量
+
+        Args:
+            limit: 最多返回的接收人数量，按余量从低到高
+        """
+        with self._lock:
+            now = time.time()
+            receivers = sorted(((name, bucket.level(now)) for name, bucket in self._receivers.items()),
+                               key=lambda item: item[1])
+            return {
+                'enabled': self.enabled,
+                'global': {
+                    'tokens': self._global.level(now),
+                    'rate': self._global_config['rate'],
+                    'burst': self._global_config['burst']
+                },
+                'receiver': {
+                    'rate': self._receiver_config['rate'],
+                    'burst': self._receiver_config['burst'],
+                    'tracked': len(self._receivers),
+                    'lowest': [{'receiver': name, 'tokens': tokens} for name, tokens in receivers[:limit]]
+                },
+                'delayed_count': self.delayed,
+                'delayed_seconds': round(self.delayed_seconds, 2)
+            }
+
+# 全局发送速率限制器
+send_rate_limiter = SendRateLimiter(_load_config())
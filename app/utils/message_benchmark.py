@@ -0,0 +1,89 @@
+"""
+消息格式化性能测试
+对比原先各接口内联的消息转换代码与app.message_model的处理速度（条/秒）
+
+用法: python -m app.utils.message_benchmark [消息数量] [重复次数]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from app.message_model import normalize_new_messages
+
+class _FakeMessage:
+    """模拟wxauto/wxautox的消息对象，__str__开销与真实消息对象相近"""
+
+    def __init__(self, index, file_path=None):
+        self.type = 'image' if file_path else 'text'
+        self.content = f'测试消息内容 {index}' * 4
+        self.sender = f'用户{index % 20}'
+        self.time = '2025-01-01 12:00:00'
+        self.id = str(index)
+        self.mtype = None
+        self.sender_remark = None
+        self.file_path = file_path
+
+    def __str__(self):
+        return f"<{self.__class__.__name__} ({self.type}) {self.sender}: {self.content}>"
+
+def _legacy_format(messages):
+    """原先 get_next_new_message 中的转换逻辑（按聊天名称分组的分支）"""
+    def clean_group_name(name):
+        import re
+        return re.sub(r'\s*\(\d+\)$', '', name)
+
+    formatted_messages = {}
+    for chat_name, msg_list in messages.items():
+        clean_name = clean_group_name(chat_name)
+        formatted_messages[clean_name] = []
+        for msg in msg_list:
+            if hasattr(msg, 'type') and getattr(msg, 'type', '') in ['image', 'file', 'video', 'voice']:
+                if hasattr(msg, 'file_path') and getattr(msg, 'file_path', ''):
+                    file_path = getattr(msg, 'file_path', '')
+                    if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
+                        pass
+            formatted_messages[clean_name].append({
+                'type': getattr(msg, 'type', 'unknown'),
+                'content': getattr(msg, 'content', str(msg)),
+                'sender': getattr(msg, 'sender', ''),
+                'time': getattr(msg, 'time', ''),
+                'id': getattr(msg, 'id', ''),
+                'mtype': getattr(msg, 'mtype', None),
+                'sender_remark': getattr(msg, 'sender_remark', None),
+                'file_path': getattr(msg, 'file_path', None)
+            })
+    return formatted_messages
+
+def _measure(func, messages, count, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(messages)
+        best = min(best, time.perf_counter() - start)
+    return count / best
+
+def main(count=10000, repeat=5):
+    with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as f:
+        f.write(b'\xff\xd8\xff')
+        image_path = f.name
+    try:
+        # 10个群聊，每10条消息中有1条图片消息
+        messages = {}
+        for i in range(count):
+            chat = f'测试群{i % 10} ({i % 10 + 3})'
+            messages.setdefault(chat, []).append(_FakeMessage(i, image_path if i % 10 == 0 else None))
+
+        assert _legacy_format(messages) == normalize_new_messages(messages)
+
+        before = _measure(_legacy_format, messages, count, repeat)
+        after = _measure(normalize_new_messages, messages, count, repeat)
+        print(f"消息数量: {count}, 重复: {repeat} 次（取最快一次）")
+        print(f"原内联实现:   {before:,.0f} 条/秒")
+        print(f"message_model: {after:,.0f} 条/秒 ({after / before:.2f}x)")
+    finally:
+        os.remove(image_path)
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
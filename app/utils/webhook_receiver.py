@@ -0,0 +1,104 @@
+"""
+本地Webhook接收端
+用于调试和测试Webhook推送：打印收到的消息，校验签名，并可模拟目标故障
+
+用法: python -m app.utils.webhook_receiver [--port 8900] [--secret 密钥] [--fail-rate 0.3] [--status 503]
+配置示例: "webhooks": [{"url": "http://127.0.0.1:8900/webhook", "secret": "密钥"}]
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class WebhookReceiver:
+    """记录收到的批次，供测试代码检查"""
+
+    def __init__(self, secret=None, fail_rate=0.0, fail_status=503, quiet=False):
+        self.secret = secret
+        self.fail_rate = fail_rate
+        self.fail_status = fail_status
+        self.quiet = quiet
+        self.batches = []
+        self.failed_requests = 0
+        self.bad_signatures = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+    def _verify(self, body, signature):
+        if not self.secret:
+            return True
+        expected = "sha256=" + hmac.new(self.secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, signature or '')
+
+    def handler(self):
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if random.random() < receiver.fail_rate:
+                    with receiver.lock:
+                        receiver.failed_requests += 1
+                    self.send_response(receiver.fail_status)
+                    self.end_headers()
+                    return
+                if not receiver._verify(body, self.headers.get('X-Webhook-Signature')):
+                    with receiver.lock:
+                        receiver.bad_signatures += 1
+                    self.send_response(401)
+                    self.end_headers()
+                    return
+
+                payload = json.loads(body)
+                with receiver.lock:
+                    receiver.batches.append(payload)
+                if not receiver.quiet:
+                    for item in payload['messages']:
+                        print(f"[{item['event_id']}] {item['chat']}: {item['message'].get('content')}")
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    @property
+    def messages(self):
+        with self.lock:
+            return [item for batch in self.batches for item in batch['messages']]
+
+    def start(self, host='127.0.0.1', port=0):
+        """在后台线程中启动，返回实际监听的端口"""
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server.server_address[1]
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description="本地Webhook接收端")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--secret', help="校验X-Webhook-Signature签名的密钥")
+    parser.add_argument('--fail-rate', type=float, default=0.0, help="模拟失败的请求比例")
+    parser.add_argument('--status', type=int, default=503, help="模拟失败时返回的状态码")
+    args = parser.parse_args()
+
+    receiver = WebhookReceiver(args.secret, args.fail_rate, args.status)
+    receiver.server = ThreadingHTTPServer((args.host, args.port), receiver.handler())
+    print(f"Webhook接收端已启动: http://{args.host}:{args.port}/webhook")
+    try:
+        receiver.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
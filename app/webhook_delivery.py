@@ -0,0 +1,436 @@
+"""
+Webhook消息推送模块
+将监听对象收到的新消息批量POST到配置的Webhook地址。
+目标不可用时按指数退避重试，期间新消息写入磁盘队列，恢复后按顺序补发
+"""
+
+import hashlib
+import hmac
+import json
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from app.unified_logger import logger
+from app.config import Config
+from app.message_hub import message_hub
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# 磁盘队列目录，每个Webhook地址一个文件
+WEBHOOK_DIR = Config.API_DIR / "webhooks"
+
+# 单个Webhook的默认配置
+DEFAULT_WEBHOOK = {
+    'url': None,
+    'chats': None,          # 只推送这些聊天对象的消息，None表示全部
+    'batch_size': 50,       # 每个请求最多包含的消息数量
+    'batch_ms': 500,        # 攒批的最长等待时间（毫秒）
+    'concurrency': 2,       # 同时进行中的请求数量上限
+    'timeout': 10,          # 请求超时（秒）
+    'headers': {},
+    'secret': None          # 设置后使用HMAC-SHA256签名请求体
+}
+
+# 内存中最多保留的待发送消息数量，超过后写入磁盘队列
+WEBHOOK_MEMORY_LIMIT = 1000
+
+# 连续失败多少次后判定目标不可用，之后的新消息直接写入磁盘队列
+WEBHOOK_DOWN_AFTER = 3
+
+# 重试的退避时间（秒）
+WEBHOOK_BACKOFF_BASE = 1.0
+WEBHOOK_BACKOFF_MAX = 60.0
+
+# 参与延迟统计的最近消息数量
+WEBHOOK_LATENCY_SAMPLES = 1000
+
+# 可以重试的HTTP状态码，此外5xx也会重试，其他4xx视为永久失败
+RETRYABLE_STATUS = {408, 425, 429}
+
+def _load_webhooks():
+    """合并app_config.json中的webhooks配置与默认配置，忽略无效的条目"""
+    webhooks = []
+    for item in Config.WEBHOOKS if isinstance(Config.WEBHOOKS, list) else []:
+        if isinstance(item, str):
+            item = {'url': item}
+        if not isinstance(item, dict) or not item.get('url'):
+            logger.warning(f"忽略无效的Webhook配置: {item}")
+            continue
+        config = dict(DEFAULT_WEBHOOK)
+        config.update(item)
+        config['batch_size'] = max(int(config['batch_size']), 1)
+        config['concurrency'] = max(int(config['concurrency']), 1)
+        webhooks.append(config)
+    return webhooks
+
+def _percentile(samples, percent):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return round(ordered[min(int(len(ordered) * percent), len(ordered) - 1)], 3)
+
+class WebhookEndpoint:
+    """
+    单个Webhook地址的推送队列
+
+    消息优先保存在内存中；目标不可用、内存队列已满或磁盘队列尚未清空时写入磁盘队列，
+    保证补发顺序。同一时刻只有一个发送线程读取磁盘队列，确认送达后才推进读取位置，
+    服务重启后从上次确认的位置继续
+    """
+
+    def __init__(self, config):
+        self.url = config['url']
+        self.name = hashlib.sha1(self.url.encode('utf-8')).hexdigest()[:12]
+        self._config = config
+        self._chats = frozenset(config['chats']) if config['chats'] else None
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._file_lock = threading.Lock()
+        self._spill_path = WEBHOOK_DIR / f"{self.name}.jsonl"
+        self._offset_path = WEBHOOK_DIR / f"{self.name}.offset"
+        self._spill_offset = 0
+        self._spill_pending = 0
+        self._spill_busy = False
+        self._consecutive_failures = 0
+        self._running = False
+        self._stop_event = threading.Event()
+        self._threads = []
+        self._client = None
+        self._latencies = deque(maxlen=WEBHOOK_LATENCY_SAMPLES)
+        self.delivered = 0
+        self.batches = 0
+        self.failures = 0
+        self.retries = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.last_error = None
+        self.last_success_at = None
+        self._load_spill()
+
+    @property
+    def down(self):
+        return self._consecutive_failures >= WEBHOOK_DOWN_AFTER
+
+    def accepts(self, chat):
+        return self._chats is None or chat in self._chats
+
+    def enqueue(self, item):
+        """加入一条待推送的消息"""
+        with self._cond:
+            if self.down or self._spill_pending or len(self._pending) >= WEBHOOK_MEMORY_LIMIT:
+                self._spill_pending += 1
+                spill = True
+            else:
+                self._pending.append(item)
+                spill = False
+            self._cond.notify()
+        if spill:
+            self._spill([item])
+
+    def start(self):
+        self._client = httpx.Client(
+            timeout=self._config['timeout'],
+            limits=httpx.Limits(max_connections=self._config['concurrency'],
+                                max_keepalive_connections=self._config['concurrency'])
+        )
+        self._running = True
+        self._stop_event.clear()
+        for i in range(self._config['concurrency']):
+            thread = threading.Thread(target=self._run, daemon=True, name=f"Webhook-{self.name}-{i}")
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """停止发送线程，内存中未送达的消息写入磁盘队列"""
+        with self._cond:
+            self._running = False
+            self._stop_event.set()
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        self._threads = []
+        with self._cond:
+            remaining = list(self._pending)
+            self._pending.clear()
+            self._spill_pending += len(remaining)
+        if remaining:
+            self._spill(remaining)
+        if self._client:
+            self._client.close()
+
+    def _run(self):
+        while True:
+            batch, next_offset = self._next_batch()
+            if batch is None:
+                return
+            delivered = self._deliver(batch)
+            if next_offset is not None:
+                self._ack_spill(len(batch), next_offset, delivered)
+            elif not delivered:
+                # 服务停止时仍未送达的内存消息写入磁盘队列，重启后补发
+                with self._cond:
+                    self._spill_pending += len(batch)
+                self._spill(batch)
+
+    def _next_batch(self):
+        """
+        等待下一批消息：攒够batch_size条或最早的消息等待超过batch_ms时发送内存中的消息，
+        内存队列为空时读取磁盘队列
+
+        Returns:
+            (消息列表, 磁盘队列读取后的位置)，消息来自内存时位置为None；服务停止时消息列表为None
+        """
+        batch_size = self._config['batch_size']
+        batch_delay = self._config['batch_ms'] / 1000
+        with self._cond:
+            while self._running:
+                if self._pending:
+                    wait = self._pending[0]['received_at'] + batch_delay - time.time()
+                    if len(self._pending) >= batch_size or wait <= 0:
+                        return [self._pending.popleft() for _ in range(min(batch_size, len(self._pending)))], None
+                    self._cond.wait(wait)
+                elif self._spill_pending and not self._spill_busy:
+                    self._spill_busy = True
+                    offset = self._spill_offset
+                    break
+                else:
+                    self._cond.wait()
+            else:
+                return None, None
+
+        try:
+            batch, next_offset = self._read_spill(offset, batch_size)
+        except Exception as e:
+            logger.error(f"读取Webhook磁盘队列失败: {str(e)}")
+            batch, next_offset = [], offset
+        if not batch:
+            with self._cond:
+                self._spill_busy = False
+            # 写入尚未完成时稍后再读
+            self._stop_event.wait(batch_delay)
+            return [], None
+        return batch, next_offset
+
+    def _deliver(self, batch):
+        """
+        发送一批消息，可重试的失败按指数退避重试直到成功、永久失败或服务停止
+
+        Returns:
+            是否已处理完毕（送达或永久失败），False表示服务停止时仍未送达
+        """
+        if not batch:
+            return True
+        body = json.dumps({
+            'webhook_id': self.name,
+            'sent_at': time.time(),
+            'messages': batch
+        }, ensure_ascii=False).encode('utf-8')
+        headers = {'Content-Type': 'application/json', 'X-Webhook-Delivery': uuid.uuid4().hex}
+        headers.update(self._config['headers'] or {})
+        if self._config['secret']:
+            signature = hmac.new(str(self._config['secret']).encode('utf-8'), body, hashlib.sha256).hexdigest()
+            headers['X-Webhook-Signature'] = f"sha256={signature}"
+
+        attempt = 0
+        while True:
+            error = None
+            try:
+                response = self._client.post(self.url, content=body, headers=headers)
+                if 200 <= response.status_code < 300:
+                    self._on_success(batch)
+                    return True
+                error = f"HTTP {response.status_code}"
+                retryable = response.status_code >= 500 or response.status_code in RETRYABLE_STATUS
+            except Exception as e:
+                error = f"{type(e).__name__}: {str(e)}"
+                retryable = True
+
+            with self._cond:
+                self.failures += 1
+                self.last_error = error
+                if not retryable:
+                    self.dropped += len(batch)
+                    logger.error(f"Webhook {self.url} 拒绝了 {len(batch)} 条消息，不再重试: {error}")
+                    return True
+                self._consecutive_failures += 1
+                if self._consecutive_failures == WEBHOOK_DOWN_AFTER:
+                    logger.warning(f"Webhook {self.url} 连续失败 {WEBHOOK_DOWN_AFTER} 次，新消息将写入磁盘队列")
+
+            delay = min(WEBHOOK_BACKOFF_BASE * (2 ** attempt), WEBHOOK_BACKOFF_MAX)
+            delay = random.uniform(delay / 2, delay)
+            attempt += 1
+            logger.debug(f"Webhook {self.url} 推送失败: {error}，{delay:.1f} 秒后重试")
+            if self._stop_event.wait(delay):
+                return False
+            with self._cond:
+                self.retries += 1
+
+    def _on_success(self, batch):
+        now = time.time()
+        with self._cond:
+            if self.down:
+                logger.info(f"Webhook {self.url} 已恢复")
+            self._consecutive_failures = 0
+            self.delivered += len(batch)
+            self.batches += 1
+            self.last_success_at = now
+            self._latencies.extend(now - item['received_at'] for item in batch)
+
+    def _spill(self, items):
+        """追加写入磁盘队列"""
+        lines = ''.join(json.dumps(item, ensure_ascii=False) + '\n' for item in items)
+        try:
+            with self._file_lock:
+                with open(self._spill_path, 'a', encoding='utf-8') as f:
+                    f.write(lines)
+            with self._cond:
+                self.spilled += len(items)
+                self._cond.notify()
+        except Exception as e:
+            logger.error(f"写入Webhook磁盘队列失败，丢弃 {len(items)} 条消息: {str(e)}")
+            with self._cond:
+                self._spill_pending -= len(items)
+                self.dropped += len(items)
+
+    def _read_spill(self, offset, limit):
+        """从指定位置读取最多limit条消息，返回(消息列表, 读取后的位置)"""
+        batch = []
+        with self._file_lock:
+            with open(self._spill_path, 'rb') as f:
+                f.seek(offset)
+                while len(batch) < limit:
+                    line = f.readline()
+                    if not line or not line.endswith(b'\n'):
+                        break
+                    offset += len(line)
+                    try:
+                        batch.append(json.loads(line))
+                    except ValueError:
+                        continue
+        return batch, offset
+
+    def _ack_spill(self, count, next_offset, delivered):
+        """磁盘队列中的一批消息已处理，推进读取位置，全部处理完时清空文件"""
+        with self._cond:
+            self._spill_busy = False
+            if not delivered:
+                return
+            self._spill_pending = max(self._spill_pending - count, 0)
+            self._spill_offset = next_offset
+            drained = self._spill_pending == 0
+            self._cond.notify()
+
+        try:
+            with self._file_lock:
+                if drained and self._spill_path.stat().st_size <= next_offset:
+                    self._spill_path.unlink()
+                    self._offset_path.unlink(missing_ok=True)
+                    with self._cond:
+                        self._spill_offset = 0
+                else:
+                    self._offset_path.write_text(str(next_offset), encoding='utf-8')
+        except Exception as e:
+            logger.warning(f"更新Webhook磁盘队列位置失败: {str(e)}")
+
+    def _load_spill(self):
+        """启动时恢复上次未送达的磁盘队列"""
+        if not self._spill_path.exists():
+            return
+        try:
+            if self._offset_path.exists():
+                self._spill_offset = int(self._offset_path.read_text(encoding='utf-8') or 0)
+            with open(self._spill_path, 'rb') as f:
+                f.seek(self._spill_offset)
+                self._spill_pending = sum(1 for line in f if line.endswith(b'\n'))
+            if self._spill_pending:
+                logger.info(f"Webhook {self.url} 有 {self._spill_pending} 条未送达的消息待补发")
+        except Exception as e:
+            logger.error(f"加载Webhook磁盘队列失败: {str(e)}")
+
+    def stats(self):
+        with self._cond:
+            latencies = list(self._latencies)
+            return {
+                'url': self.url,
+                'webhook_id': self.name,
+                'state': 'down' if self.down else 'up',
+                'pending': len(self._pending),
+                'spill_pending': self._spill_pending,
+                'delivered': self.delivered,
+                'batches': self.batches,
+                'failures': self.failures,
+                'retries': self.retries,
+                'dropped': self.dropped,
+                'spilled': self.spilled,
+                'consecutive_failures': self._consecutive_failures,
+                'last_error': self.last_error,
+                'last_success_at': self.last_success_at,
+                'latency': {
+                    'p50': _percentile(latencies, 0.5),
+                    'p95': _percentile(latencies, 0.95),
+                    'max': round(max(latencies), 3) if latencies else None
+                }
+            }
+
+class WebhookDispatcher:
+    """将监听消息分发到所有配置的Webhook"""
+
+    def __init__(self, configs):
+        self._configs = configs
+        self._endpoints = []
+        self._started = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        """创建推送队列并订阅新消息，没有配置Webhook时不做任何事"""
+        with self._lock:
+            if self._started or not self._configs:
+                return
+            if httpx is None:
+                logger.error("未安装httpx，Webhook推送不可用")
+                return
+            WEBHOOK_DIR.mkdir(parents=True, exist_ok=True)
+            self._endpoints = [WebhookEndpoint(config) for config in self._configs]
+            for endpoint in self._endpoints:
+                endpoint.start()
+            message_hub.add_listener(self._on_message)
+            self._started = True
+        logger.info(f"Webhook推送已启动，共 {len(self._endpoints)} 个地址")
+
+    @property
+    def started(self):
+        """是否已配置Webhook并开始推送"""
+        return self._started
+
+    def stop(self):
+        with self._lock:
+            for endpoint in self._endpoints:
+                endpoint.stop()
+
+    def _on_message(self, event_id, chat, message):
+        item = None
+        for endpoint in self._endpoints:
+            if endpoint.accepts(chat):
+                if item is None:
+                    item = {
+                        'id': uuid.uuid4().hex,
+                        'event_id': event_id,
+                        'chat': chat,
+                        'message': message,
+                        'received_at': time.time()
+                    }
+                endpoint.enqueue(item)
+
+    def stats(self):
+        return {
+            'enabled': self._started,
+            'endpoints': [endpoint.stats() for endpoint in self._endpoints]
+        }
+
+# 全局Webhook分发器，由路由模块启动
+webhook_dispatcher = WebhookDispatcher(_load_webhooks())
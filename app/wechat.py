@@ -4,6 +4,8 @@
 from app.unified_logger import logger
 from app.config import Config
 from app.wechat_adapter import wechat_adapter
+from app.api_queue import run_in_executor
+from app.adaptive_poll import AdaptiveInterval
 
 class WeChatManager:
     def __init__(self):
@@ -17,6 +19,8 @@ def __init__(self):
         self._running = False
         self._retry_count = 0
         self._adapter = wechat_adapter
+        # 连接检查间隔：重连后使用最短间隔，连接持续正常时逐渐增大
+        self._check_schedule = AdaptiveInterval(Config.WECHAT_CHECK_MIN_INTERVAL, self._check_interval)
 
     def initialize(self):
         """初始化微信实例"""
@@ -44,10 +48,15 @@ def check_connection(self):
             return False
 
         try:
-            result = self._adapter.check_connection()
+            # 连接检查同样需要操作UI，交给执行线程串行执行
+            result = run_in_executor(self._adapter.check_connection, timeout=self._check_interval)
             if result:
                 self._retry_count = 0  # 重置重试计数
             return result
+        except TimeoutError:
+            # 执行线程正忙于其他UI任务，说明实例仍在工作，不视为断开
+            logger.debug("连接检查等待执行线程超时，跳过本次检查")
+            return True
         except Exception as e:
             error_str = str(e)
             # 对于GetNextSiblingControl等控件访问错误，使用debug级别
@@ -62,20 +71,28 @@ def _monitor_connection(self):
         # 为监控线程初始化COM环境
         pythoncom.CoInitialize()
 
+        schedule = self._check_schedule
         while self._running:
             try:
-                if not self.check_connection():
+                connected = self.check_connection()
+                schedule.record_poll()
+                if not connected:
                     if self._retry_count < self._max_retry:
                         logger.warning(f"微信连接已断开，正在尝试重新连接 (尝试 {self._retry_count + 1}/{self._max_retry})...")
                         self._instance = None
                         self.initialize()
                         self._retry_count += 1
+                        # 重连后尽快确认连接是否恢复
+                        schedule.activity()
                         time.sleep(self._reconnect_delay)  # 重连等待时间
                     else:
                         logger.error("重连次数超过最大限制，停止自动重连")
                         self._running = False
                 else:
-                    time.sleep(self._check_interval)
+                    # 先按当前间隔等待再增大间隔，重连后的第一次确认使用最短间隔；
+                    # 有发送任务排队时推迟检查，避免占用执行线程
+                    schedule.wait()
+                    schedule.idle()
             except Exception as e:
                 logger.error(f"连接监控异常: {str(e)}")
                 time.sleep(self._check_interval)
@@ -95,6 +112,13 @@ def _start_monitor(self):
             self._monitor_thread.start()
             logger.info("微信连接监控已启动")
 
+    def monitor_stats(self):
+        """连接监控的检查频率统计"""
+        stats = self._check_schedule.stats()
+        stats['running'] = bool(self._monitor_thread and self._monitor_thread.is_alive())
+        stats['retry_count'] = self._retry_count
+        return stats
+
     def stop(self):
         """停止监控"""
         self._running = False
@@ -10,6 +10,7 @@
 import time
 import pythoncom
 import logging
+from functools import wraps
 from typing import Optional, Union, List, Dict, Any
 
 
@@ -25,6 +26,89 @@
     )
     logger = logging.getLogger("wechat_adapter")
 
+from app.message_model import serialize_message, serialize_messages, clean_group_name
+
+# 只读取数据、耗时较长的方法放入后台通道，避免阻塞交互式发送
+BACKGROUND_METHODS = {
+    'GetAllFriends', 'GetAllGroups', 'GetGroupMembers', 'GetFriendDetails',
+    'GetAllRecentGroups', 'GetContactGroups', 'GetNewFriends', 'Moments'
+}
+
+# 发送类方法，调用前按全局和接收人的速率限制等待令牌
+SEND_METHODS = {'SendMsg', 'SendFiles', 'SendTypingText', 'SendUrlCard', 'SendEmotion', 'AtAll'}
+
+# 长时间阻塞或只启动/停止库自身监听线程的方法，不放入UI自动化执行线程，避免长期占用执行线程
+BLOCKING_METHODS = {'KeepRunning', 'StartListening', 'StopListening'}
+
+# 返回窗口对象的方法，返回的窗口同样包装为UIProxy
+WINDOW_METHODS = {'Moments'}
+
+def _rate_limited(func, get_receiver):
+    """发送前等待发送令牌，令牌不足时延迟发送而不是失败；get_receiver在发送时返回接收人"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        from app.rate_limiter import send_rate_limiter
+        send_rate_limiter.acquire(kwargs.get('who') or get_receiver())
+        return func(*args, **kwargs)
+    return wrapper
+
+def _on_executor(func=None, lane=None, get_affinity=None):
+    """
+    将调用转交给UI自动化执行线程串行执行，lane为使用的优先级通道
+
+    get_affinity按调用参数返回亲和键（发送方法的接收人），接收人的发送令牌不足时任务在队列中暂缓，
+    而不是在执行线程中等待令牌
+    """
+    if func is None:
+        return lambda f: _on_executor(f, lane=lane, get_affinity=get_affinity)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        # 延迟导入，避免与队列模块循环导入
+        from app.api_queue import run_in_executor
+        affinity = get_affinity(kwargs) if get_affinity else None
+        return run_in_executor(func, args, kwargs, lane=lane, affinity=affinity)
+    return wrapper
+
+class UIProxy:
+    """
+    微信窗口对象（监听的聊天窗口、朋友圈窗口）的代理
+
+    方法调用转交给UI自动化执行线程，发送方法按窗口的聊天对象限速，属性读取直接返回原对象的属性
+    """
+
+    def __init__(self, target, receiver=None):
+        self._ui_target = target
+        self._ui_receiver = receiver
+
+    def __getattr__(self, name):
+        attr = getattr(self._ui_target, name)
+        if not callable(attr) or isinstance(attr, type):
+            return attr
+        lane = 'background' if name in BACKGROUND_METHODS else None
+        if name in SEND_METHODS:
+            attr = _rate_limited(attr, lambda: self._ui_receiver)
+            return _on_executor(attr, lane=lane, get_affinity=lambda kwargs: kwargs.get('who') or self._ui_receiver)
+        return _on_executor(attr, lane=lane)
+
+    def __repr__(self):
+        return repr(self._ui_target)
+
+    def __str__(self):
+        return str(self._ui_target)
+
+def _unwrap(obj):
+    """取出UIProxy包装的原对象"""
+    return obj._ui_target if isinstance(obj, UIProxy) else obj
+
+def _returns_window(func):
+    """将方法返回的窗口对象包装为UIProxy"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        result = func(*args, **kwargs)
+        return UIProxy(result) if result is not None else None
+    return wrapper
+
 class WeChatAdapter:
     """微信自动化库适配器，支持wxauto和wxautox"""
 
@@ -41,7 +125,9 @@ def __init__(self, lib_name: str = 'wxauto', lazy_init: bool = False):
         self._requested_lib_name = lib_name  # 保存请求的库名称
         self._lock = threading.Lock()
         self._listen = {}  # 添加listen属性
+        self._window_proxies = {}  # 聊天对象 -> (聊天窗口对象, UIProxy)，窗口对象不变时复用同一个代理
         self._cached_window_name = ""  # 添加窗口名称缓存
+        self._current_chat = None  # 主窗口当前聊天对象，用于按接收人限制发送速率
         self._lazy_init = lazy_init
         self._initialized = False
 
@@ -87,13 +173,26 @@ def _ensure_initialized(self):
 
     @property
     def listen(self):
-        """获取监听列表"""
+        """获取监听列表，聊天窗口包装为UIProxy，方法调用在UI自动化执行线程中执行"""
         self._ensure_initialized()
         if self._instance:
-            # 直接返回实例的listen属性
-            return self._instance.listen
+            return {who: self._proxy_listen_item(who, item) for who, item in self._instance.listen.items()}
         return self._listen
 
+    def _proxy_listen_item(self, who, item):
+        """包装监听列表中的聊天窗口，部分版本的值为(聊天窗口, 回调)元组"""
+        if isinstance(item, tuple):
+            return (self._proxy_window(who, item[0]),) + item[1:] if item else item
+        return self._proxy_window(who, item)
+
+    def _proxy_window(self, who, chat_wnd):
+        cached = self._window_proxies.get(who)
+        if cached is not None and cached[0] is chat_wnd:
+            return cached[1]
+        proxy = UIProxy(chat_wnd, receiver=who)
+        self._window_proxies[who] = (chat_wnd, proxy)
+        return proxy
+
     def _try_import_wxautox(self) -> bool:
         """尝试导入wxautox库"""
         try:
@@ -478,10 +577,36 @@ def __getattr__(self, name):
 
         # 直接代理到实际实例，暂时禁用所有特殊处理
         try:
-            return getattr(self._instance, name)
+            attr = getattr(self._instance, name)
         except AttributeError:
             raise AttributeError(f"'{self.__class__.__name__}' object has no attribute '{name}'")
 
+        # 实例方法统一在UI自动化执行线程中调用，避免多个线程同时操作微信窗口
+        if callable(attr) and not isinstance(attr, type) and name not in BLOCKING_METHODS:
+            if name in WINDOW_METHODS:
+                attr = _returns_window(attr)
+            elif name == 'ChatWith':
+                attr = self._track_chat(attr)
+            lane = 'background' if name in BACKGROUND_METHODS else None
+            if name in SEND_METHODS:
+                # 在执行线程中取令牌，接收人为发送时主窗口的当前聊天对象
+                attr = _rate_limited(attr, lambda: self._current_chat)
+                return _on_executor(attr, lane=lane,
+                                    get_affinity=lambda kwargs: kwargs.get('who') or self._current_chat)
+            return _on_executor(attr, lane=lane)
+        return attr
+
+    def _track_chat(self, chat_with):
+        """记录ChatWith切换到的聊天对象"""
+        @wraps(chat_with)
+        def wrapper(who, *args, **kwargs):
+            self._current_chat = None
+            result = chat_with(who, *args, **kwargs)
+            if result:
+                self._current_chat = who
+            return result
+        return wrapper
+
     def _handle_ChatWith(self, *args, **kwargs):
         """处理ChatWith方法的差异"""
         if not self._instance:
@@ -794,7 +919,6 @@ def message_callback(msg, chat):
                     content = getattr(msg, 'content', str(msg))
                     sender = getattr(msg, 'sender', '未知发送者')
                     msg_type = getattr(msg, 'type', '未知类型')
-                    msg_id = getattr(msg, 'id', '')
                     timestamp = getattr(msg, 'timestamp', None)
 
                     logger.info(f"消息发送者: {sender}")
@@ -805,24 +929,15 @@ def message_callback(msg, chat):
                     chat_name = str(chat) if hasattr(chat, '__str__') else getattr(chat, 'who', str(chat))
 
                     # 清理群名中的人数信息
-                    import re
-                    clean_name = re.sub(r'\s*\(\d+\)$', '', chat_name)
+                    clean_name = clean_group_name(chat_name)
 
                     # 初始化该聊天的消息列表
                     if clean_name not in self._message_cache:
                         self._message_cache[clean_name] = []
 
                     # 将消息添加到缓存
-                    msg_data = {
-                        'type': msg_type,
-                        'content': content,
-                        'sender': sender,
-                        'id': msg_id,
-                        'timestamp': timestamp,
-                        'mtype': getattr(msg, 'mtype', None),
-                        'sender_remark': getattr(msg, 'sender_remark', None),
-                        'file_path': getattr(msg, 'file_path', None)
-                    }
+                    msg_data = serialize_message(msg)
+                    msg_data['timestamp'] = timestamp
 
                     self._message_cache[clean_name].append(msg_data)
                     logger.info(f"消息已缓存到 {clean_name}: {content[:50]}...")
@@ -1346,16 +1461,21 @@ def _handle_RemoveListenChat_DELETED(self, *args, **kwargs):
                 return False
 
 # 添加对聊天窗口方法的特殊处理
+    @_on_executor
     def _handle_chat_window_method(self, chat_wnd, method_name, *args, **kwargs):
-        """处理聊天窗口方法的调用，添加异常处理"""
+        """处理聊天窗口方法的调用，添加异常处理，在UI自动化执行线程中执行"""
         if not chat_wnd:
             raise AttributeError(f"聊天窗口对象为空，无法调用 {method_name} 方法")
+        chat_wnd = _unwrap(chat_wnd)
 
         # 获取方法
         method = getattr(chat_wnd, method_name, None)
         if not method:
             raise AttributeError(f"聊天窗口对象没有 {method_name} 方法")
 
+        if method_name in SEND_METHODS:
+            method = _rate_limited(method, lambda: getattr(chat_wnd, 'who', None))
+
         try:
             # 调用方法
             return method(*args, **kwargs)
@@ -1367,6 +1487,7 @@ def _handle_chat_window_method(self, chat_wnd, method_name, *args, **kwargs):
             # 重新抛出异常，让上层处理
             raise
 
+    @_on_executor(lane='background')
     def get_friend_list(self):
         """
         获取好友列表
@@ -1385,6 +1506,7 @@ def get_friend_list(self):
             # 重新抛出异常，让上层处理
             raise
 
+    @_on_executor(lane='background')
     def get_group_list(self):
         """
         获取群聊列表
@@ -1414,6 +1536,7 @@ def get_group_list(self):
             # 重新抛出异常，让上层处理
             raise
 
+    @_on_executor(lane='background')
     def GetNextNewMessage(self, *args, **kwargs):
         """
         获取下一条新消息 - 独立实现，无缓存机制
@@ -1488,22 +1611,7 @@ def GetNextNewMessage(self, *args, **kwargs):
                                 messages = result.get('msg', [])
                                 if isinstance(messages, list):
                                     # 转换消息对象为可序列化格式，但保持字典结构
-                                    serializable_messages = []
-                                    for msg in messages:
-                                        try:
-                                            msg_dict = {
-                                                'type': getattr(msg, 'type', 'unknown'),
-                                                'content': getattr(msg, 'content', str(msg)),
-                                                'sender': getattr(msg, 'sender', ''),
-                                                'time': getattr(msg, 'time', ''),
-                                                'id': getattr(msg, 'id', ''),
-                                                'mtype': getattr(msg, 'mtype', None),
-                                                'sender_remark': getattr(msg, 'sender_remark', None),
-                                                'file_path': getattr(msg, 'file_path', None)
-                                            }
-                                            serializable_messages.append(msg_dict)
-                                        except Exception as e:
-                                            logger.error(f"转换字典中的消息对象失败: {str(e)}")
+                                    serializable_messages = serialize_messages(messages)
 
                                     # 保持字典格式，只替换msg部分
                                     serializable_result = result.copy()
@@ -1516,36 +1624,7 @@ def GetNextNewMessage(self, *args, **kwargs):
                     # 如果result是列表格式
                     elif isinstance(result, (list, tuple)):
                         logger.debug("处理列表格式的result")
-                        for i, msg in enumerate(result):
-                            try:
-                                logger.debug(f"处理消息 {i}: type={type(msg)}, value={msg}")
-
-                                # 将消息对象转换为字典
-                                msg_dict = {
-                                    'type': getattr(msg, 'type', 'unknown'),
-                                    'content': getattr(msg, 'content', str(msg)),
-                                    'sender': getattr(msg, 'sender', ''),
-                                    'time': getattr(msg, 'time', ''),
-                                    'id': getattr(msg, 'id', ''),
-                                    'mtype': getattr(msg, 'mtype', None),
-                                    'sender_remark': getattr(msg, 'sender_remark', None),
-                                    'file_path': getattr(msg, 'file_path', None)
-                                }
-                                serializable_result.append(msg_dict)
-                                logger.debug(f"转换消息: {msg_dict}")
-                            except Exception as e:
-                                logger.error(f"转换wxauto消息对象失败: {str(e)}")
-                                # 添加错误消息
-                                serializable_result.append({
-                                    'type': 'error',
-                                    'content': f'消息转换错误: {str(e)}',
-                                    'sender': '',
-                                    'time': '',
-                                    'id': '',
-                                    'mtype': None,
-                                    'sender_remark': None,
-                                    'file_path': None
-                                })
+                        serializable_result = serialize_messages(result)
 
                     else:
                         # 其他类型，直接转换为字符串